@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# Compares the notes DiffRuleSet gives against searching for each rule on its own, as the checks were originally made
+# Lines matched by rules which overlap each other are checked first, then every line of the files given (if any)
+# Usage: diff_rules.py [file]...
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hooks"))
+from hooklib import CommitChecker, DiffRule, DiffRuleSet
+
+# The match of the first rule covers the start of the match of the second
+Overlapping = [
+    DiffRule("first", r".", r"(foo)bar", "[FIRST: {0}]"),
+    DiffRule("second", r".", r"(bar)\(", "[SECOND: {0}]"),
+]
+
+def expected_notes(rules, line):
+    "The notes for the given line, searching for each rule on its own"
+    notes = list()
+    for rule in rules:
+        match = rule.expression.search(line)
+        if match:
+            notes.append( rule.note.format(*match.groups()) )
+    return notes
+
+def compare(rules, rule_set, line, source):
+    expected = expected_notes(rules, line)
+    result = rule_set.check(line)
+    if result != expected:
+        print "{0}: {1!r}: expected {2!r}, got {3!r}".format(source, line, expected, result)
+        return 1
+    return 0
+
+differences = 0
+for line in ["foobar(", "foobar( and foobar(", "bar( foobar"]:
+    differences += compare(Overlapping, DiffRuleSet(Overlapping), line, "overlapping rules")
+
+checker = CommitChecker()
+lines = 0
+for path in sys.argv[1:]:
+    rule_set = checker.rules_for(path)
+    with open(path, "rb") as sourcefile:
+        for line in sourcefile:
+            lines += 1
+            differences += compare(rule_set.rules, rule_set, line, path)
+
+print "{0} lines of {1} files, {2} differences".format(lines, len(sys.argv) - 1, differences)
+if differences:
+    sys.exit(1)
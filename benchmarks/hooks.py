@@ -0,0 +1,401 @@
+#!/usr/bin/python
+# Measures how each stage of the hooks scales, against synthetic repositories or replayed pushes
+# Mail and DNS are served by stubs on the loopback interface, so nothing leaves the machine
+# Usage:
+#   hooks.py synthetic [--commits N] [--files N] [--file-size BYTES] [--refs N] [--renames FRACTION] [--keep DIRECTORY]
+#   hooks.py replay <bare repository> <file of "<oldsha> <newsha> <refname>" lines, as given to pre-receive>
+
+import argparse
+import asyncore
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import smtpd
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hooks"))
+import hooklib
+from ordereddict import OrderedDict
+
+ManagementDirectory = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# The audits made on each batch of commits, as audit_pushed_commits() makes them
+Audits = ["audit_eol_blobs", "audit_filename", "audit_names_in_metadata", "audit_emails_in_metadata"]
+
+class Stages(object):
+
+    """The time spent in each stage, and the peak memory used while in it
+
+    Stages may be entered several times, in which case their times are added up.
+    Where Linux allows the peak to be reset (through /proc/self/clear_refs) the peak
+    is that of the stage alone, otherwise it is the peak of the process so far."""
+
+    def __init__(self):
+        self.results = OrderedDict()
+
+    @contextmanager
+    def measure(self, name):
+        hooklib.HookMetrics.reset_peak_rss()
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            peak = hooklib.HookMetrics.peak_rss()
+            entry = self.results.setdefault(name, {"calls": 0, "seconds": 0.0, "peak_rss_kb": 0})
+            entry["calls"] += 1
+            entry["seconds"] += elapsed
+            entry["peak_rss_kb"] = max(entry["peak_rss_kb"], peak)
+
+class SmtpSink(smtpd.SMTPServer):
+
+    "Accepts and counts mail on a local port, discarding it"
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.received = 0
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received += 1
+
+    def start(self):
+        thread = threading.Thread(target=asyncore.loop, kwargs={"timeout": 0.1})
+        thread.daemon = True
+        thread.start()
+
+class DnsStub(object):
+
+    "Answers every MX and A query made to a local port, so all domains are valid"
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.port = self.socket.getsockname()[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        # Only loaded when needed, as the hooks themselves do
+        import dns.message
+        import dns.rdatatype
+        import dns.rrset
+
+        while True:
+            data, address = self.socket.recvfrom(4096)
+            query = dns.message.from_wire(data)
+            response = dns.message.make_response(query)
+            question = query.question[0]
+            name = question.name.to_text()
+            if question.rdtype == dns.rdatatype.MX:
+                response.answer.append( dns.rrset.from_text(name, 60, "IN", "MX", "10 mail." + name) )
+            elif question.rdtype == dns.rdatatype.A:
+                response.answer.append( dns.rrset.from_text(name, 60, "IN", "A", "127.0.0.1") )
+            self.socket.sendto(response.to_wire(), address)
+
+class SyntheticRepository(object):
+
+    """Generates a bare repository with git fast-import, to push to
+
+    The root commit adds the initial files, which the refs of the repository point at.
+    The history to push follows it in a single line, with each commit touching a number
+    of files: some of which are renamed, and some newly added (with a license header)."""
+
+    Authors = [
+        ("Alice Developer", "alice@example.org"), ("Bob Maintainer", "bob@example.com"),
+        ("Carol Translator", "carol@example.net"), ("Dave Contributor", "dave@kde.example"),
+    ]
+
+    Headers = [
+        ["/*", "    SPDX-FileCopyrightText: 2020 Alice Developer <alice@example.org>", "",
+         "    SPDX-License-Identifier: LGPL-2.1-only OR LGPL-3.0-only OR LicenseRef-KDE-Accepted-LGPL", "*/"],
+        ["/*", " * Copyright 2020 Bob Maintainer <bob@example.com>", " *",
+         " * This library is free software; you can redistribute it and/or",
+         " * modify it under the terms of the GNU Lesser General Public",
+         " * License as published by the Free Software Foundation; either",
+         " * version 2.1 of the License, or (at your option) any later version.", " */"],
+    ]
+
+    Words = ["value", "count", "result", "index", "buffer", "widget", "model", "view", "item", "entry", "path", "name"]
+
+    def __init__(self, directory, commits, files, file_size, refs, renames, seed = 1):
+        self.git_dir = os.path.join(directory, "kde", "bench.git")
+        self.commits = commits
+        self.files = files
+        self.file_size = file_size
+        self.refs = refs
+        self.renames = renames
+        self.random = random.Random(seed)
+        self.paths = itertools.count()
+
+    def generate(self):
+        "Creates the repository, returning the change to replay against it"
+        subprocess.check_call(["git", "init", "--quiet", "--bare", self.git_dir])
+        environment = dict(os.environ, GIT_DIR=self.git_dir)
+        process = subprocess.Popen(["git", "fast-import", "--quiet"], stdin=subprocess.PIPE, env=environment)
+
+        # The root, which everything already in the repository is based on
+        live = [self.new_path() for _ in xrange(self.files)]
+        self.write_commit(process.stdin, "refs/heads/master", 1, None, [("M", path) for path in live])
+
+        # Refs already in the repository, each with a commit of their own so all of them are distinct tips
+        for number in xrange(self.refs):
+            self.write_commit(process.stdin, "refs/heads/branch-{0}".format(number), 2 + number, 1, [("M", self.random.choice(live))])
+
+        # The history being pushed, kept alive by a ref the hooks ignore
+        mark = 1
+        for number in xrange(self.commits):
+            parent = mark
+            mark = 2 + self.refs + number
+            operations = list()
+            for path in self.random.sample(live, min(self.files, len(live))):
+                chance = self.random.random()
+                if chance < self.renames:
+                    renamed = self.new_path()
+                    live[live.index(path)] = renamed
+                    operations.append( ("R", path, renamed) )
+                elif chance < self.renames + 0.1:
+                    added = self.new_path()
+                    live.append(added)
+                    operations.append( ("M", added) )
+                else:
+                    operations.append( ("M", path) )
+            self.write_commit(process.stdin, "refs/keep-around/bench", mark, parent, operations)
+
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError("git fast-import failed")
+
+        root = self.rev_parse("refs/heads/master")
+        tip = self.rev_parse("refs/keep-around/bench")
+        return [(root, tip, "refs/heads/master")]
+
+    def new_path(self):
+        number = next(self.paths)
+        return "src/part{0}/file{1}.cpp".format(number % 20, number)
+
+    def content(self):
+        lines = list( self.random.choice(self.Headers) )
+        size = sum(len(line) + 1 for line in lines)
+        while size < self.file_size:
+            words = self.random.sample(self.Words, 3)
+            line = "    int {0} = {1}({2}) + {3};".format(words[0], words[1], words[2], self.random.randint(0, 1000))
+            lines.append(line)
+            size += len(line) + 1
+        return "\n".join(lines) + "\n"
+
+    def message(self, mark):
+        lines = ["Change number {0} to the benchmark repository".format(mark), "",
+                 "This describes the change in some more detail, as a commit message should."]
+        if mark % 10 == 0:
+            lines.append("BUG: {0}".format(100000 + mark))
+        if mark % 25 == 0:
+            lines.append("FIXED-IN: 5.{0}".format(mark % 100))
+        return "\n".join(lines) + "\n"
+
+    def write_commit(self, stream, ref, mark, parent, operations):
+        name, email = self.random.choice(self.Authors)
+        message = self.message(mark)
+        stream.write("commit {0}\nmark :{1}\n".format(ref, mark))
+        stream.write("author {0} <{1}> {2} +0000\n".format(name, email, 1500000000 + mark))
+        stream.write("committer {0} <{1}> {2} +0000\n".format(name, email, 1500000000 + mark))
+        stream.write("data {0}\n{1}\n".format(len(message), message))
+        if parent is not None:
+            stream.write("from :{0}\n".format(parent))
+        for operation in operations:
+            if operation[0] == "R":
+                stream.write("R {0} {1}\n".format(operation[1], operation[2]))
+            else:
+                content = self.content()
+                stream.write("M 644 inline {0}\ndata {1}\n{2}\n".format(operation[1], len(content), content))
+        stream.write("\n")
+
+    def rev_parse(self, ref):
+        command = ["git", "--git-dir", self.git_dir, "rev-parse", ref]
+        return subprocess.check_output(command).strip()
+
+@contextmanager
+def quiet():
+    "Discards what the hooks would tell the user while in the block"
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def replay_boundary(changes):
+    """Makes the repository appear as it was before the given changes were pushed
+
+    The old tips of the refs being changed are taken as all the repository knew of,
+    rather than the refs it has now, which would already include the commits pushed."""
+    known = set( old_sha1 for old_sha1, new_sha1, ref in changes if old_sha1 != hooklib.Repository.EmptyRef )
+    def tips_for(boundary, ref, old_sha1):
+        return set( sha1 for sha1 in known if sha1 != old_sha1 )
+    hooklib.BoundaryIndex.tips_for = tips_for
+
+def measure_change(git_dir, old_sha1, new_sha1, ref, smtp_port):
+    "Runs each stage of the hooks for the given change, returning the measurements"
+    stages = Stages()
+    started = time.time()
+
+    with stages.measure("repository"):
+        repository = hooklib.Repository( ref, old_sha1, new_sha1, "benchmark" )
+        commit_count = repository.commit_count
+
+    # The audits, made on batches of commits as they are streamed from git
+    auditor = hooklib.CommitAuditor( repository )
+    policy = hooklib.RepoPolicy.for_path( repository.management_directory, repository.path )
+    commits = repository.iter_commits()
+    while True:
+        with stages.measure("extract"):
+            batch = list( itertools.islice(commits, hooklib.CommitAuditor.BatchSize) )
+        if not batch:
+            break
+        for audit in Audits:
+            with stages.measure(audit):
+                getattr(auditor, audit)( batch )
+    with stages.measure("audit_hashes"):
+        auditor.audit_hashes( policy.global_blocked_list, policy.global_blocked_index )
+
+    # The notifications, as process_accepted_change() sends them
+    transport = hooklib.SmtpTransport( "127.0.0.1", smtp_port )
+    notifier = hooklib.CommitNotifier( transport )
+    cia = hooklib.CiaNotifier( repository, transport )
+    bugzilla = hooklib.BugzillaAggregator( transport )
+    checker = hooklib.CommitChecker()
+    handler = notifier.handler( repository )
+    while True:
+        with stages.measure("patches"):
+            change = next(handler, None)
+        if change is None:
+            break
+        commit, diff = change
+
+        with stages.measure("checker"):
+            checker.check_commit_problems( commit, diff )
+
+        with stages.measure("builder"):
+            builder = hooklib.MessageBuilder( repository, commit, checker )
+            builder.determine_keywords()
+            builder.subject
+            builder.body
+
+        with stages.measure("notify"):
+            cia.notify( builder )
+            notifier.notify_email( builder, "kde-commits@kde.org", diff )
+            bugzilla.add( builder )
+
+    with stages.measure("checker"):
+        checker.store_license_verdicts()
+
+    with stages.measure("notify"), quiet():
+        bugzilla.notify()
+        transport.close()
+
+    return {
+        "ref": ref, "old": old_sha1, "new": new_sha1, "commits": commit_count,
+        "audit_failed": auditor.audit_failed, "seconds": time.time() - started,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "git_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        "stages": stages.results,
+    }
+
+def report(result):
+    print "{0} {1}..{2}: {3} commits, audit {4}".format(result["ref"], result["old"][:12], result["new"][:12],
+        result["commits"], "failed" if result["audit_failed"] else "passed")
+    print "    {0:<26} {1:>7} {2:>10} {3:>14}".format("Stage", "Calls", "Seconds", "Peak RSS (MB)")
+    for name, entry in result["stages"].iteritems():
+        print "    {0:<26} {1:>7} {2:>10.3f} {3:>14.1f}".format(name, entry["calls"], entry["seconds"], entry["peak_rss_kb"] / 1024.0)
+    print "    {0:<26} {1:>7} {2:>10.3f} {3:>14.1f}".format("total", "", result["seconds"], result["peak_rss_kb"] / 1024.0)
+    print "    {0:<26} {1:>7} {2:>10} {3:>14.1f}".format("git (largest process)", "", "", result["git_peak_rss_kb"] / 1024.0)
+
+def run(git_dir, changes, arguments):
+    # Everything the hooks would normally find in their environment
+    git_dir = os.path.abspath(git_dir)
+    os.environ["GIT_DIR"] = git_dir
+    os.environ["REPO_MGMT"] = ManagementDirectory
+    os.chdir(git_dir)
+    hooklib.Repository.BaseDir = os.path.dirname(os.path.dirname(git_dir)) + "/"
+
+    # Verdicts start out unknown, unless a cache to reuse was given
+    cache_dir = arguments.cache or tempfile.mkdtemp(prefix="hook-benchmark-cache-")
+    hooklib.VerdictCache.BaseDir = cache_dir
+
+    smtp = SmtpSink()
+    smtp.start()
+    resolver = DnsStub()
+    resolver.start()
+    os.environ["HOOK_DNS_NAMESERVERS"] = "127.0.0.1:{0}".format(resolver.port)
+
+    # Audit failures are counted, not printed
+    logging.disable(logging.CRITICAL)
+
+    results = list()
+    try:
+        for old_sha1, new_sha1, ref in changes:
+            result = measure_change(git_dir, old_sha1, new_sha1, ref, smtp.port)
+            report(result)
+            results.append(result)
+    finally:
+        if not arguments.cache:
+            shutil.rmtree(cache_dir)
+
+    print "{0} messages sent".format(smtp.received)
+    if arguments.json:
+        with open(arguments.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the time and memory used by each stage of the hooks")
+    parser.add_argument("--cache", help="Directory of verdict caches to reuse, rather than starting without any")
+    parser.add_argument("--json", help="File to write the measurements to, for comparison between runs")
+    modes = parser.add_subparsers(dest="mode")
+
+    synthetic = modes.add_parser("synthetic", help="Push the history of a generated repository")
+    synthetic.add_argument("--commits", type=int, default=1000, help="Number of commits pushed")
+    synthetic.add_argument("--files", type=int, default=5, help="Number of files touched by each commit")
+    synthetic.add_argument("--file-size", type=int, default=2000, help="Size of each file written, in bytes")
+    synthetic.add_argument("--refs", type=int, default=10, help="Number of refs already in the repository")
+    synthetic.add_argument("--renames", type=float, default=0.1, help="Fraction of the files touched which are renamed")
+    synthetic.add_argument("--keep", help="Directory to generate the repository in and keep it, rather than a temporary one")
+
+    replay = modes.add_parser("replay", help="Replay recorded changes against an existing repository")
+    replay.add_argument("git_dir", help="The (bare) repository to replay the changes against")
+    replay.add_argument("changes", help="File listing the changes, as given to pre-receive on stdin")
+
+    arguments = parser.parse_args()
+    if arguments.mode == "synthetic":
+        directory = arguments.keep or tempfile.mkdtemp(prefix="hook-benchmark-")
+        try:
+            generator = SyntheticRepository(directory, arguments.commits, arguments.files, arguments.file_size,
+                                            arguments.refs, arguments.renames)
+            started = time.time()
+            changes = generator.generate()
+            print "Generated {0} in {1:.1f}s".format(generator.git_dir, time.time() - started)
+            run(generator.git_dir, changes, arguments)
+        finally:
+            if not arguments.keep:
+                shutil.rmtree(directory)
+    else:
+        with open(arguments.changes) as listing:
+            changes = [tuple(line.split()) for line in listing if line.strip()]
+        replay_boundary(changes)
+        run(arguments.git_dir, changes, arguments)
+
+if __name__ == "__main__":
+    main()
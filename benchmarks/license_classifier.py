@@ -0,0 +1,215 @@
+#!/usr/bin/python
+# Compares the labels produced by LicenseClassifier against the original license checks, and times both
+# Files carrying a SPDX tag are classified from it and can't be compared, so they are only counted
+# Usage: license_classifier.py <directory containing source files>...
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hooks"))
+from hooklib import LicenseClassifier
+
+SourceFiles = re.compile(r"\.(cpp|cc|cxx|C|c\+\+|c|l|y||h|H|hh|hxx|hpp|h\+\+|qml)$")
+
+def legacy_classify(text):
+    "The license checks as CommitChecker performed them before LicenseClassifier was introduced"
+    problemfile = False
+    gl = qte = license = wrong = ""
+    text = re.sub("^\#", "", text)
+    text = re.sub("\t\n\r", "   ", text)
+    text = re.sub("[^ A-Za-z.@0-9]", "", text)
+    text = re.sub("\s+", " ", text)
+
+    if re.search("version 2(?:\.0)? .{0,40}as published by the Free Software Foundation", text):
+        gl = " (v2)"
+
+    if re.search("version 2(?:\.0)? of the License", text):
+        gl = " (v2)"
+
+    if re.search("version 3(?:\.0)? .{0,40}as published by the Free Software Foundation", text):
+        gl = " (v3)"
+
+    if re.search("either version 2(?: of the License)? or at your option any later version", text):
+        gl = " (v2+)"
+
+    if re.search("version 2(?: of the License)? or at your option version 3", text):
+        gl = " (v2/3)"
+
+    if re.search("version 2(?: of the License)? or at your option version 3 or at the discretion of KDE e.V.{10,60}any later version", text):
+        gl = " (v2/3+eV)"
+
+    if re.search("either version 3(?: of the License)? or at your option any later version", text):
+        gl = " (v3+)"
+
+    if re.search("version 2\.1 as published by the Free Software Foundation", text):
+        gl = " (v2.1)"
+
+    if re.search("2\.1 available at: http:\/\/www.fsf.org\/copyleft\/lesser.html", text):
+        gl = " (v2.1)"
+
+    if re.search("either version 2\.1 of the License or at your option any later version", text):
+        gl = " (v2.1+)"
+
+    if re.search("([Pp]ermission is given|[pP]ermission is also granted|[pP]ermission) to link (the code of )?this program with (any edition of )?(Qt|the Qt library)", text):
+        qte = " (+Qt exception)"
+
+    # Check for an old FSF address
+    # MIT licenses will trigger the check too, as "675 Mass Ave" is MIT's address
+    if re.search("(?:675 Mass Ave|59 Temple Place|Suite 330|51 Franklin Steet|02139|02111-1307)", text, re.IGNORECASE):
+        # "51 Franklin Street, Fifth Floor, Boston, MA 02110-1301" is the right FSF address
+        wrong = " (wrong address)"
+        problemfile = True
+
+    # traditional license header LGPL or GPL
+    if re.search("under (the (terms|conditions) of )?the GNU (Library|Lesser) General Public License", text):
+        license = "LGPL" + gl + wrong + " " + license
+
+    if re.search("under (the (terms|conditions) of )?the (Library|Lesser) GNU General Public License", text):
+        license = "LGPL" + gl + wrong + " " + license
+
+    if re.search("under (the (terms|conditions) of )?the (GNU )?LGPL", text):
+        license = "LGPL" + gl + wrong + " " + license
+
+    if re.search("[Tt]he LGPL as published by the Free Software Foundation", text):
+        license = "LGPL" + gl + wrong + " " + license
+
+    if re.search("LGPL with the following explicit clarification", text):
+        license = "LGPL" + gl + wrong + " " + license
+
+    if re.search("under (the terms of )?(version 2 of )?the GNU (General Public License|GENERAL PUBLIC LICENSE)", text):
+        license = "GPL" + gl + qte + wrong + " " + license
+
+    # SPDX based LGPL or GPL
+    # TODO first version for SPDX based license hooks: this only detects simple statements, shall be extended for full SPDX expressions
+    if re.search("SPDX-License-Identifier: LGPL-2.0-only", text):
+        license = "LGPL(v2.0) " + wrong + " " + license
+    if re.search("SPDX-License-Identifier: LGPL-2.0-or-later", text):
+        license = "LGPL(v2.0+) " + wrong + " " + license
+    if re.search("SPDX-License-Identifier: LGPL-2.1-only", text):
+        license = "LGPL(v2.1) " + wrong + " " + license
+    if re.search("SPDX-License-Identifier: LGPL-2.1-or-later", text):
+        license = "LGPL(v2.1+) " + wrong + " " + license
+    if re.search("SPDX-License-Identifier: LGPL-3.0-only", text):
+        license = "LGPL(v3.0) " + wrong + " " + license
+    if re.search("SPDX-License-Identifier: LGPL-3.0-or-later", text):
+        license = "LGPL(v3.0+) " + wrong + " " + license
+    if re.search("SPDX-License-Identifier: LGPL-2.0-only OR LGPL-3.0-only OR LicenseRef-KDE-Accepted-LGPL", text):
+        license = "LGPL(v2.0/3+eV) " + wrong + " " + license
+    if re.search("SPDX-License-Identifier: LGPL-2.1-only OR LGPL-3.0-only OR LicenseRef-KDE-Accepted-LGPL", text):
+        license = "LGPL(v2.1/3+eV) " + wrong + " " + license
+    if re.search("SPDX-License-Identifier: GPL-2.0-only", text):
+        license = "GPL(v2.0) " + wrong + " " + license
+    if re.search("SPDX-License-Identifier: GPL-2.0-or-later", text):
+        license = "GPL(v2.0+) " + wrong + " " + license
+    if re.search("SPDX-License-Identifier: GPL-3.0-only", text):
+        license = "GPL(v3.0) " + wrong + " " + license
+    if re.search("SPDX-License-Identifier: GPL-2.0-only OR GPL-3.0-only", text):
+        license = "GPL(v2/3) " + wrong + " " + license
+    if re.search("SPDX-License-Identifier: GPL-2.0-only OR GPL-3.0-only OR LicenseRef-KDE-Accepted-GPL", text):
+        license = "GPL(v2/3+eV) " + wrong + " " + license
+
+    # QPL
+    if re.search("may be distributed under the terms of the Q Public License as defined by Trolltech AS", text):
+        license = "QPL " + license
+
+    # X11, BSD-like
+    if re.search("Permission is hereby granted free of charge to any person obtaining a copy of this software and associated documentation files", text):
+        license = "X11 (BSD like) " + license
+
+    # MIT license
+    if re.search("Permission to use copy modify (and )?distribute(and sell)? this software and its documentation for any purpose", text):
+        license = "MIT " + license
+    if re.search("SPDX-License-Identifier: MIT", text):
+        license = "MIT " + wrong + " " + license
+
+    # BSD
+    if re.search("MERCHANTABILITY( AND|| or) FITNESS FOR A PARTICULAR PURPOSE", text) and not re.search("GPL", license):
+        license = "BSD " + license
+    if re.search("SPDX-License-Identifier: BSD-2-Clause", text) or re.search("SPDX-License-Identifier: BSD-3-Clause", text):
+        license = "BSD " + wrong + " " + license
+
+    # MPL
+    if re.search("subject to the Mozilla Public License Version 1.1", text):
+        license = "MPL 1.1 " + license
+
+    if re.search("Mozilla Public License Version 1\.0/", text):
+        license = "MPL 1.0 " + license
+
+    # Artistic license
+    if re.search("under the Artistic License", text):
+        license = "Artistic " + license
+
+    # Public domain
+    if re.search("Public Domain", text, re.IGNORECASE) or re.search(" disclaims [Cc]opyright", text):
+        license = "Public Domain " + license
+
+    # Auto-generated
+    if re.search("(All changes made in this file will be lost|This file is automatically generated|DO NOT EDIT|DO NOT delete this file|[Gg]enerated by|uicgenerated|produced by gperf)", text):
+        license = "GENERATED FILE"
+        problemfile = True
+
+    # Don't bother with trivial files.
+    if not license and len(text) < 128:
+        license = "Trivial file"
+
+    # About every license has this clause; but we've failed to detect which type it is.
+    if not license and re.search("This (software|package)( is free software and)? is provided ",
+                                 text, re.IGNORECASE):
+        license = "Unknown license"
+        problemfile = True
+
+    # Either a missing or an unsupported license
+    if not license:
+        license = "UNKNOWN"
+        problemfile = True
+
+    license = license.strip()
+    return license, problemfile
+
+def added_lines(path):
+    "Returns the lines of diff adding the given file, as the hooks see them"
+    with open(path, "rb") as sourcefile:
+        content = unicode(sourcefile.read(), "utf-8", "replace")
+
+    lines = ["+" + line for line in content.splitlines(True)]
+    if lines and not lines[-1].endswith("\n"):
+        lines.append("\\ No newline at end of file\n")
+    return lines
+
+def corpus(directories):
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            for name in sorted(files):
+                if SourceFiles.search(name):
+                    yield os.path.join(root, name)
+
+if len(sys.argv) < 2:
+    print "Usage: {0} <directory>...".format(sys.argv[0])
+    sys.exit(2)
+
+files = [(path, added_lines(path)) for path in corpus(sys.argv[1:])]
+classifier = LicenseClassifier.compiled()
+
+legacy_time = classifier_time = 0.0
+differences = tagged = 0
+for path, lines in files:
+    start = time.time()
+    expected = legacy_classify(''.join(lines))
+    legacy_time += time.time() - start
+
+    start = time.time()
+    result = classifier.classify(lines)
+    classifier_time += time.time() - start
+
+    if classifier.spdx(lines) is not None:
+        tagged += 1
+    elif result != expected:
+        differences += 1
+        print "{0}: expected {1!r}, got {2!r}".format(path, expected, result)
+
+print "{0} files, {1} classified by SPDX tag, {2} differences".format(len(files), tagged, differences)
+print "Original checks: {0:.3f}s, LicenseClassifier: {1:.3f}s".format(legacy_time, classifier_time)
+if differences:
+    sys.exit(1)
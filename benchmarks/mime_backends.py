@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# Compares the mime types the glob lookups of mime.cache and of the text globs2 file (used when the cache is out of date) give
+# A file name is made up for every glob of the database, in its own case and upper cased, plus any names given
+# Usage: mime_backends.py [--mime-directory DIRECTORY] [name]...
+
+import argparse
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hooks"))
+from mime.xdg.mime import MimeCache, GlobsFile
+
+def names_for(glob):
+    "Returns file names the given glob matches, in its own case and upper cased"
+    name = re.sub(r"\[(.)[^\]]*\]", r"\1", glob).replace("*", "file").replace("?", "x")
+    return [name, name.upper()]
+
+parser = argparse.ArgumentParser(description="Compare the glob lookups of mime.cache and globs2")
+parser.add_argument("--mime-directory", default="/usr/share/mime")
+parser.add_argument("names", nargs="*")
+arguments = parser.parse_args()
+
+cache = MimeCache( os.path.join(arguments.mime_directory, "mime.cache") )
+globs = GlobsFile()
+globs.parse( os.path.join(arguments.mime_directory, "globs2") )
+
+names = list(arguments.names)
+with open( os.path.join(arguments.mime_directory, "globs2") ) as globsfile:
+    for line in globsfile:
+        if not line.startswith("#"):
+            names.extend( names_for(line.rstrip("\n").split(":")[2]) )
+
+differences = 0
+for name in sorted(set(names)):
+    expected = cache.matchGlob(name) or ""
+    result = globs.lookup(name)
+    if result != expected:
+        differences += 1
+        print "{0}: mime.cache gives {1!r}, globs2 gives {2!r}".format(name, expected, result)
+
+print "{0} names, {1} differences".format(len(set(names)), differences)
+if differences:
+    sys.exit(1)
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# Checks the start up cost of the update hook on the paths which never send notifications
+# Each path runs in a fresh interpreter, as the hook does for every ref of every push, against a generated repository
+# The commits pushed aren't referenced by any ref yet, so they are audited as they would be on the server
+# Fails if importing hooklib takes longer than the budget, if any of the packages only needed to notify get loaded,
+# or if the packages needed to audit get loaded when nothing is audited (or aren't when something is)
+# Usage: startup.py [--runs N] [--budget MILLISECONDS]
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HooksDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hooks")
+ManagementDirectory = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Packages which are only needed to audit the commits being pushed (checking author domains and file types)
+Auditing = ["dns", "mime"]
+
+# Packages which are only needed once notifications are sent
+Notifying = ["yaml", "smtplib", "scandir", "lxml", "email"]
+
+Deferred = Auditing + Notifying
+
+# Each path is the repository pushed to, the ref changed, and whether the commits pushed get audited
+Paths = [
+    ("reject", "kde/bench", "refs/backups/branch-master-1", False),
+    ("work-branch", "kde/bench", "refs/heads/work/feature", True),
+    ("scratch", "someone/bench", "refs/heads/feature", True),
+]
+
+EmptyRef = "0000000000000000000000000000000000000000"
+
+def create_repository(base_dir, path):
+    """Creates a bare repository holding a single commit on master, along with a commit on top of it
+    which no ref points at, returning the sha1 of the latter for it to be pushed"""
+    git_dir = os.path.join(base_dir, path + ".git")
+    subprocess.check_call(["git", "init", "--quiet", "--bare", git_dir])
+    binary = "\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR"
+    stream = "\n".join([
+        "commit refs/heads/master",
+        "author Alice Developer <alice@example.org> 1500000000 +0000",
+        "committer Alice Developer <alice@example.org> 1500000000 +0000",
+        "data 15", "Initial import", "M 644 inline README", "data 6", "Hello", "",
+        "commit refs/heads/pushed",
+        "author Alice Developer <alice@example.org> 1500000100 +0000",
+        "committer Alice Developer <alice@example.org> 1500000100 +0000",
+        "data 14", "Add some files", "from refs/heads/master",
+        "M 644 inline main.cpp", "data 14", "int main() {}", "",
+        "M 644 inline icon.png", "data {0}".format(len(binary)), binary, "", ""])
+    process = subprocess.Popen(["git", "fast-import", "--quiet"], stdin=subprocess.PIPE, env=dict(os.environ, GIT_DIR=git_dir))
+    process.communicate(stream)
+    pushed = subprocess.check_output(["git", "--git-dir", git_dir, "rev-parse", "refs/heads/pushed"]).strip()
+    subprocess.check_call(["git", "--git-dir", git_dir, "update-ref", "-d", "refs/heads/pushed"])
+    return pushed
+
+def run_path(base_dir, ref, new_sha1):
+    "Runs the steps of invent.update in this interpreter, printing what it cost as the last line of output"
+    started = time.time()
+    sys.path.insert(0, HooksDirectory)
+    from hooklib import Repository, determine_gitlab_repo_type, check_ref_change, audit_pushed_commits, process_accepted_change
+    imported = time.time()
+
+    Repository.BaseDir = base_dir + "/"
+    repository = Repository( ref, EmptyRef, new_sha1, "benchmark" )
+    determine_gitlab_repo_type( repository )
+    rejection = check_ref_change( repository )
+    audited = 0
+    if not rejection:
+        audit_pushed_commits( repository )
+        audited = repository.commit_count
+        process_accepted_change( repository )
+    finished = time.time()
+
+    loaded = sorted( set( name.split('.')[0] for name in sys.modules if sys.modules[name] is not None ).intersection(Deferred) )
+    print json.dumps({"import_ms": (imported - started) * 1000, "path_ms": (finished - imported) * 1000,
+                      "rejected": bool(rejection), "audited": audited, "deferred": loaded})
+
+def measure(base_dir, path, ref, new_sha1, runs, nameservers):
+    "Runs the given path in fresh interpreters, returning the median of each measurement"
+    git_dir = os.path.join(base_dir, path + ".git")
+    results = list()
+    for run in xrange(runs):
+        # Each run starts with nothing cached, as verdicts would otherwise spare later runs the lookups
+        environment = dict(os.environ, GIT_DIR=git_dir, REPO_MGMT=ManagementDirectory, GL_USERNAME="benchmark",
+                           HOOK_CACHE_DIR=os.path.join(base_dir, "cache-{0}-{1}".format(path.replace("/", "-"), run)),
+                           HOOK_DNS_NAMESERVERS=nameservers)
+        started = time.time()
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--run", base_dir, ref, new_sha1],
+                                         cwd=git_dir, env=environment)
+        result = json.loads( output.splitlines()[-1] )
+        result["total_ms"] = (time.time() - started) * 1000
+        results.append(result)
+
+    def median(key):
+        values = sorted( result[key] for result in results )
+        return values[len(values) // 2]
+
+    return {"import_ms": median("import_ms"), "path_ms": median("path_ms"), "total_ms": median("total_ms"),
+            "rejected": results[-1]["rejected"], "audited": min( result["audited"] for result in results ),
+            "deferred": sorted(set( name for result in results for name in result["deferred"] ))}
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--run":
+        run_path(*sys.argv[2:])
+        return
+
+    # Not needed by the runs themselves, which must start with nothing but the hook loaded
+    from hooks import DnsStub
+
+    parser = argparse.ArgumentParser(description="Checks the start up cost of the update hook on paths which don't notify")
+    parser.add_argument("--runs", type=int, default=10, help="Number of times each path is run, the median being reported")
+    parser.add_argument("--budget", type=float, default=80.0, help="Milliseconds importing hooklib may take")
+    arguments = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp(prefix="hook-startup-")
+    failed = False
+    try:
+        # Author domains are looked up (and found valid) without leaving the machine
+        resolver = DnsStub()
+        resolver.start()
+        nameservers = "127.0.0.1:{0}".format(resolver.port)
+
+        commits = dict( (path, create_repository(base_dir, path)) for _, path, _, _ in Paths )
+
+        # Interpreter start up itself, which every path pays for as well
+        started = time.time()
+        for _ in xrange(arguments.runs):
+            subprocess.check_call([sys.executable, "-c", "pass"])
+        print "Interpreter start up: {0:.1f} ms".format( (time.time() - started) * 1000 / arguments.runs )
+
+        print "{0:<12} {1:>10} {2:>10} {3:>10}  {4}".format("Path", "Import", "Hook", "Total", "Deferred packages loaded")
+        for name, path, ref, audits in Paths:
+            result = measure(base_dir, path, ref, commits[path], arguments.runs, nameservers)
+            print "{0:<12} {1:>8.1f}ms {2:>8.1f}ms {3:>8.1f}ms  {4}".format(name, result["import_ms"], result["path_ms"],
+                result["total_ms"], ', '.join(result["deferred"]) or "none")
+
+            if result["import_ms"] > arguments.budget:
+                print "    Importing hooklib exceeded the budget of {0:.0f} ms".format(arguments.budget)
+                failed = True
+            if set(result["deferred"]).intersection(Notifying):
+                print "    Packages only needed to notify were loaded"
+                failed = True
+            if audits and not result["audited"]:
+                print "    No commits were audited"
+                failed = True
+            if set(result["deferred"]).intersection(Auditing) != (set(Auditing) if audits else set()):
+                print "    Packages needed to audit were {0}loaded".format("not " if audits else "")
+                failed = True
+            if result["rejected"] != (name == "reject"):
+                print "    The push was {0}expectedly declined".format("un" if result["rejected"] else "not ")
+                failed = True
+    finally:
+        shutil.rmtree(base_dir)
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
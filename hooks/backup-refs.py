@@ -0,0 +1,32 @@
+#!/usr/bin/python
+# Backs up the refs which an accepted push force updated or deleted
+# Reads the "<old-sha1> <new-sha1> <ref>" lines given to post-receive on stdin
+# Git forbids ref updates inside the quarantine environment pre-receive runs in, so this has to happen here
+# Backups are made here whether invent.update or invent.pre-receive audits the push, so they are made in a single place
+
+import os
+import sys
+from hooklib import Repository, GitSession, ChangeType
+
+# With Gitaly GIT_DIR isn't always set
+if 'GIT_DIR' not in os.environ:
+    os.environ['GIT_DIR'] = os.getcwd()
+
+Repository.BaseDir = "/srv/git/repositories/"
+push_user = os.getenv('GL_USERNAME')
+
+session = GitSession()
+failed = False
+for line in sys.stdin:
+    fields = line.split()
+    if len(fields) != 3:
+        continue
+
+    old_sha1, new_sha1, ref = fields
+    repository = Repository( ref, old_sha1, new_sha1, push_user, session )
+    if repository.change_type == ChangeType.Forced or repository.change_type == ChangeType.Delete:
+        if not repository.backup_ref():
+            failed = True
+
+if failed:
+    exit(1)
@@ -0,0 +1,32 @@
+#!/usr/bin/python
+# Compiles the repo-configs tree into the index used by the hooks
+# Run this whenever repo-management is updated - hooks will otherwise recompile it themselves on first use
+
+import os
+import sys
+from hooklib import Repository, RepoPolicy, BlockedCommits
+
+# Find our configuration directory....
+if len(sys.argv) > 1:
+    management_directory = sys.argv[1]
+elif os.getenv('REPO_MGMT'):
+    management_directory = os.getenv('REPO_MGMT')
+else:
+    management_directory = os.getenv('HOME') + "/" + Repository.RepoManagementName
+
+index = RepoPolicy.compile( management_directory )
+RepoPolicy.store( management_directory, index )
+print "Compiled policies for {0} repositories".format( len(index) )
+
+# Compile the lists of blocked commits as well
+compiled = 0
+for path, flags in index.items():
+    if "blocked" in flags:
+        policy = RepoPolicy( management_directory, path, flags )
+        BlockedCommits.compile( policy.blocked_list, policy.blocked_index )
+        compiled += 1
+
+policy = RepoPolicy( management_directory, "", [] )
+if os.path.exists( policy.global_blocked_list ):
+    BlockedCommits.compile( policy.global_blocked_list, policy.global_blocked_index )
+print "Compiled {0} lists of blocked commits".format( compiled )
@@ -0,0 +1,31 @@
+#!/usr/bin/python
+# Delivers the notifications queued by the hooks when HOOK_MAIL_SPOOL is set
+# Run this as a service alongside the hooks, or with --once from cron
+
+import os
+import sys
+import argparse
+from hooklib import NotificationSpool
+
+parser = argparse.ArgumentParser(description='Deliver the notifications spooled by the hooks.')
+parser.add_argument('--spool', default=os.getenv('HOOK_MAIL_SPOOL'), help='Spool directory to deliver from (defaults to $HOOK_MAIL_SPOOL)')
+parser.add_argument('--host', default='localhost', help='SMTP server to deliver to')
+parser.add_argument('--port', type=int, default=25, help='Port of the SMTP server')
+parser.add_argument('--workers', type=int, default=4, help='Number of SMTP connections to deliver over')
+parser.add_argument('--retries', type=int, default=5, help='Attempts to make before a message is moved to failed/')
+parser.add_argument('--once', action='store_true', help='Exit once the spool is empty, rather than waiting for more')
+parser.add_argument('--poll-interval', type=float, default=5, help='Seconds to wait between checks of an empty spool')
+args = parser.parse_args()
+
+if not args.spool:
+    parser.error("no spool directory given, and HOOK_MAIL_SPOOL is not set")
+
+spool = NotificationSpool( args.spool, args.host, args.port, args.workers, args.retries )
+try:
+    spool.run( args.once, args.poll_interval )
+except KeyboardInterrupt:
+    pass
+
+print "Delivered {0} messages, {1} failed".format( spool.delivered, spool.failed )
+if spool.failed:
+    sys.exit(1)
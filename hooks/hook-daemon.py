@@ -0,0 +1,26 @@
+#!/usr/bin/python
+# Serves requests to run the update hook, made by hookclient when HOOK_DAEMON_SOCKET is set
+# Run this as a service, as the user the hooks run as, with the same HOOK_DAEMON_SOCKET
+# Changes to the hooks (or hooklib) are picked up by the daemon starting itself over, so it needn't be restarted after updating them
+
+import os
+import argparse
+from hooklib import HookDaemon, Repository
+
+default_management = os.getenv('REPO_MGMT') or os.path.join(os.getenv('HOME', ''), Repository.RepoManagementName)
+
+parser = argparse.ArgumentParser(description='Run the update hook on behalf of hookclient, with everything it needs already loaded.')
+parser.add_argument('--socket', default=os.getenv('HOOK_DAEMON_SOCKET'), help='Unix socket to listen on (defaults to $HOOK_DAEMON_SOCKET)')
+parser.add_argument('--management', default=default_management, help='The repo-management checkout whose policies the hooks use')
+parser.add_argument('--workers', type=int, default=32, help='Number of requests which may be handled at once')
+args = parser.parse_args()
+
+if not args.socket:
+    parser.error("no socket given, and HOOK_DAEMON_SOCKET is not set")
+
+daemon = HookDaemon( args.socket, args.management, args.workers )
+daemon.warm()
+try:
+    daemon.serve()
+except KeyboardInterrupt:
+    pass
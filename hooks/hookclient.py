@@ -0,0 +1,62 @@
+# Hands a hook run to the hook daemon (see hook-daemon.py), relaying its output and exit status
+# This is loaded before anything else by the hooks, so it must stay small: it doesn't use hooklib
+
+import os
+import sys
+import json
+import socket
+
+# Seconds allowed for the daemon to accept the request
+ConnectTimeout = 2
+
+def run(hook, arguments):
+    """Ask the hook daemon to run the given hook, relaying its output
+
+    Returns the exit status of the hook, or None if it should be run in-process instead:
+    either no daemon is configured (through HOOK_DAEMON_SOCKET), it isn't running, it is
+    restarting to pick up changes to the hooks, or we are the daemon running the hook already."""
+    socket_path = os.getenv('HOOK_DAEMON_SOCKET')
+    if not socket_path or os.getenv('HOOK_DAEMON_CHILD'):
+        return None
+
+    try:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(ConnectTimeout)
+        connection.connect(socket_path)
+        request = {"hook": hook, "arguments": arguments, "cwd": os.getcwd(), "environment": dict(os.environ)}
+        connection.sendall( json.dumps(request) + "\n" )
+    except socket.error:
+        return None
+
+    # The hook may take as long as it needs from here on
+    connection.settimeout(None)
+    trailer = None
+    try:
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            if trailer is not None:
+                trailer += data
+                continue
+
+            output, separator, rest = data.partition("\0")
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            if separator:
+                trailer = rest
+    except socket.error:
+        pass
+    finally:
+        connection.close()
+
+    # Once the request has been made the hook may have done anything, so it can't simply be run again
+    # Unless the daemon declined it, which it does without running the hook when it is restarting
+    try:
+        reply = json.loads(trailer)
+        if reply.get("declined"):
+            return None
+        return int( reply["status"] )
+    except (TypeError, ValueError, KeyError, AttributeError):
+        print "The hook daemon failed while handling this push, please try again"
+        return 1
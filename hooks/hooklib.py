@@ -1,28 +1,39 @@
 #!/usr/bin/python
 
-import itertools
 import logging
 import os
+import sys
 import re
 import io
 import time
-import yaml
+import fcntl
+import json
+import mmap
+import hashlib
+import binascii
+import sqlite3
+import tempfile
 import subprocess
-import dns.resolver
-import smtplib
-import scandir
+import socket
+import threading
+import Queue
 import operator
+import itertools
+import atexit
+import runpy
+import signal
+import traceback
+import resource
+import importlib
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, Counter
+from contextlib import contextmanager
 from itertools import takewhile
-from email.mime.text import MIMEText
-from email.header import Header
-from email import Charset
 
-import mimetypes
 from ordereddict import OrderedDict
-import lxml.etree as etree
-from lxml.builder import E
+
+# Packages which take a while to load (yaml, dns, smtplib, scandir, lxml, mime and email) are
+# only imported by the code needing them, so pushes which are declined or not notified don't pay for them
 
 class RepoType(object):
     "Enum type - Indicates the type of repository"
@@ -60,7 +71,7 @@ class Repository(object):
     PullBaseUrlGit = "git://anongit.kde.org/"
     PushBaseUrl = "git@git.kde.org:"
 
-    def __init__(self, ref, old_sha1, new_sha1, push_user):
+    def __init__(self, ref, old_sha1, new_sha1, push_user, session = None, pushed_tips = None):
         "Create a Repository object"
 
         # Save configuration
@@ -68,7 +79,21 @@ class Repository(object):
         self.old_sha1 = old_sha1
         self.new_sha1 = new_sha1
         self.push_user = push_user
-        self.commits = OrderedDict()
+
+        # Tips of refs already changed earlier in the same push, whose commits we have seen
+        # Only pre-receive knows these: the update hook runs as each ref is updated, so there they are found in the refs themselves
+        self.pushed_tips = pushed_tips
+
+        # Queries to git are shared across the hook run where possible
+        if session is None:
+            session = GitSession()
+        self.session = session
+        self.__patches = None
+        self.__revisions = None
+        self.__commits = None
+
+        # Whether the commits streamed to the audit are kept, for the notifications to use instead of extracting them again
+        self.keep_commits = False
 
         # Find our configuration directory....
         if os.getenv('REPO_MGMT'):
@@ -76,6 +101,9 @@ class Repository(object):
         else:
             self.management_directory = os.getenv('HOME') + "/" + Repository.RepoManagementName
 
+        # Locate the repository itself
+        self.git_dir = os.path.abspath( os.getenv('GIT_DIR', os.getcwd()) )
+
         # Set the repository path...
         path_match = re.match("^"+Repository.BaseDir+"(.+).git$", os.getcwd())
         self.path = self.virtual_path = path_match.group(1)
@@ -84,9 +112,7 @@ class Repository(object):
         # If it is, then some adjustment to the above is required
         if '@hashed/' in self.path:
             # Retrieve the human usable path from Gitlab
-            command = ["git", "config", "--local", '--get', 'gitlab.fullpath']
-            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-            self.path = self.virtual_path = process.stdout.readline().strip()
+            self.path = self.virtual_path = self.session.config('gitlab.fullpath')
 
         # Determine types....
         self.repo_type = self.__get_repo_type()
@@ -99,126 +125,143 @@ class Repository(object):
         if self.change_type == ChangeType.Delete:
             self.commit_type = "commit"
         else:
-            command = ["git", "cat-file", "-t", self.new_sha1]
-            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-            self.commit_type = process.stdout.readline().strip()
+            self.commit_type = self.session.object_type(self.new_sha1)
+
+    @property
+    def patches(self):
+        "The patches of the commits being pushed, generated on first use"
+        if self.__patches is None:
+            self.__patches = PatchSpool(self)
+        return self.__patches
+
+    @property
+    def commits(self):
+        """The commits being pushed, by sha1, extracted on first use
 
-        # Final initialisation
-        self.__build_commits()
+        This holds every commit in memory at once, so consumers which only need to
+        look at each commit in turn should use iter_commits() instead."""
+        if self.__commits is None:
+            self.__commits = OrderedDict( (commit.sha1, commit) for commit in self.iter_commits() )
+        return self.__commits
 
-        # Ensure emails get done using the charset encoding method we want, not what Python thinks is best....
-        Charset.add_charset("utf-8", Charset.QP, Charset.QP)
+    @property
+    def commit_count(self):
+        "The number of commits being pushed"
+        return len( self.__list_revisions() ) // BlockedCommits.RecordSize
+
+    @property
+    def tip_introduced(self):
+        "Whether the commit the ref now points at is one of the commits being pushed"
+        revisions = self.__list_revisions()
+        return bool(revisions) and binascii.hexlify( revisions[-BlockedCommits.RecordSize:] ) == self.new_sha1
+
+    def revisions(self):
+        "Yields the sha1 of each commit being pushed, oldest first"
+        revisions = self.__list_revisions()
+        for start in xrange(0, len(revisions), BlockedCommits.RecordSize):
+            yield binascii.hexlify( revisions[start:start + BlockedCommits.RecordSize] )
+
+    def iter_commits(self):
+        """Yields each commit being pushed, oldest first
+
+        Commits are extracted as they are read from git, so only one of them needs to
+        be held in memory at a time, however large the push is. Unless keep_commits
+        is set, when they are all kept once read, so later passes don't run git again."""
+        if self.__commits is not None:
+            for commit in self.__commits.itervalues():
+                yield commit
+            return
+
+        # If we have no revisions... don't continue
+        if not self.commit_count:
+            return
+
+        # Extract information about commits, along with the files they changed, in a single pass
+        kept = OrderedDict() if self.keep_commits else None
+        for commit_data in CommitExtractor( self.revisions() ):
+            commit = Commit(self, commit_data)
+            if kept is not None:
+                kept[commit.sha1] = commit
+            yield commit
+
+        if kept is not None:
+            self.__commits = kept
 
     def backup_ref(self):
 
-        """Backup the git refs."""
+        """Backup the git refs, returning whether git made the backup.
+
+        Git refuses ref updates inside the quarantine environment pre-receive runs in,
+        so this is called once the push has been accepted, from post-receive."""
 
         # Back ourselves up!
         backup_ref="refs/backups/{0}-{1}-{2}".format(self.ref_type, self.ref_name, int( time.time() ))
         command = ("git", "update-ref", backup_ref, self.old_sha1)
         process = subprocess.Popen(command, shell=False, stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        if process.returncode != 0:
+            print "Backing up {0} to {1} failed: {2}".format(self.ref, backup_ref, errors.strip())
+            return False
+        return True
+
+    def __list_revisions(self):
+        # The revisions are listed once, and kept packed (20 bytes each) to keep even huge pushes small
+        if self.__revisions is not None:
+            return self.__revisions
+        self.__revisions = ""
 
-    def __build_commits(self):
         # Build the revision span git will use to help build the revision list...
         if self.change_type == ChangeType.Delete:
-            return
+            return self.__revisions
         elif self.change_type == ChangeType.Create:
             revision_span = self.new_sha1
         else:
-            merge_base = read_command(('git', 'merge-base', self.new_sha1, self.old_sha1))
+            merge_base = self.session.merge_base(self.new_sha1, self.old_sha1)
             revision_span = "{0}..{1}".format(merge_base, self.new_sha1)
 
-        # Determine what command we need to use to fetch the list of revisions
-        #
-        # To start, the merge request refs, along with the keep-around refs used by Gitlab for it's operations are both ignored and not considered to be already in the repository
-        # We also ignore work branches, as these are subject to force pushes and are considered to be a work in progress and not yet part of a release
-        #
-        # This is necessary to ensure hooks fire when these changes are merged into the repository and become part of a release branch
-        revisionsCommand = "git for-each-ref --format='%(refname) ^%(objectname)' | grep -v -E '^refs/(merge-requests|keep-around)/' | grep -v '^refs/heads/work/' | cut -d ' ' -f 2 | sort -u | grep -v {0} | git rev-list --reverse --stdin {1}"
-
-        # Now we have the command, actually get the list of revisions we are to be working on!
-        command = revisionsCommand.format(self.old_sha1, revision_span)
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-        revisions = process.stdout.readlines()
-
-        # If we have no revisions... don't continue
-        if not revisions:
-            return
-
-        # Build the git pretty format + regex.
-        l = (
-             ('CH' , ('%H%n',  '(?P<sha1>.+)\n')),
-             ('CP' , ('%P%n',  '(?P<parents>.*)\n')),
-             ('AN' , ('%an%n', '(?P<author_name>.*)\n')),
-             ('AE' , ('%ae%n', '(?P<author_email>.*)\n')),
-             ('D'  , ('%ct%n', '(?P<date>.+)\n')),
-             ('CN' , ('%cn%n', '(?P<committer_name>.*)\n')),
-             ('CE' , ('%ce%n', '(?P<committer_email>.*)\n')),
-             ('MSG', ('%B%xff','(?P<message>(.|\n)*)\xff(\n*)(\x00*)(?P<files_changed>(.|\n)*)'))
-            )
-
-        pretty_format_data = (': '.join((outer, inner[0])) for outer, inner in l)
-        pretty_format = '%xfe%xfa%xfc' + ''.join(pretty_format_data)
-
-        re_format_data = (': '.join((outer, inner[1])) for outer, inner in l)
-        re_format = '^' + ''.join(re_format_data) + '$'
-
-        # Extract information about commits....
-        command = "git show --stdin --name-status -z -C --pretty=format:'{0}'".format(pretty_format)
-        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
-                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        # Pass on the commits for it to show, and read in all information
-        for sha1 in revisions:
-            process.stdin.write(sha1)
-        process.stdin.close()
-        output = process.stdout.read()
-
-        # Parse time!
-        split_out = output.split("\xfe\xfa\xfc")
-        split_out.remove("")
-        for commit_data in split_out:
-            match = re.match(re_format, commit_data, re.MULTILINE)
-            commit = Commit(self, match.groupdict())
-            self.commits[ commit.sha1 ] = commit
-
-        # Extract the commit descriptions....
-        command = ("xargs", "git", "describe", "--always")
-        process = subprocess.Popen(command, stdin=subprocess.PIPE,
-                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate(''.join(revisions))
-        descriptions = stdout.split('\n')
-        for rev,desc in itertools.izip(revisions, descriptions):
-            self.commits[ rev.strip() ].description = desc.strip()
-
-        # Retrieve number of changed lines, and merge in the type of change
-        process = get_change_diff( self, ["--numstat", "-z"] )
-        output = process.stdout.read()
-        for sha1, information in re.findall("\xff([0-9a-f]+)\xff(?:\n|\x00|)([^\xff]*)(?:\x00|)", output):
-            stats = defaultdict(dict)
-            file_stats = re.findall("([0-9]+|-)\t([0-9]+|-)\t(?:(?=\x00)\x00([^\x00]+)\x00|)([^\x00]+)", information)
-            for added, removed, source_file, changed_file in file_stats:
-                if source_file:
-                    stats[changed_file]["source"] = unicode(source_file, "utf-8", "replace")
-                stats[changed_file]["added"] = added
-                stats[changed_file]["removed"] = removed
-
-            # Parse the way files changed
-            status = re.findall("\x00?(A|C|D|M|R|T|U|X)(?:(?<=C|R)([0-9]+)\x00([^\x00]+)|)\x00([^\x00]+)?", self.commits[sha1].files_changed)
-            for change, similarity, source_file, changed_file in status:
-                stats[changed_file]["change"] = change
-                if source_file:
-                    stats[changed_file]["similarity"] = similarity
-
-            for filename, data in stats.iteritems():
-                if "source" in data.keys() and "similarity" not in data.keys():
-                    del data["source"]
-
-            # Remove items with invalid data (ie. number of changed lines but no status)
-            data = OrderedDict((unicode(filename, "utf-8", "replace"), data) for filename, data in sorted(stats.items(), key=operator.itemgetter(0)) if "change" in data and "added" in data)
-            self.commits[sha1].files_changed = data
+        # Find the tips of everything already known to the repository, which we don't want to process again
+        # The boundary index only holds refs as they were before the push, which is all pre-receive needs
+        # The update hook has to see refs changed earlier in the same push as well, so it reads the refs as they are now
+        boundary = BoundaryIndex( self.git_dir )
+        live = self.pushed_tips is None
+        revisions, errors = self.__run_rev_list( revision_span, boundary.tips_for(self.ref, self.old_sha1, live) )
+
+        # Git rejects the whole listing when one of the tips no longer exists (as the index has missed a change to the refs)
+        # Retry with the tips from the refs as they are now, and give up should that fail too - listing no commits would skip the audits
+        if revisions is None and not live:
+            boundary.rebuild()
+            revisions, errors = self.__run_rev_list( revision_span, boundary.tips_for(self.ref, self.old_sha1) )
+        if revisions is None:
+            raise RuntimeError("Unable to list the commits in {0}: {1}".format(revision_span, errors.strip()))
+
+        self.__revisions = revisions
+        return self.__revisions
+
+    def __run_rev_list(self, revision_span, known_tips):
+        # Returns the packed revisions, or None (along with what git had to say) should rev-list fail
+        known_tips = known_tips | set( self.pushed_tips or () )
+        command = ("git", "rev-list", "--reverse", "--stdin", revision_span)
+        with Metrics.stage("revisions"), tempfile.TemporaryFile() as errors:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=errors)
+            try:
+                process.stdin.write( ''.join("^" + sha1 + "\n" for sha1 in known_tips) )
+                process.stdin.close()
+            except IOError:
+                # Git stopped reading early, which it only does when it has failed
+                pass
+
+            revisions = bytearray()
+            for line in process.stdout:
+                revisions.extend( binascii.unhexlify(line.strip()) )
+            process.wait()
+
+            if process.returncode != 0:
+                errors.seek(0)
+                return None, errors.read()
+
+        return str(revisions), ""
 
     def __get_repo_type(self):
         sysadmin_repos = ["gitolite-admin"]
@@ -259,7 +302,7 @@ class Repository(object):
     def __get_change_type(self):
         # Determine the merge base, to detect if we are experiencing a force or normal push....
         if( self.old_sha1 != self.EmptyRef and self.new_sha1 != self.EmptyRef ):
-            merge_base = read_command(('git', 'merge-base', self.old_sha1, self.new_sha1))
+            merge_base = self.session.merge_base(self.old_sha1, self.new_sha1)
 
         # What type of change is happening here?
         if self.old_sha1 == self.EmptyRef and self.new_sha1 != self.EmptyRef:
@@ -271,12 +314,1018 @@ class Repository(object):
         else:
             return ChangeType.Update
 
+class BoundaryIndex(object):
+
+    """Persistent index of the ref tips whose commits are already known to the repository.
+
+    The tips are used to exclude commits which have already been processed when
+    determining the revisions a push introduces. Rather than listing every ref
+    on each push, the index is stored in the repository and updated incrementally
+    as refs change. Should it look stale, it is rebuilt from scratch.
+
+    The index is only brought up to date by post-receive, so it is of use to
+    pre-receive alone: the update hook runs as each ref of a push is updated, and
+    reads the refs themselves to see those changed earlier in the same push."""
+
+    FileName = "kde-boundary-index"
+
+    # Rebuild the index at least this often (in seconds) to pick up refs changed without our hooks being involved
+    MaximumAge = 6 * 60 * 60
+
+    # The merge request refs, along with the keep-around refs used by Gitlab for it's operations are both ignored and not considered to be already in the repository
+    # We also ignore work branches, as these are subject to force pushes and are considered to be a work in progress and not yet part of a release
+    #
+    # This is necessary to ensure hooks fire when these changes are merged into the repository and become part of a release branch
+    IgnoredRefs = re.compile("^refs/(merge-requests/|keep-around/|heads/work/)")
+
+    def __init__(self, git_dir):
+        self.path = os.path.join(git_dir, self.FileName)
+        self.tips = None
+
+    def tips_for(self, ref, old_sha1, live = False):
+        """Returns the known tips to exclude when processing a change to the given ref.
+
+        The previous value of the ref being changed is not considered to be known.
+        With live set the tips are read from the refs as they are now, rather than from
+        the index, which doesn't learn of the refs a push changes until post-receive."""
+        if live:
+            tips = self.__read_refs()
+        else:
+            if not self.__load() or self.__is_stale(ref, old_sha1):
+                self.rebuild()
+            tips = self.tips
+
+        return set( sha1 for sha1 in tips.itervalues() if sha1 != old_sha1 )
+
+    def update(self, changes):
+        """Record ref changes which have been accepted into the repository.
+
+        Takes a list of (ref, old_sha1, new_sha1) tuples, as given to post-receive"""
+        with self.__lock():
+            if not self.__load():
+                self.rebuild()
+                return
+
+            for ref, old_sha1, new_sha1 in changes:
+                if self.IgnoredRefs.match(ref):
+                    continue
+
+                # If our view of the ref doesn't match what it was, we have missed a change
+                if self.__is_stale(ref, old_sha1):
+                    self.rebuild()
+                    return
+
+                if new_sha1 == Repository.EmptyRef:
+                    self.tips.pop(ref, None)
+                else:
+                    self.tips[ref] = new_sha1
+
+            self.__save()
+
+    def rebuild(self):
+        "Rebuild the index from the refs currently in the repository"
+        self.tips = self.__read_refs()
+        self.__save()
+
+    def __read_refs(self):
+        # The tips of the refs currently in the repository, by ref
+        command = ("git", "for-each-ref", "--format=%(objectname) %(refname)")
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+        tips = {}
+        for line in process.stdout:
+            sha1, ref = line.rstrip("\n").split(" ", 1)
+            if not self.IgnoredRefs.match(ref):
+                tips[ref] = sha1
+        process.wait()
+        return tips
+
+    def __is_stale(self, ref, old_sha1):
+        if self.IgnoredRefs.match(ref):
+            return False
+        if old_sha1 == Repository.EmptyRef:
+            return ref in self.tips
+        return self.tips.get(ref) != old_sha1
+
+    def __load(self):
+        if self.tips is not None:
+            return True
+
+        try:
+            if time.time() - os.path.getmtime(self.path) > self.MaximumAge:
+                return False
+
+            tips = {}
+            with open(self.path, "r") as index:
+                for line in index:
+                    sha1, ref = line.rstrip("\n").split(" ", 1)
+                    tips[ref] = sha1
+        except (IOError, OSError, ValueError):
+            return False
+
+        self.tips = tips
+        return True
+
+    def __save(self):
+        # Write to a temporary file first, so concurrent readers never see a partially written index
+        # Not being able to store the index isn't fatal, it will be rebuilt next time
+        temporary = None
+        try:
+            handle, temporary = tempfile.mkstemp(prefix=self.FileName + ".", dir=os.path.dirname(self.path))
+            with os.fdopen(handle, "w") as index:
+                for ref, sha1 in sorted(self.tips.iteritems()):
+                    index.write("{0} {1}\n".format(sha1, ref))
+            os.rename(temporary, self.path)
+        except (IOError, OSError):
+            if temporary and os.path.exists(temporary):
+                os.unlink(temporary)
+
+    @contextmanager
+    def __lock(self):
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+class RepoPolicy(object):
+
+    """The policies from the repo-configs tree which apply to a repository
+
+    The whole tree is compiled into a single index file, so hooks only need one
+    small read instead of probing the filesystem for each policy. The index records
+    the commit repo-management was checked out at when it was compiled, and is
+    recompiled once that changes. Changes to repo-configs which aren't committed
+    need hooks/compile-repo-policy.py to be run for the hooks to see them."""
+
+    IndexFile = os.path.join("compiled", "repo-policy.json")
+
+    # Flags which can be set for a repository in repo-configs/audit/
+    AuditFlags = ("skip-eol", "skip-filename", "skip-author-names", "skip-author-emails")
+
+    # Qt mirrors are exempt from all audits
+    UnauditedRepos = re.compile("^qt/(.+)$")
+
+    # Indexes already loaded, by management directory
+    Loaded = {}
+
+    def __init__(self, management_directory, path, flags):
+        self.path = path
+        flags = set(flags)
+        unaudited = bool(self.UnauditedRepos.match(path))
+
+        self.skip_eol = unaudited or "skip-eol" in flags
+        self.skip_filename = unaudited or "skip-filename" in flags
+        self.skip_author_names = unaudited or "skip-author-names" in flags
+        self.skip_author_emails = unaudited or "skip-author-emails" in flags
+        self.skip_notifications = "skip-notifications" in flags
+        self.force_push = "force-push" in flags
+        self.bulk_notifications = "notifications" in flags
+        self.blocked = "blocked" in flags
+        self.blocked_list = os.path.join(management_directory, "repo-configs", "blocked", path)
+        self.blocked_index = os.path.join(management_directory, "compiled", "blocked", path + ".idx")
+
+        # Commits blocked in every repository, and therefore across all forks
+        self.global_blocked_list = os.path.join(management_directory, "repo-configs", "blocked-global")
+        self.global_blocked_index = os.path.join(management_directory, "compiled", "blocked-global.idx")
+
+    @classmethod
+    def for_path(cls, management_directory, path):
+        "Returns the policies applying to the repository with the given path"
+        index = cls.load(management_directory)
+        return cls(management_directory, path, index.get(path, ()))
+
+    @classmethod
+    def load(cls, management_directory):
+        "Returns the policy index, compiling it first if needed"
+        if management_directory in cls.Loaded:
+            return cls.Loaded[management_directory]
+
+        index_file = os.path.join(management_directory, cls.IndexFile)
+        revision = cls.revision(management_directory)
+
+        index = None
+        try:
+            with open(index_file) as handle:
+                compiled = json.load(handle)
+            # Should we not be able to tell which commit we are at, the index is assumed to be current
+            if revision is None or compiled.get("revision") == revision:
+                index = compiled["repositories"]
+        except (IOError, OSError, ValueError, KeyError, AttributeError):
+            pass
+
+        if index is None:
+            index = cls.compile(management_directory)
+            cls.store(management_directory, index)
+
+        cls.Loaded[management_directory] = index
+        return index
+
+    @classmethod
+    def revision(cls, management_directory):
+        "Returns the commit repo-management is checked out at, or None if it can't be told"
+        # This is read straight from the repository, as starting git would cost more than the index saves
+        git_dir = os.path.join(management_directory, ".git")
+        try:
+            with open(os.path.join(git_dir, "HEAD")) as head:
+                ref = head.read().strip()
+            if not ref.startswith("ref: "):
+                return ref
+            ref = ref[len("ref: "):]
+
+            try:
+                with open(os.path.join(git_dir, ref)) as loose:
+                    return loose.read().strip()
+            except IOError:
+                pass
+
+            with open(os.path.join(git_dir, "packed-refs")) as packed:
+                for line in packed:
+                    sha1, _, name = line.rstrip("\n").partition(" ")
+                    if name == ref:
+                        return sha1
+        except IOError:
+            pass
+        return None
+
+    @classmethod
+    def compile(cls, management_directory):
+        "Compile the repo-configs tree into an index of the flags set for each repository"
+        base = os.path.join(management_directory, "repo-configs")
+        index = defaultdict(list)
+
+        def entries(section):
+            # Yields the path of everything in the section relative to it, along with whether it is a directory
+            section_base = os.path.join(base, section)
+            for directory, dirnames, filenames in os.walk(section_base):
+                relative = os.path.relpath(directory, section_base)
+                for name in dirnames:
+                    yield os.path.normpath(os.path.join(relative, name)), True
+                for name in filenames:
+                    if name != ".keepme":
+                        yield os.path.normpath(os.path.join(relative, name)), False
+
+        # Audit exemptions live in repo-configs/audit/<path>.git/<flag>
+        for entry, is_directory in entries("audit"):
+            repository, flag = os.path.split(entry)
+            if not is_directory and repository.endswith(".git") and flag in cls.AuditFlags:
+                index[repository[:-4]].append(flag)
+
+        # The presence of repo-configs/notifications/<path> allows large pushes
+        # Notifications are disabled by repo-configs/notifications/<path>.git/skip-notifications
+        for entry, is_directory in entries("notifications"):
+            repository, flag = os.path.split(entry)
+            if not is_directory and repository.endswith(".git") and flag == "skip-notifications":
+                index[repository[:-4]].append("skip-notifications")
+            index[entry].append("notifications")
+
+        # Force pushes are allowed by the presence of repo-configs/force-push/<path>
+        for entry, is_directory in entries("force-push"):
+            index[entry].append("force-push")
+
+        # Commits listed in repo-configs/blocked/<path> can't be pushed
+        for entry, is_directory in entries("blocked"):
+            if not is_directory:
+                index[entry].append("blocked")
+
+        return dict(index)
+
+    @classmethod
+    def store(cls, management_directory, index):
+        "Write the index to disk for use by later hooks"
+        index_file = os.path.join(management_directory, cls.IndexFile)
+        temporary = None
+        try:
+            if not os.path.isdir(os.path.dirname(index_file)):
+                os.makedirs(os.path.dirname(index_file))
+            handle, temporary = tempfile.mkstemp(dir=os.path.dirname(index_file))
+            with os.fdopen(handle, "w") as output:
+                json.dump({"repositories": index, "revision": cls.revision(management_directory)}, output, sort_keys=True, indent=1)
+            os.rename(temporary, index_file)
+        except (IOError, OSError):
+            if temporary and os.path.exists(temporary):
+                os.unlink(temporary)
+
+class BlockedCommits(object):
+
+    """A list of administratively blocked commits
+
+    The text lists are compiled into an index of the raw SHA-1 of each commit,
+    sorted and stored with a fixed width, which is memory mapped and binary
+    searched. Checking a commit therefore costs O(log n) however large the list
+    grows. Should the index be missing or out of date, it is compiled again."""
+
+    RecordSize = 20
+
+    def __init__(self, records):
+        self.records = records
+        self.count = len(records) // self.RecordSize
+
+    def __contains__(self, sha1):
+        try:
+            key = binascii.unhexlify(sha1)
+        except (TypeError, binascii.Error):
+            return False
+
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = self.records[middle * self.RecordSize:(middle + 1) * self.RecordSize]
+            if record < key:
+                low = middle + 1
+            elif record > key:
+                high = middle
+            else:
+                return True
+
+        return False
+
+    @classmethod
+    def load(cls, blocked_list, blocked_index):
+        "Returns the blocked commits from the given list, using its compiled index where possible"
+        try:
+            listed = os.path.getmtime(blocked_list)
+        except OSError:
+            return cls("")
+
+        try:
+            if os.path.getmtime(blocked_index) >= listed and os.path.getsize(blocked_index) % cls.RecordSize == 0:
+                with open(blocked_index, "rb") as index:
+                    if os.path.getsize(blocked_index) == 0:
+                        return cls("")
+                    return cls( mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ) )
+        except (IOError, OSError, ValueError):
+            pass
+
+        return cls( cls.compile(blocked_list, blocked_index) )
+
+    @classmethod
+    def compile(cls, blocked_list, blocked_index):
+        "Compile the given list into an index, returning the records"
+        records = set()
+        with open(blocked_list, "r") as blockedfile:
+            for line in blockedfile:
+                sha1 = line.strip()
+                if re.match("^[0-9a-f]{40}$", sha1):
+                    records.add( binascii.unhexlify(sha1) )
+        records = ''.join(sorted(records))
+
+        # Not being able to store the index isn't fatal, it will be compiled again next time
+        temporary = None
+        try:
+            if not os.path.isdir(os.path.dirname(blocked_index)):
+                os.makedirs(os.path.dirname(blocked_index))
+            handle, temporary = tempfile.mkstemp(dir=os.path.dirname(blocked_index))
+            with os.fdopen(handle, "wb") as index:
+                index.write(records)
+            os.rename(temporary, blocked_index)
+        except (IOError, OSError):
+            if temporary and os.path.exists(temporary):
+                os.unlink(temporary)
+
+        return records
+
+class GitSession(object):
+
+    """Long lived git processes, and memoized query results, for a hook run.
+
+    Objects are looked up through persistent "git cat-file --batch-check" and
+    "git cat-file --batch" processes, rather than forking git for every
+    query. Merge bases, object types and configuration values are remembered
+    for the remainder of the run, so repeated questions are answered without
+    invoking git again."""
+
+    def __init__(self):
+        self.__batch_check = None
+        self.__batch = None
+        self.__object_types = {}
+        self.__merge_bases = {}
+        self.__config = {}
+
+    def __start(self, mode):
+        command = ("git", "cat-file", mode)
+        return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def __query(self, process, name):
+        process.stdin.write(name + "\n")
+        process.stdin.flush()
+
+        # The header is either "<sha1> <type> <size>" or "<name> missing"
+        header = process.stdout.readline().split()
+        if len(header) != 3:
+            return None, 0
+        return header[1], int(header[2])
+
+    def object_type(self, name):
+        "Returns the type of the given object, or an empty string if it does not exist"
+        if name not in self.__object_types:
+            if self.__batch_check is None:
+                self.__batch_check = self.__start("--batch-check")
+            object_type, _ = self.__query(self.__batch_check, name)
+            self.__object_types[name] = object_type or ""
+
+        return self.__object_types[name]
+
+    def read_object(self, name):
+        "Returns the type and content of the given object, or (None, None) if it does not exist"
+        if self.__batch is None:
+            self.__batch = self.__start("--batch")
+
+        object_type, size = self.__query(self.__batch, name)
+        if object_type is None:
+            return None, None
+
+        # The content is followed by a newline, which isn't part of the object
+        content = self.__batch.stdout.read(size)
+        self.__batch.stdout.read(1)
+        self.__object_types[name] = object_type
+        return object_type, content
+
+    def stream_object(self, name, chunk_size = 65536):
+        """Yields the type of the given object, followed by its content in chunks
+
+        Nothing is yielded if the object does not exist. Content not consumed by the caller is discarded."""
+        if self.__batch is None:
+            self.__batch = self.__start("--batch")
+
+        object_type, size = self.__query(self.__batch, name)
+        if object_type is None:
+            return
+
+        self.__object_types[name] = object_type
+        try:
+            yield object_type
+            while size > 0:
+                chunk = self.__batch.stdout.read(min(size, chunk_size))
+                size -= len(chunk)
+                yield chunk
+        finally:
+            # Keep the process in step with us, even if the caller stopped early
+            while size > 0:
+                size -= len(self.__batch.stdout.read(min(size, chunk_size)))
+            self.__batch.stdout.read(1)
+
+    def merge_base(self, first, second):
+        "Returns the merge base of two commits"
+        key = frozenset((first, second))
+        if key not in self.__merge_bases:
+            self.__merge_bases[key] = read_command(('git', 'merge-base', first, second))
+
+        return self.__merge_bases[key]
+
+    def config(self, key):
+        "Returns the value of a configuration key local to the repository"
+        if key not in self.__config:
+            self.__config[key] = read_command(('git', 'config', '--local', '--get', key))
+
+        return self.__config[key]
+
+    def close(self):
+        "Shuts down the long lived git processes"
+        for process in (self.__batch_check, self.__batch):
+            if process is not None:
+                process.stdin.close()
+                process.wait()
+
+        self.__batch_check = self.__batch = None
+
+class VerdictCache(object):
+
+    """Persistent store of verdicts, shared between hook runs and repositories.
+
+    Remembers the outcome of checks whose input never changes, such as the content
+    of a blob, so they don't need to be performed again. Verdicts may optionally expire.
+    Problems accessing the store are never fatal, they are treated as a cache miss."""
+
+    BaseDir = os.getenv('HOOK_CACHE_DIR', os.path.join(os.path.expanduser("~"), ".cache", "kde-hooks"))
+
+    @classmethod
+    def configure(cls):
+        "Determine where the stores are kept from the environment again, as the hook daemon does for each request"
+        cls.BaseDir = os.getenv('HOOK_CACHE_DIR', os.path.join(os.path.expanduser("~"), ".cache", "kde-hooks"))
+
+    # SQLite limits the number of parameters a single statement may have
+    BatchSize = 500
+
+    def __init__(self, name):
+        self.path = os.path.join(self.BaseDir, name + ".sqlite")
+        self.__connection = None
+
+    def __connect(self):
+        if self.__connection is None:
+            try:
+                if not os.path.isdir(self.BaseDir):
+                    os.makedirs(self.BaseDir)
+                connection = sqlite3.connect(self.path, timeout=2)
+                connection.execute("CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, verdict TEXT NOT NULL, expires INTEGER)")
+                self.__connection = connection
+            except (sqlite3.Error, OSError):
+                return None
+
+        return self.__connection
+
+    def get(self, key):
+        "Returns the verdict for the given key, or None if it is not known"
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        "Returns a dictionary of the known verdicts for the given keys"
+        connection = self.__connect()
+        if connection is None:
+            return {}
+
+        keys = list(keys)
+        verdicts = {}
+        now = int(time.time())
+        try:
+            for start in xrange(0, len(keys), self.BatchSize):
+                batch = keys[start:start + self.BatchSize]
+                query = "SELECT key, verdict FROM verdicts WHERE (expires IS NULL OR expires > ?) AND key IN ({0})".format(','.join('?' * len(batch)))
+                verdicts.update( connection.execute(query, [now] + batch) )
+        except sqlite3.Error:
+            pass
+
+        return verdicts
+
+    def put(self, key, verdict, ttl = None):
+        "Stores the verdict for the given key, which expires after ttl seconds if given"
+        self.put_many({key: verdict}, ttl)
+
+    def put_many(self, verdicts, ttl = None):
+        "Stores a dictionary of verdicts, which expire after ttl seconds if given"
+        connection = self.__connect()
+        if connection is None or not verdicts:
+            return
+
+        expires = int(time.time()) + ttl if ttl is not None else None
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO verdicts (key, verdict, expires) VALUES (?, ?, ?)",
+                                       ((key, verdict, expires) for key, verdict in verdicts.iteritems()))
+        except sqlite3.Error:
+            pass
+
+class HookMetrics(object):
+
+    """Records the resources used by each named stage of a hook run.
+
+    For each stage the wall time, CPU time (of the hook and of the processes it
+    waited for), number of processes started and peak resident set size are added
+    up over all the times it is entered. When the run ends a record per stage is
+    emitted, tagged with the repository, type of ref and number of commits involved.
+
+    Records are appended as JSON lines to the file named by HOOK_METRICS_FILE and/or
+    sent to the StatsD (with DogStatsD style tags) server named by HOOK_METRICS_STATSD
+    as host:port. When neither is set, entering a stage does nothing at all."""
+
+    def __init__(self, metrics_file = None, statsd = None):
+        self.metrics_file = metrics_file
+        self.statsd = statsd
+        self.enabled = bool(metrics_file or statsd)
+        self.hook = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "python"
+        self.stages = OrderedDict()
+        self.active = list()
+        self.repository = None
+        self.processes = 0
+
+        if self.enabled:
+            self.__count_processes()
+
+    @classmethod
+    def from_environment(cls):
+        return cls( os.getenv('HOOK_METRICS_FILE'), os.getenv('HOOK_METRICS_STATSD') )
+
+    def describe(self, repository):
+        "Tag the records with details of the given Repository (or Push)"
+        self.repository = repository
+
+    @contextmanager
+    def stage(self, name):
+        "Measures the block as part of the named stage"
+        if not self.enabled:
+            yield
+            return
+
+        # Peaks reached by enclosing stages would be lost when the peak is reset for this one
+        if self.active:
+            self.active[-1]["peak_rss_kb"] = max( self.active[-1]["peak_rss_kb"], self.peak_rss() )
+        self.reset_peak_rss()
+
+        frame = {"peak_rss_kb": 0}
+        self.active.append(frame)
+        started = time.time()
+        times = os.times()
+        processes = self.processes
+        try:
+            yield
+        finally:
+            finished = os.times()
+            peak = max( frame["peak_rss_kb"], self.peak_rss() )
+            self.active.pop()
+            if self.active:
+                self.active[-1]["peak_rss_kb"] = max( self.active[-1]["peak_rss_kb"], peak )
+
+            entry = self.stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "child_cpu": 0.0, "subprocesses": 0, "peak_rss_kb": 0})
+            entry["calls"] += 1
+            entry["wall"] += time.time() - started
+            entry["cpu"] += (finished[0] - times[0]) + (finished[1] - times[1])
+            entry["child_cpu"] += (finished[2] - times[2]) + (finished[3] - times[3])
+            entry["subprocesses"] += self.processes - processes
+            entry["peak_rss_kb"] = max( entry["peak_rss_kb"], peak )
+
+    def records(self):
+        "The record of each stage measured so far"
+        tags = {"hook": self.hook}
+        if self.repository is not None:
+            tags["path"] = self.repository.path
+            tags["ref_type"] = getattr(self.repository, "ref_type", None)
+            tags["commits"] = self.repository.commit_count
+
+        for name, entry in self.stages.iteritems():
+            record = dict(tags)
+            record.update(entry)
+            record["stage"] = name
+            yield record
+
+    def flush(self):
+        "Emit the records of the stages measured so far, and start over"
+        if not self.stages:
+            return
+
+        try:
+            records = list( self.records() )
+        except Exception:
+            # Describing the repository must never cause the hook itself to fail
+            self.repository = None
+            records = list( self.records() )
+        self.stages = OrderedDict()
+
+        if self.metrics_file:
+            self.__write(records)
+        if self.statsd:
+            self.__send(records)
+
+    def __write(self, records):
+        now = time.time()
+        lines = ''.join( json.dumps(dict(record, time=now), sort_keys=True) + "\n" for record in records )
+        try:
+            # Appends of a single write are atomic, so hooks running at once don't interleave their lines
+            descriptor = os.open(self.metrics_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            try:
+                os.write(descriptor, lines)
+            finally:
+                os.close(descriptor)
+        except OSError:
+            pass
+
+    def __send(self, records):
+        host, _, port = self.statsd.partition(':')
+        try:
+            connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        except socket.error:
+            return
+
+        for record in records:
+            tags = ','.join( "{0}:{1}".format(key, record[key]) for key in ["hook", "path", "ref_type", "commits"] if key in record )
+            prefix = "kde.hooks.{0}.".format(record["stage"])
+            packet = "\n".join([
+                prefix + "calls:{0}|c|#{1}".format(record["calls"], tags),
+                prefix + "wall:{0:.3f}|ms|#{1}".format(record["wall"] * 1000, tags),
+                prefix + "cpu:{0:.3f}|ms|#{1}".format(record["cpu"] * 1000, tags),
+                prefix + "child_cpu:{0:.3f}|ms|#{1}".format(record["child_cpu"] * 1000, tags),
+                prefix + "subprocesses:{0}|c|#{1}".format(record["subprocesses"], tags),
+                prefix + "peak_rss:{0}|g|#{1}".format(record["peak_rss_kb"] * 1024, tags),
+            ])
+            try:
+                connection.sendto(packet, (host, int(port or 8125)))
+            except (socket.error, ValueError):
+                break
+        connection.close()
+
+    def __count_processes(self):
+        # Processes are counted by whoever starts them, hooklib or otherwise
+        metrics = self
+        original = subprocess.Popen
+        class CountedPopen(original):
+            def __init__(self, *args, **kwargs):
+                metrics.processes += 1
+                original.__init__(self, *args, **kwargs)
+        CountedPopen.__name__ = "Popen"
+        subprocess.Popen = CountedPopen
+
+    @staticmethod
+    def reset_peak_rss():
+        "Resets the peak resident set size of the process, returning whether it could be"
+        # Linux allows the peak to be reset, without which it is the peak of the whole run so far
+        try:
+            with open("/proc/self/clear_refs", "w") as clear_refs:
+                clear_refs.write("5")
+            return True
+        except (IOError, OSError):
+            return False
+
+    @staticmethod
+    def peak_rss():
+        "The peak resident set size of the process since it was last reset, in kilobytes"
+        try:
+            with open("/proc/self/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1])
+        except (IOError, OSError):
+            pass
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Shared by everything measured in a hook run, and emitted when it ends
+Metrics = HookMetrics.from_environment()
+if Metrics.enabled:
+    atexit.register(Metrics.flush)
+
+class CommitExtractor(object):
+
+    """Extracts the metadata and file changes of a list of revisions.
+
+    Everything is retrieved using a single git invocation. The output is NUL
+    delimited and is parsed incrementally as it is read from git, rather than
+    buffering it in full and matching it against regular expressions.
+
+    The abbreviated hashes, which commits without a tag to describe them with are
+    described by, come from a second git invocation read alongside the first.
+
+    The %(describe) placeholder needs git 2.32 or later. Errors from git are
+    passed on to the hook's own standard error rather than being collected."""
+
+    # Marks the start of each commit record in the output
+    RecordMarker = "\xfe\xfa\xfc"
+
+    # Metadata fields, in the order they appear in each record
+    Fields = (
+        ('sha1',            '%H'),
+        ('parents',         '%P'),
+        ('author_name',     '%an'),
+        ('author_email',    '%ae'),
+        ('date',            '%ct'),
+        ('committer_name',  '%cn'),
+        ('committer_email', '%ce'),
+        ('description',     '%(describe)'),
+        ('message',         '%B'),
+    )
+
+    ReadSize = 65536
+
+    re_numstat = re.compile("^([0-9]+|-)\t([0-9]+|-)\t(.*)$", re.DOTALL)
+
+    def __init__(self, revisions):
+        self.revisions = revisions
+
+    def __iter__(self):
+        pretty_format = '%xfe%xfa%xfc' + '%x00'.join(placeholder for _, placeholder in self.Fields) + '%x00'
+        command = ["git", "show", "--stdin", "-z", "-C", "--raw", "--numstat", "--no-abbrev",
+                   "--pretty=format:" + pretty_format]
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        # --no-abbrev (needed for the blobs) keeps %h from being abbreviated, so they are listed separately, in the same order
+        command = ["git", "log", "--stdin", "--no-walk=unsorted", "--format=%h"]
+        abbreviations = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        # Pass on the commits for it to show
+        for sha1 in self.revisions:
+            process.stdin.write(sha1.strip() + "\n")
+            abbreviations.stdin.write(sha1.strip() + "\n")
+        process.stdin.close()
+        abbreviations.stdin.close()
+
+        # Parse the records as they arrive
+        tokens = self.__read_tokens(process.stdout)
+        commit_data = None
+        for token in tokens:
+            # Start of the next commit?
+            if token.startswith(self.RecordMarker):
+                if commit_data is not None:
+                    yield self.__finish(commit_data, changes)
+
+                values = [token[len(self.RecordMarker):]]
+                values.extend( next(tokens) for _ in self.Fields[1:] )
+                commit_data = dict( zip((name for name, _ in self.Fields), values) )
+                commit_data["abbreviated"] = abbreviations.stdout.readline().strip()
+                changes = defaultdict(dict)
+                continue
+
+            # Entries after the metadata may be preceded by a newline
+            token = token.lstrip("\n")
+            if not token or commit_data is None:
+                continue
+
+            # Raw output, which tells us the way files changed along with the blobs involved
+            # Merges use the combined format, which has one colon per parent
+            if token.startswith(":"):
+                combined = token.startswith("::")
+                raw = token.split(" ")
+                status = raw[-1]
+                change = status[0]
+                if change in ("C", "R") and not combined:
+                    next(tokens)
+                    changed_file = next(tokens)
+                    changes[changed_file]["similarity"] = status[1:]
+                else:
+                    changed_file = next(tokens)
+                changes[changed_file]["change"] = change
+                # A mode and blob is listed for each parent, then for the commit itself
+                # Merges are compared against their first parent, as their patches are
+                parents = len(raw[0]) - len(raw[0].lstrip(":"))
+                changes[changed_file]["old_blob"] = raw[parents + 1]
+                changes[changed_file]["blob"] = raw[2 * parents + 1]
+                continue
+
+            # Number of changed lines, where renames and copies list their source
+            numstat = self.re_numstat.match(token)
+            if numstat:
+                added, removed, changed_file = numstat.groups()
+                if not changed_file:
+                    source_file = next(tokens)
+                    changed_file = next(tokens)
+                    changes[changed_file]["source"] = unicode(source_file, "utf-8", "replace")
+                changes[changed_file]["added"] = added
+                changes[changed_file]["removed"] = removed
+
+        if commit_data is not None:
+            yield self.__finish(commit_data, changes)
+
+        process.wait()
+        abbreviations.stdout.close()
+        abbreviations.wait()
+
+    def __read_tokens(self, stream):
+        remainder = ""
+        while True:
+            chunk = stream.read(self.ReadSize)
+            if not chunk:
+                break
+
+            tokens = (remainder + chunk).split("\x00")
+            remainder = tokens.pop()
+            for token in tokens:
+                yield token
+
+        if remainder:
+            yield remainder
+
+    def __finish(self, commit_data, changes):
+        # Without any tags git describe falls back to the abbreviated hash, as git abbreviates it (which isn't always 7 characters)
+        abbreviated = commit_data.pop("abbreviated")
+        if not commit_data["description"]:
+            commit_data["description"] = abbreviated
+
+        for filename, data in changes.iteritems():
+            if "source" in data and "similarity" not in data:
+                del data["source"]
+
+        # Remove items with invalid data (ie. number of changed lines but no status)
+        valid = [(filename, data) for filename, data in sorted(changes.items(), key=operator.itemgetter(0)) if "change" in data and "added" in data]
+        commit_data["files_changed"] = FileChanges(valid)
+        return commit_data
+
+class Push(object):
+    """Represents the changes made to several refs of a repository by a single push
+
+    The commits of all refs are combined, so commits shared between them are only processed once."""
+
+    def __init__(self, repositories):
+        self.repositories = repositories
+
+        # All the refs belong to the same repository
+        first = repositories[0]
+        self.path = first.path
+        self.virtual_path = first.virtual_path
+        self.repo_type = first.repo_type
+        self.management_directory = first.management_directory
+        self.git_dir = first.git_dir
+        self.session = first.session
+
+        self.__patches = None
+        self.__commits = None
+
+    @property
+    def patches(self):
+        "The patches of the commits being pushed, generated on first use"
+        if self.__patches is None:
+            self.__patches = PatchSpool(self)
+        return self.__patches
+
+    # The commits of each ref exclude those reachable from the refs before it, so they never overlap
+
+    @property
+    def commits(self):
+        "The commits being pushed, by sha1, extracted on first use"
+        if self.__commits is None:
+            self.__commits = OrderedDict( (commit.sha1, commit) for commit in self.iter_commits() )
+        return self.__commits
+
+    @property
+    def commit_count(self):
+        "The number of commits being pushed"
+        return sum( repository.commit_count for repository in self.repositories )
+
+    def revisions(self):
+        "Yields the sha1 of each commit being pushed"
+        return itertools.chain.from_iterable( repository.revisions() for repository in self.repositories )
+
+    def iter_commits(self):
+        "Yields each commit being pushed, as they are read from git"
+        if self.__commits is not None:
+            return self.__commits.itervalues()
+        return itertools.chain.from_iterable( repository.iter_commits() for repository in self.repositories )
+
+class PatchSpool(object):
+
+    """The patches of a set of commits, generated once and shared between their consumers.
+
+    The output of git is spooled to a temporary file, noting where the patch of
+    each commit starts and ends. Consumers can then iterate over the patch of
+    each commit, or of each file in a commit, without running git again."""
+
+    re_commit = re.compile("^\xff(.+)\xff$")
+    re_filename = re.compile("^diff --(cc |git a\/.+ b\/)(.+)$")
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.__spool = None
+        self.__segments = dict()
+
+    def __generate(self):
+        with Metrics.stage("patches"):
+            self.__write_spool()
+
+    def __write_spool(self):
+        self.__spool = tempfile.TemporaryFile()
+        # Without any commits git would show HEAD instead
+        if not self.repository.commit_count:
+            return
+        process = get_change_diff( self.repository, ["-p"] )
+
+        position = 0
+        commit = None
+        for line in process.stdout:
+            commit_change = self.re_commit.match(line)
+            if commit_change:
+                if commit is not None:
+                    self.__segments[commit] = (start, position)
+                commit = commit_change.group(1)
+                start = position + len(line)
+
+            self.__spool.write(line)
+            position += len(line)
+
+        if commit is not None:
+            self.__segments[commit] = (start, position)
+        process.wait()
+
+    def commits(self):
+        "Yields the sha1 of each commit along with the lines of its patch"
+        if self.__spool is None:
+            self.__generate()
+
+        for sha1 in self.repository.revisions():
+            if sha1 in self.__segments:
+                yield sha1, self.lines(sha1)
+
+    def lines(self, sha1):
+        "Returns the lines of the patch for the given commit"
+        if self.__spool is None:
+            self.__generate()
+
+        start, end = self.__segments[sha1]
+        self.__spool.seek(start)
+        return self.__spool.read(end - start).splitlines(True)
+
+    def files(self, sha1):
+        "Yields the name of each file changed by the given commit, along with the lines of its patch"
+        filename = None
+        filediff = list()
+        for line in self.lines(sha1):
+            file_change = self.re_filename.match(line)
+            if file_change:
+                if filename is not None:
+                    yield filename, filediff
+                filename = file_change.group(2)
+                filediff = list()
+
+            if filename is not None:
+                filediff.append(line)
+
+        if filename is not None:
+            yield filename, filediff
+
 class RepositoryMetadataLoader(object):
     # Store of repositories we know about
     KnownRepos = {}
 
     # Load the projects from the YAML file
     def loadProjectsFromTree( self, directoryPath ):
+        import scandir
+        import yaml
+
         # Get a listing of everything in this directory
         filesPresent = scandir.scandir(directoryPath)
         # We will recurse into directories beneath this one
@@ -315,6 +1364,10 @@ class CommitAuditor(object):
     """Performs all audits on commits"""
 
     ALLOWED_EOL_MIMETYPES = set(("text/vcard", "text/x-vcard", "text/directory", "image/svg", "image/x-portable-graymap"))
+
+    # Change this whenever what audit_eol_blobs() stores for a blob changes, so previously cached verdicts are ignored
+    # That includes changes to how binary blobs are told apart (MimeType.isTextData)
+    EolVersion = "3"
     ALLOWED_EOL_EXTENSIONS = set(("vcf", "vcf.ref", "svg", "pdf", "pgm", "fits"))
  
     "Whitelist of names which will always be accepted"
@@ -331,6 +1384,9 @@ class CommitAuditor(object):
         'heaptrack'
     ]
 
+    # How many commits are audited together, when they are streamed from git
+    BatchSize = 1000
+
     def __init__(self, repository):
         self.repository = repository
         self.__failed = False
@@ -345,6 +1401,9 @@ class CommitAuditor(object):
 
         self.__setup_filenames()
 
+        # Shared by each batch of commits audited
+        self.domain_validator = DomainValidator()
+
     def __log_failure(self, commit, message):
         log_message = unicode("Audit failure - Commit {0} - {1}", "utf-8").format(commit, message)
         self.__logger.critical(log_message)
@@ -355,22 +1414,10 @@ class CommitAuditor(object):
         self.__logger.warning(log_message)
 
     def __setup_filenames(self):
-        self.filename_limits = []
-
         configuration_file = os.path.join(self.repository.management_directory,
                                           "hooks", "blockedfiles.cfg")
 
-        with open(configuration_file) as configuration:
-            for line in configuration:
-                regex = line.strip()
-
-                # Skip comments and blank lines
-                if regex.startswith("#") or not regex:
-                    continue
-
-                restriction = re.compile(regex)
-                if restriction:
-                    self.filename_limits.append( restriction )
+        self.filename_policy = FilenamePolicy.load( configuration_file )
 
     @property
     def audit_failed(self):
@@ -379,6 +1426,12 @@ class CommitAuditor(object):
 
         return self.__failed
 
+    def __commits(self, commits):
+        # Unless told which commits to audit, all of those being pushed are streamed from git
+        if commits is None:
+            return self.repository.iter_commits()
+        return commits
+
     def audit_eol(self):
 
         """Audit the commit for proper end-of-line characters.
@@ -386,73 +1439,146 @@ class CommitAuditor(object):
         The UNIX type EOL is the only allowed EOL character."""
 
         # Regex's....
-        re_commit = re.compile("^\xff(.+)\xff$")
-        re_filename = re.compile("^diff --(cc |git a\/.+ b\/)(.+)$")
         blocked_eol = re.compile(r"(?:\r\n|\n\r|\r)$")
 
-        # Bool to allow special files such as vcards to bypass the check
-        eol_allowed = False
-
-
         # Do EOL audit!
-        process = get_change_diff( self.repository, ["-p"] )
-        for line in process.stdout:
-            commit_change = re.match( re_commit, line )
-            if commit_change:
-                commit = commit_change.group(1)
-                continue
+        for commit in self.repository.revisions():
+            for filename, filediff in self.repository.patches.files(commit):
+                # Allow special files such as vcards to bypass the check
+                if self.__eol_allowed(filename):
+                    continue
 
-            file_change = re.match( re_filename, line )
-            if file_change:
-                filename = file_change.group(2)
-                eol_violation = False
-                eol_allowed = False
-
-                # Check if it's an allowed mimetype
-                # First - check with the mimetypes system, to see if it can tell
-                guessed_type, _ = mimetypes.guess_type(filename)
-                if guessed_type in self.ALLOWED_EOL_MIMETYPES:
-                    eol_allowed = True
+                for line in filediff[1:]:
+                    # Unless they added it, ignore it
+                    if not line.startswith("+"):
+                        continue
+
+                    if re.search( blocked_eol, line ):
+                        # Failure has been found... handle it
+                        self.__log_failure(commit, "End of Line Style (non-Unix): " + filename);
+                        break
+
+    def audit_eol_blobs(self, commits = None):
+
+        """Audit the blobs introduced by the commits for proper end-of-line characters.
+
+        Instead of generating and scanning the diff of every commit, the content
+        of each new blob is scanned for lines ending in a carriage return. Verdicts are
+        remembered by blob, so blobs seen in earlier pushes (or forks) are not scanned again.
+        Binary blobs, which git would not show a textual diff for, are ignored: they are
+        told apart from their first chunk, without scanning the remainder of the blob.
+
+        As with the diff, only such lines added by the commit count: a modified file is
+        compared against its previous blob, so files which already had them can be changed.
+        The files a merge changes with respect to every one of its parents (those in its
+        combined diff) are checked too, being compared against the first parent."""
+
+        # Find the blobs which need to be checked
+        introduced = list()
+        for commit in self.__commits(commits):
+            for filename, data in commit.files_changed.iteritems():
+                blob = data.get("blob")
+                if data["change"] == "D" or not blob or blob == data.get("old_blob"):
                     continue
+                if self.__eol_allowed(filename):
+                    continue
+                introduced.append( (commit.sha1, filename, blob, data.get("old_blob")) )
+
+        # Check the blobs we haven't seen before
+        cache = VerdictCache("eol-" + self.EolVersion)
+        verdicts = cache.get_many( set(blob for _, _, blob, _ in introduced) )
+        scanned = dict()
+        for _, _, blob, _ in introduced:
+            if blob not in verdicts and blob not in scanned:
+                scanned[blob] = self.__scan_eol(blob)
+
+        cache.put_many( scanned )
+        verdicts.update( scanned )
+
+        for sha1, filename, blob, old_blob in introduced:
+            if verdicts[blob] == "crlf" and self.__crlf_introduced(blob, old_blob):
+                self.__log_failure(sha1, "End of Line Style (non-Unix): " + filename)
+
+    def __scan_eol(self, blob):
+        from mime import MimeType
+
+        content = self.repository.session.stream_object(blob)
+
+        # Submodules (commits) and the like have no content to check
+        if next(content, None) != "blob":
+            content.close()
+            return "ok"
+
+        previous = ""
+        for position, chunk in enumerate(content):
+            # Besides the heuristic git uses (a NUL byte near the start), binary formats are recognized by their magic
+            if position == 0 and not MimeType.isTextData(chunk):
+                verdict = "binary"
+                break
+            # The line ending may be split between chunks
+            if "\r\n" in chunk or (previous.endswith("\r") and chunk.startswith("\n")):
+                verdict = "crlf"
+                break
+            previous = chunk
+        else:
+            # The last line needn't have a newline at all
+            verdict = "crlf" if previous.endswith("\r") else "ok"
 
-                # Second check: by file extension
-                # NOTE: This uses the FIRST dot as extension
-                splitted_filename = filename.split(os.extsep)
-                # Check if there's an extension or not
-                # NOTE This assumes that files use dots for extensions only!
-                if len(splitted_filename) > 1:
-                    extension = splitted_filename[1]
-                    if extension in self.ALLOWED_EOL_EXTENSIONS:
-                        eol_allowed = True
+        content.close()
+        return verdict
 
-                continue
+    def __crlf_introduced(self, blob, old_blob):
+        "Whether the blob has lines ending in a carriage return which the blob it replaced did not have"
+        old_lines = self.__crlf_lines(old_blob) if old_blob else Counter()
+        if not old_lines:
+            return True
 
-            # Unless they added it, ignore it
-            if not line.startswith("+"):
-                continue
+        new_lines = self.__crlf_lines(blob)
+        return any( count > old_lines[line] for line, count in new_lines.iteritems() )
 
-            if re.search( blocked_eol, line ) and not eol_violation:
-                # Is this an allowed filename?
-                if eol_allowed:
-                    continue
+    def __crlf_lines(self, blob):
+        # Counts each distinct line of the blob ending in a carriage return
+        object_type, content = self.repository.session.read_object(blob)
+        if object_type != "blob":
+            return Counter()
+        return Counter( line for line in content.split("\n") if line.endswith("\r") )
+
+    def __eol_allowed(self, filename):
+        "Whether special files such as vcards are allowed to bypass the EOL checks"
+
+        from mime import MimeType
+
+        # Check if it's an allowed mimetype
+        # First - check with the shared mime database, to see if it can tell
+        guessed_type = MimeType.fromName(os.path.basename(filename))
+        if guessed_type and guessed_type.name() in self.ALLOWED_EOL_MIMETYPES:
+            return True
 
-                # Failure has been found... handle it
-                eol_violation = True
-                self.__log_failure(commit, "End of Line Style (non-Unix): " + filename);
+        # Second check: by file extension
+        # NOTE: This uses the FIRST dot as extension
+        splitted_filename = filename.split(os.extsep)
+        # Check if there's an extension or not
+        # NOTE This assumes that files use dots for extensions only!
+        if len(splitted_filename) > 1:
+            extension = splitted_filename[1]
+            if extension in self.ALLOWED_EOL_EXTENSIONS:
+                return True
 
-    def audit_filename(self):
+        return False
+
+    def audit_filename(self, commits = None):
 
         """Audit the file names in the commit."""
 
-        for commit in self.repository.commits.values():
+        for commit in self.__commits(commits):
             for filename in commit.files_changed:
                 if commit.files_changed[ filename ]["change"] not in ["A","R","C"]:
                     continue
-                for restriction in self.filename_limits:
-                    if re.search(restriction, filename):
-                        self.__log_failure(commit.sha1, "Invalid filename: " + filename)
+                restriction = self.filename_policy.match(filename)
+                if restriction:
+                    self.__log_failure(commit.sha1, "Invalid filename: " + filename + " (blocked by " + restriction + ")")
 
-    def audit_names_in_metadata(self):
+    def audit_names_in_metadata(self, commits = None):
 
         """Audit names in commit metadata.
 
@@ -462,7 +1588,7 @@ class CommitAuditor(object):
         that what looks like an actual name is present."""
 
         # Iterate over commits....
-        for commit in self.repository.commits.values():
+        for commit in self.__commits(commits):
             for name in [ commit.committer_name, commit.author_name ]:
                 # Is the name whitelisted?
                 if name in self.FullNameWhitelist:
@@ -478,7 +1604,7 @@ class CommitAuditor(object):
                     self.__log_failure(commit.sha1, "Non-full name: " + name)
                     continue
 
-    def audit_emails_in_metadata(self):
+    def audit_emails_in_metadata(self, commits = None):
 
         """Audit commit metadata.
 
@@ -488,7 +1614,8 @@ class CommitAuditor(object):
 
         # Iterate over commits....
         disallowed_domains = ["localhost", "localhost.localdomain", "(none)", "bombardier.com", "rail.bombardier.com"]
-        for commit in self.repository.commits.values():
+        addresses = list()
+        for commit in self.__commits(commits):
             for email_address in [ commit.committer_email, commit.author_email ]:
                 # Extract the email address, and reject them if extraction fails....
                 extraction = re.match("^(\S+)@(\S+)$", email_address)
@@ -502,37 +1629,731 @@ class CommitAuditor(object):
                     self.__log_failure(commit.sha1, "Email address using a blocked domain: " + email_address)
                     continue
 
-                # Ensure they have a valid MX/A entry in DNS....
-                try:
-                    dns.resolver.query(domain, "MX")
-                except (dns.resolver.NoAnswer, dns.exception.Timeout, dns.name.EmptyLabel):
-                    try:
-                        dns.resolver.query(domain, "A")
-                    except (dns.resolver.NoAnswer, dns.exception.Timeout, dns.name.EmptyLabel, dns.resolver.NXDOMAIN):
-                        self.__log_failure(commit.sha1, "Email address has an invalid domain : " + email_address)
-                except (dns.resolver.NXDOMAIN, dns.resolver.NoNameservers):
-                    self.__log_failure(commit.sha1, "Email address has an invalid domain : " + email_address)
+                addresses.append( (commit.sha1, email_address, domain) )
 
-    def audit_hashes(self, blocked_list):
-        with open(blocked_list, "r") as blockedfile:
-            blocked = blockedfile.readlines()
+        # Ensure they have a valid MX/A entry in DNS....
+        # Each domain only needs to be looked up once
+        valid_domains = self.domain_validator.validate( set(domain for _, _, domain in addresses) )
+        for sha1, email_address, domain in addresses:
+            if not valid_domains[domain]:
+                self.__log_failure(sha1, "Email address has an invalid domain : " + email_address)
 
-        for sha1 in blocked:
-            sha1 = sha1.strip()
-            if sha1 in self.repository.commits:
+    def audit_hashes(self, blocked_list, blocked_index = None):
+        if blocked_index is None:
+            blocked_index = blocked_list + ".idx"
+        blocked = BlockedCommits.load(blocked_list, blocked_index)
+
+        for sha1 in self.repository.revisions():
+            if sha1 in blocked:
                 self.__log_failure(sha1, "Administratively blocked commit: contact sysadmin@kde.org")
 
+class FilenamePolicy(object):
+
+    """Compiled form of the filename restrictions in blockedfiles.cfg
+
+    The restrictions are merged into a combined regular expression, so each
+    filename is checked in a single pass while still telling which restriction
+    matched. The merged form is cached on disk, keyed by the hash of the
+    configuration, and compiled at most once per process."""
+
+    # Python limits the number of groups a single regular expression may contain
+    RulesPerPattern = 90
+
+    # Restrictions using inline flags would change the meaning of those they are merged with
+    # Group references and named groups would no longer refer to the right group once merged
+    re_unmergeable = re.compile(r"^\(\?[iLmsux]+\)|\\[1-9]|\(\?P[<=]")
+
+    # Policies which have already been compiled, by the hash of their configuration
+    Compiled = {}
+
+    def __init__(self, rules, patterns = None):
+        self.rules = rules
+
+        # Work out how the rules can be merged, if we don't already know
+        if patterns is None:
+            patterns = self.__merge(rules)
+        self.patterns = patterns
+
+        self.__matchers = [(re.compile(pattern), first, merged) for pattern, first, merged in patterns]
+
+    @classmethod
+    def load(cls, configuration_file):
+        "Returns the compiled policy for the given configuration file"
+        with open(configuration_file) as configuration:
+            content = configuration.read()
+
+        digest = hashlib.sha1(content).hexdigest()
+        if digest in cls.Compiled:
+            return cls.Compiled[digest]
+
+        # Perhaps an earlier run already merged this configuration?
+        cache_file = os.path.join(VerdictCache.BaseDir, "filename-policy-" + digest + ".json")
+        try:
+            with open(cache_file) as cache:
+                cached = json.load(cache)
+            policy = cls(cached["rules"], [tuple(entry) for entry in cached["patterns"]])
+        except (IOError, ValueError, KeyError, TypeError, re.error):
+            policy = cls(cls.parse(content))
+            policy.__store(cache_file)
+
+        cls.Compiled[digest] = policy
+        return policy
+
+    @staticmethod
+    def parse(content):
+        "Returns the restrictions listed in the given configuration"
+        rules = []
+        for line in content.splitlines():
+            regex = line.strip()
+
+            # Skip comments and blank lines
+            if regex.startswith("#") or not regex:
+                continue
+
+            # Make sure it is valid on it's own
+            re.compile(regex)
+            rules.append( regex )
+
+        return rules
+
+    def match(self, filename):
+        "Returns the restriction the filename violates, or None if it is permitted"
+        for matcher, first, merged in self.__matchers:
+            match = matcher.search(filename)
+            if match and merged:
+                return self.rules[first + int(match.lastgroup[1:])]
+            elif match:
+                return self.rules[first]
+
+        return None
+
+    def __merge(self, rules):
+        # Returns a list of (pattern, index of the first rule it covers, whether it covers several rules)
+        patterns = []
+        chunk = []
+        for index, rule in enumerate(rules):
+            if self.re_unmergeable.search(rule):
+                if chunk:
+                    patterns.append( self.__combine(chunk) )
+                    chunk = []
+                patterns.append( (rule, index, False) )
+                continue
+
+            chunk.append( (index, rule) )
+            if len(chunk) == self.RulesPerPattern:
+                patterns.append( self.__combine(chunk) )
+                chunk = []
+
+        if chunk:
+            patterns.append( self.__combine(chunk) )
+        return patterns
+
+    def __combine(self, chunk):
+        first = chunk[0][0]
+        alternatives = ("(?P<r{0}>{1})".format(index - first, rule) for index, rule in chunk)
+        return ('|'.join(alternatives), first, True)
+
+    def __store(self, cache_file):
+        try:
+            if not os.path.isdir(VerdictCache.BaseDir):
+                os.makedirs(VerdictCache.BaseDir)
+            handle, temporary = tempfile.mkstemp(dir=VerdictCache.BaseDir)
+            with os.fdopen(handle, "w") as cache:
+                json.dump({"rules": self.rules, "patterns": self.patterns}, cache)
+            os.rename(temporary, cache_file)
+        except (IOError, OSError):
+            pass
+
+class DomainValidator(object):
+
+    """Checks whether email domains are valid, based on their MX or A records in DNS.
+
+    Domains are looked up concurrently, with each lookup, and the validation as a
+    whole, bounded by a timeout. The timeouts are enforced by the resolver, so no
+    lookup outlives the validation. Verdicts are kept in a VerdictCache, with valid
+    domains remembered for longer than invalid ones. Failures caused by a timeout
+    are not remembered at all.
+
+    The nameservers to use can be given (as host[:port]) to test against a local
+    resolver, or through the HOOK_DNS_NAMESERVERS environment variable."""
+
+    Workers = 8
+
+    # Seconds allowed for each query, and for the validation as a whole
+    QueryTimeout = 5
+    TotalTimeout = 15
+
+    # Seconds for which verdicts remain valid
+    ValidLifetime = 7 * 24 * 60 * 60
+    InvalidLifetime = 60 * 60
+
+    def __init__(self, nameservers = None):
+        if nameservers is None and os.getenv('HOOK_DNS_NAMESERVERS'):
+            nameservers = os.getenv('HOOK_DNS_NAMESERVERS').split(',')
+        self.nameservers = nameservers
+        self.cache = VerdictCache("domains")
+        # Verdicts reached by this validator, including those we ran out of time for
+        self.verdicts = dict()
+
+    def validate(self, domains):
+        "Returns a dictionary telling whether each of the given domains is valid"
+        with Metrics.stage("dns"):
+            return self.__validate(domains)
+
+    def __validate(self, domains):
+        domains = set(domains)
+        verdicts = dict( (domain, self.verdicts[domain]) for domain in domains if domain in self.verdicts )
+        verdicts.update( (domain, verdict == "valid") for domain, verdict in self.cache.get_many(domains.difference(verdicts)).iteritems() )
+
+        # Look up everything we don't know about yet
+        unknown = Queue.Queue()
+        for domain in domains.difference(verdicts):
+            unknown.put(domain)
+
+        results = dict()
+        deadline = time.time() + self.TotalTimeout
+        workers = [threading.Thread(target=self.__worker, args=(unknown, results, deadline)) for _ in xrange(min(self.Workers, unknown.qsize()))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        # Remember what we found out, except where we ran out of time
+        self.cache.put_many( dict((domain, "valid") for domain, valid in results.items() if valid), self.ValidLifetime )
+        self.cache.put_many( dict((domain, "invalid") for domain, valid in results.items() if valid is False), self.InvalidLifetime )
+
+        for domain in domains.difference(verdicts):
+            verdicts[domain] = bool( results.get(domain) )
+        self.verdicts.update( verdicts )
+        return verdicts
+
+    def __resolver(self):
+        import dns.resolver
+        resolver = dns.resolver.Resolver()
+        if self.nameservers:
+            # The resolver uses a single port for all nameservers
+            resolver.nameservers = [entry.partition(':')[0] for entry in self.nameservers]
+            resolver.port = int(self.nameservers[0].partition(':')[2] or 53)
+        resolver.timeout = resolver.lifetime = self.QueryTimeout
+        return resolver
+
+    def __worker(self, unknown, results, deadline):
+        resolver = self.__resolver()
+        while True:
+            try:
+                domain = unknown.get_nowait()
+            except Queue.Empty:
+                return
+            results[domain] = self.__lookup(resolver, domain, deadline)
+
+    def __limit(self, resolver, deadline):
+        # Bounds the next query by the time left for the validation, returning False if there is none
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        resolver.timeout = resolver.lifetime = min(self.QueryTimeout, remaining)
+        return True
+
+    def __lookup(self, resolver, domain, deadline):
+        # Returns whether the domain is valid, or None if we could not find out in time
+        import dns.resolver
+        if not self.__limit(resolver, deadline):
+            return None
+        try:
+            resolver.query(domain, "MX")
+            return True
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoNameservers):
+            return False
+        except (dns.resolver.NoAnswer, dns.exception.Timeout, dns.name.EmptyLabel):
+            pass
+
+        if not self.__limit(resolver, deadline):
+            return None
+        try:
+            resolver.query(domain, "A")
+            return True
+        except dns.exception.Timeout:
+            return None
+        except dns.exception.DNSException:
+            return False
+
+class SmtpTransport(object):
+    "Sends mail directly to a SMTP server, connecting when the first message is sent"
+
+    # Seconds to wait on the server before giving up on it (each time it is waited on)
+    # This is well below NotificationSpool.ClaimTimeout, so a hung delivery fails before its message is claimed again
+    Timeout = 60
+
+    def __init__(self, host = "localhost", port = 25, timeout = Timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.smtp = None
+
+    def send(self, sender, recipients, message):
+        import smtplib
+        with Metrics.stage("smtp"):
+            if self.smtp is None:
+                self.smtp = smtplib.SMTP(timeout=self.timeout)
+                self.smtp.connect(self.host, self.port)
+            self.smtp.sendmail(sender, recipients, message)
+
+    def close(self):
+        import smtplib
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.smtp = None
+
+class SpoolTransport(object):
+
+    """Queues mail in a spool directory, to be delivered later by hooks/deliver-notifications.py
+
+    The spool is laid out like a maildir: messages are written into tmp/ and
+    renamed into new/ once complete, so the delivery worker never sees a partially
+    written message. Each file holds the envelope as a line of JSON followed by the message."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        for subdir in NotificationSpool.Subdirectories:
+            path = os.path.join(directory, subdir)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def send(self, sender, recipients, message):
+        envelope = json.dumps({"sender": sender, "recipients": list(recipients)})
+        handle, temporary = tempfile.mkstemp(dir=os.path.join(self.directory, "tmp"))
+        with os.fdopen(handle, "wb") as spoolfile:
+            spoolfile.write(envelope + "\n")
+            spoolfile.write(message)
+            spoolfile.flush()
+            os.fsync(spoolfile.fileno())
+
+        name = "{0:.6f}.{1}.{2}".format(time.time(), os.getpid(), os.path.basename(temporary))
+        os.rename(temporary, os.path.join(self.directory, "new", name))
+
+    def close(self):
+        pass
+
+def open_transport():
+    "Returns the transport notifications should be sent through, spooling them if HOOK_MAIL_SPOOL is set"
+    spool = os.getenv('HOOK_MAIL_SPOOL')
+    if spool:
+        return SpoolTransport(spool)
+    return SmtpTransport()
+
+class NotificationSpool(object):
+
+    """Delivers the mail queued in a spool directory by SpoolTransport
+
+    Messages are claimed by moving them from new/ into cur/, and handed through a
+    bounded queue to a pool of workers which each keep a SMTP connection open.
+    Temporary failures are retried with a growing delay, messages which still can't
+    be delivered (or which the server rejects outright) are moved into failed/.
+
+    Several deliverers may share a spool. Messages left in cur/ by a worker which
+    failed unexpectedly (or by a deliverer which was stopped) are returned to new/
+    once they have been claimed for longer than ClaimTimeout."""
+
+    Subdirectories = ["tmp", "new", "cur", "failed"]
+
+    # Seconds after which a claimed message is assumed to have been abandoned
+    # This has to allow for every retry of a message, along with the time spent waiting for the server
+    ClaimTimeout = 60 * 60
+
+    def __init__(self, directory, host = "localhost", port = 25, workers = 4, retries = 5, retry_delay = 2):
+        self.directory = directory
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        # Bounded, so we stop claiming messages while the workers are busy
+        self.queue = Queue.Queue(workers * 4)
+        self.delivered = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        SpoolTransport(directory)
+
+    def path(self, subdir, name):
+        return os.path.join(self.directory, subdir, name)
+
+    def recover(self):
+        "Return messages claimed by a worker which never finished delivering them"
+        abandoned = time.time() - self.ClaimTimeout
+        for name in os.listdir( os.path.join(self.directory, "cur") ):
+            try:
+                if os.path.getmtime( self.path("cur", name) ) < abandoned:
+                    os.rename( self.path("cur", name), self.path("new", name) )
+            except OSError:
+                # Delivered (or recovered by another deliverer) meanwhile
+                continue
+
+    def claim(self):
+        "Claim the messages waiting in the spool, oldest first"
+        claimed = []
+        for name in sorted( os.listdir( os.path.join(self.directory, "new") ) ):
+            try:
+                # The modification time records when the message was claimed, for recover()
+                os.utime( self.path("new", name), None )
+                os.rename( self.path("new", name), self.path("cur", name) )
+            except OSError:
+                # Another worker got there first
+                continue
+            claimed.append( name )
+        return claimed
+
+    def run(self, once = False, poll_interval = 5):
+        "Deliver spooled messages, returning once the spool is empty if once is set"
+        threads = []
+        for number in range(self.workers):
+            thread = threading.Thread(target=self.deliver)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            while True:
+                self.recover()
+                claimed = self.claim()
+                for name in claimed:
+                    self.queue.put(name)
+
+                if once and not claimed:
+                    break
+                if not claimed:
+                    time.sleep(poll_interval)
+        finally:
+            for thread in threads:
+                self.queue.put(None)
+            for thread in threads:
+                thread.join()
+
+    def deliver(self):
+        transport = SmtpTransport(self.host, self.port)
+        try:
+            while True:
+                name = self.queue.get()
+                if name is None:
+                    return
+
+                # The message stays in cur/ for recover() to return, rather than taking the worker down with it
+                try:
+                    self.deliver_message(transport, name)
+                except Exception:
+                    transport.close()
+                    print >> sys.stderr, "Unable to deliver {0}, it will be retried later".format(name)
+                    traceback.print_exc()
+        finally:
+            transport.close()
+
+    def deliver_message(self, transport, name):
+        import smtplib
+        with open(self.path("cur", name), "rb") as spoolfile:
+            envelope = json.loads( spoolfile.readline() )
+            message = spoolfile.read()
+
+        for attempt in range(self.retries + 1):
+            try:
+                transport.send(envelope["sender"], envelope["recipients"], message)
+            except smtplib.SMTPResponseException as error:
+                transport.close()
+                if error.smtp_code >= 500:
+                    break
+            except smtplib.SMTPRecipientsRefused as error:
+                transport.close()
+                # Only worth retrying if one of the recipients was refused temporarily
+                if all( code >= 500 for code, _ in error.recipients.values() ):
+                    break
+            except (smtplib.SMTPException, socket.error):
+                transport.close()
+            else:
+                os.unlink( self.path("cur", name) )
+                with self.lock:
+                    self.delivered += 1
+                return
+
+            if attempt < self.retries:
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+        os.rename( self.path("cur", name), self.path("failed", name) )
+        with self.lock:
+            self.failed += 1
+        print >> sys.stderr, "Unable to deliver " + name
+
+class HookDaemon(object):
+
+    """Runs hooks on behalf of hookclient, with hooklib and everything it needs already loaded
+
+    Each request is handled by a process forked from the daemon, so requests run
+    concurrently, are isolated from each other, and start out with the dependencies,
+    compiled policies and rule tables the daemon has warmed up. The hook runs with the
+    environment and working directory of the client, with its output (stdout and stderr
+    combined) sent back over the connection, followed by a NUL and its exit status.
+
+    Once the hooks or the code they load from alongside them change, the daemon starts
+    itself over. Requests which arrive meanwhile are declined without being run, so
+    hookclient runs them in-process instead."""
+
+    # Hooks which may be run through the daemon
+    Hooks = ["invent.update"]
+
+    # Packages the hooks only load once they need them, which the daemon loads up front
+    Preloaded = ["yaml", "scandir", "smtplib", "dns.resolver", "lxml.etree", "lxml.builder"]
+
+    def __init__(self, socket_path, management_directory, workers = 32):
+        self.socket_path = socket_path
+        self.management_directory = management_directory
+        self.hooks_directory = os.path.dirname(os.path.abspath(__file__))
+        self.workers = workers
+        self.children = set()
+        self.stamp = None
+        self.code_files = []
+        self.code_stamp = None
+
+    def warm(self):
+        "Load everything the hooks may need, so requests don't have to"
+        for name in self.Preloaded:
+            importlib.import_module(name)
+
+        from mime import MimeType
+        email_classes()
+        MimeType.fromName("file.txt")
+        MimeType.fromData("\x01")
+
+        LicenseClassifier.compiled()
+        checker = CommitChecker()
+        for filename in ["file.cpp", "file.desktop", "file.txt"]:
+            checker.rules_for(filename)
+
+        self.refresh()
+
+        # Everything loaded from alongside the hooks is now known, as are the versions of it we are running
+        code_files = set( os.path.join(self.hooks_directory, hook) for hook in self.Hooks )
+        for module in sys.modules.values():
+            filename = getattr(module, "__file__", None)
+            if not filename:
+                continue
+            filename = os.path.abspath(filename)
+            if not filename.startswith(self.hooks_directory + os.sep):
+                continue
+            if filename.endswith((".pyc", ".pyo")):
+                filename = filename[:-1]
+            code_files.add(filename)
+        self.code_files = sorted(code_files)
+        self.code_stamp = self.stamp_code()
+
+    def refresh(self):
+        "Reload the policies if repo-management has been updated since they were loaded"
+        watched = [os.path.join(self.management_directory, ".git", "index"),
+                   os.path.join(self.management_directory, RepoPolicy.IndexFile),
+                   os.path.join(self.management_directory, "hooks", "blockedfiles.cfg")]
+        stamp = list()
+        for path in watched:
+            try:
+                stamp.append( os.path.getmtime(path) )
+            except OSError:
+                stamp.append( None )
+
+        stamp.append( RepoPolicy.revision(self.management_directory) )
+
+        if stamp == self.stamp:
+            return
+        self.stamp = stamp
+
+        RepoPolicy.Loaded.pop(self.management_directory, None)
+        RepoPolicy.load(self.management_directory)
+        try:
+            FilenamePolicy.load( watched[2] )
+        except IOError:
+            pass
+
+    def stamp_code(self):
+        "The modification times of the code we are running"
+        stamp = list()
+        for path in self.code_files:
+            try:
+                stamp.append( os.path.getmtime(path) )
+            except OSError:
+                stamp.append( None )
+        return stamp
+
+    def restart(self, listener):
+        "Start the daemon over, so it runs the code as it is now"
+        # Until the new daemon is listening, hookclient will run hooks in-process
+        os.unlink(self.socket_path)
+        listener.setblocking(False)
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except socket.error:
+                break
+            self.decline(connection)
+        listener.close()
+
+        # Our workers have to be waited on before we go, as the new daemon won't know about them
+        while self.children:
+            self.reap(block = True)
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def decline(self, connection):
+        "Turn a request away without running it, so hookclient runs the hook itself"
+        connection.settimeout(1)
+        try:
+            connection.makefile("rb").readline()
+            connection.sendall( "\0" + json.dumps({"declined": True}) + "\n" )
+        except socket.error:
+            pass
+        connection.close()
+
+    def serve(self):
+        "Accept requests until interrupted"
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        # Only the user the hooks run as may make requests
+        os.chmod(self.socket_path, 0600)
+        listener.listen(64)
+        listener.settimeout(1)
+
+        # Stopping the service should remove the socket, so hooks go back to running in-process
+        def terminate(signum, frame):
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, terminate)
+
+        try:
+            while True:
+                self.reap()
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    connection = None
+
+                if self.stamp_code() != self.code_stamp:
+                    if connection:
+                        self.decline(connection)
+                    self.restart(listener)
+                if connection is None:
+                    continue
+
+                # Wait for a worker to finish if too many are busy
+                while len(self.children) >= self.workers:
+                    self.reap(block = True)
+
+                self.refresh()
+                pid = os.fork()
+                if pid == 0:
+                    listener.close()
+                    signal.signal(signal.SIGINT, signal.SIG_DFL)
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    status = 1
+                    try:
+                        status = self.handle(connection)
+                    finally:
+                        os._exit(status)
+
+                self.children.add(pid)
+                connection.close()
+        finally:
+            listener.close()
+            os.unlink(self.socket_path)
+
+    def reap(self, block = False):
+        "Forget the workers which have finished"
+        while self.children:
+            try:
+                pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            self.children.discard(pid)
+            block = False
+
+    def handle(self, connection):
+        "Run the requested hook in this (forked) process, sending its output and exit status back"
+        connection.settimeout(None)
+        try:
+            request = json.loads( connection.makefile("rb").readline() )
+            hook = request["hook"]
+            if hook not in self.Hooks:
+                raise ValueError("hook not served: " + hook)
+        except (ValueError, KeyError, TypeError, socket.error) as error:
+            try:
+                connection.sendall( "Invalid hook request: {0}\n\0".format(error) + json.dumps({"status": 1}) + "\n" )
+            except socket.error:
+                pass
+            return 1
+
+        # The hook writes straight to the client, as do any processes it starts
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(connection.fileno(), 1)
+        os.dup2(connection.fileno(), 2)
+        null = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null, 0)
+        os.close(null)
+
+        status = self.run_hook(hook, request)
+
+        try:
+            connection.sendall( "\0" + json.dumps({"status": status}) + "\n" )
+            # Processes the hook left running may still hold the connection open
+            connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        return status
+
+    def run_hook(self, hook, request):
+        "Run the hook as if it had been started by git, returning its exit status"
+        global Metrics
+
+        os.environ.clear()
+        os.environ.update( request["environment"] )
+        os.environ["HOOK_DAEMON_CHILD"] = "1"
+        os.chdir( request["cwd"] )
+        sys.argv = [os.path.join(self.hooks_directory, hook)] + list(request["arguments"])
+
+        # Anything hooklib configures from the environment when it is loaded
+        VerdictCache.configure()
+        Metrics = HookMetrics.from_environment()
+
+        status = 0
+        try:
+            runpy.run_path( sys.argv[0], run_name = "__main__" )
+        except SystemExit as error:
+            if error.code is None:
+                status = 0
+            elif isinstance(error.code, int):
+                status = error.code
+            else:
+                print >>sys.stderr, error.code
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+
+        Metrics.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        return status
+
 class CommitNotifier(object):
     "Contains items needed to send notifications for commits"
 
-    def __init__(self):
-        self.smtp = smtplib.SMTP()
-        self.smtp.connect()
-
-    def __del__(self):
-        self.smtp.quit()
+    def __init__(self, transport = None):
+        self.transport = transport or open_transport()
 
     def notify_email(self, builder, notification_address, diff ):
+        MIMEText, Header = email_classes()
+
         # Build list for X-Commit-Directories...
         full_commit_dirs = [cdir for cdir in builder.commit_directories]
 
@@ -581,67 +2402,228 @@ class CommitNotifier(object):
 
         # Send email...
         to_addresses = cc_addresses + bcc_addresses + [notification_address]
-        self.smtp.sendmail("null@kde.org", to_addresses, message.as_string())
+        self.transport.send("null@kde.org", to_addresses, message.as_string())
 
     def notify_bugzilla(self, builder):
-        commit_regex = re.compile("^\s*((CC)?BUGS?|FEATURE)[:=](.+)\n", re.MULTILINE)
-        bugs_changed = builder.keywords['bug_fixed'] + builder.keywords['bug_cc']
-        for bug in bugs_changed:
-            # Prepare the customised Bugzilla comment
-            related_bugs = ["bug " + entry for entry in bugs_changed if entry != bug]
-            commit_msg = builder.body
-            if related_bugs:
-                commit_msg = re.sub(commit_regex, "Related: " + ', '.join(related_bugs) + "\n", commit_msg, 1)
-            commit_msg = re.sub(commit_regex, "", commit_msg)
+        bugzilla = BugzillaAggregator(self.transport)
+        bugzilla.add( builder )
+        bugzilla.notify()
+
+    def handler(self, repository):
+        # If there are no commits -> nothing to notify on :)
+        if repository.commit_count == 0:
+            return
+
+        # The patches are shared with anything else which needs them
+        for commit in repository.iter_commits():
+            diff = [unicode(line, "utf-8", 'replace') for line in repository.patches.lines(commit.sha1)]
+            yield(commit, diff)
+
+class BugzillaAggregator(object):
+
+    """Collects the bugs referenced by the commits of a push, to notify Bugzilla once per bug
+
+    Each bug receives a single control message, carrying the messages of all the commits
+    which referenced it, and having its final status applied once."""
+
+    def __init__(self, transport = None):
+        self.transport = transport or open_transport()
+        self.bugs = OrderedDict()
+        self.bodies = dict()
+
+    def add(self, builder):
+        "Record the bugs referenced by the commit of the given builder, which must have determined its keywords"
+        if not builder.parsed.bugs:
+            return
+
+        # The body depends on the checker, which moves on to the next commit once we return
+        # The lines mentioning bugs are removed now as well, however many bugs the commit mentions
+        if builder not in self.bodies:
+            self.bodies[builder] = CommitKeywords.split_bug_lines( builder.body )
+
+        for bug in builder.parsed.bugs:
+            builders = self.bugs.setdefault(bug, [])
+            if builder not in builders:
+                builders.append( builder )
+
+    def comment(self, builder, bug):
+        "Prepare the customised Bugzilla comment for the given commit"
+        before, after = self.bodies[builder]
+        if after is None:
+            return before
+
+        related_bugs = ["bug " + entry for entry in builder.parsed.bugs if entry != bug]
+        if related_bugs:
+            return before + "Related: " + ', '.join(related_bugs) + "\n" + after
+        return before + after
+
+    def notify(self):
+        "Send the control message for each bug collected so far"
+        for bug, builders in self.bugs.iteritems():
+            fixed_by = [builder for builder in builders if bug in builder.parsed.bug_fixed]
+            # The last commit to touch the bug is the one to send as
+            sender = (fixed_by or builders)[-1]
 
             # Prepare the Bugzilla specific message body portion...
             bug_body = list()
             bug_body.append( "@bug_id = " + bug )
-            if bug in builder.keywords['bug_fixed']:
+            if fixed_by:
                 bug_body.append( "@bug_status = RESOLVED" )
                 bug_body.append( "@resolution = FIXED" )
-                bug_body.append( "@cf_commitlink = " + builder.commit.url )
-                if builder.keywords['fixed_in']:
-                    bug_body.append("@cf_versionfixedin = " + builder.keywords['fixed_in'][0])
+                bug_body.append( "@cf_commitlink = " + fixed_by[-1].commit.url )
+                fixed_in = [builder.parsed.fixed_in[0] for builder in fixed_by if builder.parsed.fixed_in]
+                if fixed_in:
+                    bug_body.append("@cf_versionfixedin = " + fixed_in[-1])
             bug_body.append( '' )
-            bug_body.append( commit_msg )
+
+            if len(builders) > 1:
+                bug_body.append( "This bug is referenced by {0} commits:".format(len(builders)) )
+                bug_body.extend( builder.commit.url for builder in builders )
+                bug_body.append( '' )
+            bug_body.append( '\n'.join(self.comment(builder, bug) for builder in builders) )
+
+            subject = sender.subject
+            if len(builders) > 1:
+                subject += unicode(" (and {0} more commits)").format(len(builders) - 1)
 
             body = unicode('\n', "utf-8").join( bug_body )
+            MIMEText, Header = email_classes()
             message = MIMEText( body.encode("utf-8"), 'plain', 'utf-8' )
-            message['Subject'] = Header( builder.subject, 'utf-8', 76, 'Subject' )
-            message['From']    = Header( builder.commit.committer_email )
+            message['Subject'] = Header( subject, 'utf-8', 76, 'Subject' )
+            message['From']    = Header( sender.commit.committer_email )
             message['To']      = Header( "bug-control@bugs.kde.org" )
-            self.smtp.sendmail(builder.commit.committer_email, ["bug-control@bugs.kde.org"],
-                               message.as_string())
+            self.transport.send(sender.commit.committer_email, ["bug-control@bugs.kde.org"],
+                                message.as_string())
 
-            if bug in builder.keywords['bug_fixed']:
+            if fixed_by:
                 print "Closing bug " + bug
             else:
                 print "Posting comment to bug " + bug
 
-    def handler(self, repository):
-        # If there are no commits -> nothing to notify on :)
-        if len(repository.commits) == 0:
-            return
+        self.bugs = OrderedDict()
+        self.bodies = dict()
 
-        # We will incrementally notify as we gather up the diffs....
-        process = get_change_diff( repository, ["-p"] )
-        diff = list()
-        for line in process.stdout:
-            commit_change = re.match( "^\xff(.+)\xff$", line )
-            if commit_change and diff:
-                yield(repository.commits[commit], diff)
-                commit = ""
-                diff = list()
+class CommitKeywords(object):
 
-            if commit_change:
-                commit = commit_change.group(1)
+    """The keywords and trailers found in a commit message
+
+    Messages are scanned in a single pass, using one expression which recognises all
+    of the keywords, so each line is only matched once."""
+
+    # Each line holds at most one keyword, the group of which holds its value
+    Keywords = re.compile("|".join([
+        "\s*CC[-_]?MAIL[:=]\s*(?P<email_cc>.*)",
+        "\s*C[Cc][:=]\s*(?P<email_cc2>.*)",
+        "\s*FIXED[-_]?IN[:=]\s*(?P<fixed_in>.*)",
+        "\s*(?:BUGS?|FEATURE)[:=]\s*(?P<bug_fixed>.+)",
+        "\s*CCBUGS?[:=]\s*(?P<bug_cc>.+)",
+        "\s*(?P<email_gui>GUI:)",
+        "(?P<silent>(?:CVS|SVN|GIT|SCM).?SILENT)",
+        "(?P<notes>Notes added by 'git notes add'|Notes removed by 'git notes remove')",
+    ]))
+
+    # Keywords which list several values, and those which list bug numbers
+    Split = ['email_cc', 'email_cc2', 'fixed_in']
+    Numeric = ['bug_fixed', 'bug_cc']
+    BugNumber = re.compile("(\d{1,10})")
+
+    # Standard git trailers, such as Signed-off-by, found in the last paragraph
+    Trailer = re.compile("^([A-Za-z0-9][A-Za-z0-9-]*):\s*(.*)$")
+
+    # Lines of a notification which mention bugs, along with any blank lines before them
+    BugLine = re.compile("[ \t\r\f\v]*((CC)?BUGS?|FEATURE)[:=].+\n")
+
+    def __init__(self):
+        self.email_cc = list()
+        self.email_cc2 = list()
+        self.fixed_in = list()
+        self.bug_fixed = list()
+        self.bug_cc = list()
+        self.email_gui = False
+        self.silent = False
+        self.notes = False
+        self.trailers = list()
+
+    @classmethod
+    def scan(cls, message):
+        "Returns the keywords and trailers of the given commit message"
+        keywords = cls()
+        paragraph = list()
+        for line in message.split("\n"):
+            if not line.strip():
+                paragraph = list()
+            else:
+                paragraph.append(line)
+
+            # If our line starts with Summary: (as it does when using Arcanist's default template) then strip this off
+            # This allows for people to fill keywords in the Differential Summary and have this work smoothly for them
+            if line.startswith("Summary: ") and len(line) > len("Summary: "):
+                line = line[len("Summary: "):]
+
+            match = cls.Keywords.match(line)
+            if not match:
                 continue
 
-            diff.append( unicode(line, "utf-8", 'replace') )
+            name = match.lastgroup
+            if name in cls.Split:
+                getattr(keywords, name).extend( result.strip() for result in match.group(name).split(",") )
+            elif name in cls.Numeric:
+                getattr(keywords, name).extend( cls.BugNumber.findall(match.group(name)) )
+            else:
+                setattr(keywords, name, True)
+
+        # Trailers are only recognised when they make up the whole of the last paragraph
+        trailers = [cls.Trailer.match(trailer_line) for trailer_line in paragraph]
+        if trailers and all(trailers):
+            keywords.trailers = [(trailer.group(1), trailer.group(2).strip()) for trailer in trailers]
+
+        return keywords
+
+    @property
+    def bugs(self):
+        "All of the bugs referenced, fixed or otherwise"
+        return self.bug_fixed + self.bug_cc
+
+    def as_dict(self):
+        "The keywords, in the form MessageBuilder.keywords has always provided them"
+        results = defaultdict(list)
+        for name in self.Split + self.Numeric:
+            if getattr(self, name):
+                results[name] = list( getattr(self, name) )
+        for name in ['email_gui', 'silent', 'notes']:
+            if getattr(self, name):
+                results[name] = True
+        return results
+
+    @classmethod
+    def split_bug_lines(cls, text):
+        """Removes the lines mentioning bugs from the given text
+
+        Returns the text before the first of those lines, and the remainder with them removed.
+        Blank lines immediately before each of them are removed as well."""
+        pieces = text.split("\n")
+        lines = [piece + "\n" for piece in pieces[:-1]]
+        if pieces[-1]:
+            lines.append(pieces[-1])
+
+        before = list()
+        after = list()
+        kept = before
+        blank = list()
+        for line in lines:
+            if cls.BugLine.match(line):
+                blank = list()
+                kept = after
+                continue
+            if line.endswith("\n") and not line.strip(" \t\n\r\f\v"):
+                blank.append(line)
+                continue
+            kept.extend(blank)
+            kept.append(line)
+            blank = list()
+        kept.extend(blank)
 
-        if commit:
-            yield(repository.commits[commit], diff)
+        return ''.join(before), ''.join(after) if kept is after else None
 
 class MessageBuilder(object):
     """Creates the components needed to send emails and other notifications"""
@@ -651,6 +2633,7 @@ class MessageBuilder(object):
         self.commit = commit
         self.checker = checker
         self.keywords = defaultdict(list)
+        self.parsed = CommitKeywords()
         self.include_url = include_url
 
         # Generate directories affected by the commit
@@ -659,6 +2642,7 @@ class MessageBuilder(object):
 
     def address_header(self, name, email):
         """Helper function to construct an address header for emails - as Python stuffs it up"""
+        MIMEText, Header = email_classes()
         fixed_name = Header( name ).encode()
         return unicode("{0} <{1}>").format(fixed_name, email)
 
@@ -733,54 +2717,21 @@ class MessageBuilder(object):
         """Parse special keywords in commits to determine further post-commit
         actions."""
 
-        split = dict()
-        split['email_cc']  = re.compile("^\s*CC[-_]?MAIL[:=]\s*(.*)")
-        split['email_cc2'] = re.compile("^\s*C[Cc][:=]\s*(.*)")
-        split['fixed_in']  = re.compile("^\s*FIXED[-_]?IN[:=]\s*(.*)")
-
-        numeric = dict()
-        numeric['bug_fixed'] = re.compile("^\s*(?:BUGS?|FEATURE)[:=]\s*(.+)")
-        numeric['bug_cc']    = re.compile("^\s*CCBUGS?[:=]\s*(.+)")
-
-        presence = dict()
-        presence['email_gui'] = re.compile("^\s*GUI:")
-        presence['silent']    = re.compile("(?:CVS|SVN|GIT|SCM).?SILENT")
-        presence['notes']     = re.compile("(?:Notes added by 'git notes add'|Notes removed by 'git notes remove')")
-
-        results = defaultdict(list)
-        for line in self.commit.message.split("\n"):
-            # If our line starts with Summary: (as it does when using Arcanist's default template) then strip this off
-            # This allows for people to fill keywords in the Differential Summary and have this work smoothly for them
-            line = re.sub("^Summary: (.+)", "\g<1>", line)
-
-            # Start processing our keywords...
-            for (name, regex) in split.iteritems():
-                match = re.match( regex, line )
-                if match:
-                    results[name] += [result.strip() for result in match.group(1).split(",")]
-
-            for (name, regex) in numeric.iteritems():
-                match = re.match( regex, line )
-                if match:
-                    results[name] += re.findall("(\d{1,10})", match.group(1))
-
-            for (name, regex) in presence.iteritems():
-                if re.match( regex, line ):
-                    results[name] = True
-
-        self.keywords = results
+        self.parsed = CommitKeywords.scan( self.commit.message )
+        self.keywords = self.parsed.as_dict()
 
 class CiaNotifier(object):
     "Notifies CIA of changes to a repository"
 
-    MESSAGE = E.message
-    GENERATOR = E.generator
-    SOURCE = E.source
-    TIMESTAMP = E.timestamp
-    BODY = E.body
-    COMMIT = E.commit
+    def __init__(self, repository, transport = None):
+        from lxml.builder import E
 
-    def __init__(self, repository):
+        self.MESSAGE = E.message
+        self.GENERATOR = E.generator
+        self.SOURCE = E.source
+        self.TIMESTAMP = E.timestamp
+        self.BODY = E.body
+        self.COMMIT = E.commit
 
         # Generate the non-variant part of the XML message sent to CIA.
         name = E.name("KDE CIA Python client")
@@ -789,17 +2740,16 @@ class CiaNotifier(object):
         self._generator = self.GENERATOR(name, version, url)
 
         self.repository = repository
-        self.smtp = smtplib.SMTP()
-        self.smtp.connect()
-
-    def __del__(self):
-        self.smtp.quit()
+        self.transport = transport or open_transport()
 
     def notify(self, builder):
 
         """Send the commmit notification to CIA.
 
         The message is created incrementally using lxml's "E" builder."""
+        import lxml.etree as etree
+        from lxml.builder import E
+        MIMEText, Header = email_classes()
 
         # Build the <files> section for the template...
         commit = builder.commit
@@ -846,215 +2796,600 @@ class CiaNotifier(object):
         message['To'] = "commits@platna.kde.org"
 
         # Send email...
-        self.smtp.sendmail("sysadmin@kde.org", ["commits@platna.kde.org"],
-                           message.as_string())
+        self.transport.send("sysadmin@kde.org", ["commits@platna.kde.org"],
+                            message.as_string())
 
-class Commit(object):
+class FileChanges(object):
 
-    """Represents a git commit"""
+    """The files changed by a commit, in order of their name
 
-    UrlPattern = "https://commits.kde.org/{0}/{1}"
+    Behaves as a read only mapping from each (decoded) filename to the details of how it
+    changed. The details are stored in a tuple per field, with an entry for each file, rather
+    than a dictionary per file, so that large pushes don't spend their memory on overhead."""
 
-    def __init__(self, repository, commit_data):
-        self.repository = repository
-        self._commit_data = commit_data
-        self._raw_properties = ["files_changed", "datetime"]
-        self.url = Commit.UrlPattern.format( repository.path, self.sha1 )
+    __slots__ = ["filenames", "fields", "index"]
 
-        # Convert the date into something usable...
-        self._commit_data["datetime"] = datetime.fromtimestamp( float(self._commit_data["date"]) )
+    Fields = ["change", "added", "removed", "old_blob", "blob", "similarity", "source"]
 
-    def __getattr__(self, key):
-        if key not in self._commit_data:
-            raise AttributeError
-        if key in self._raw_properties:
-            return self._commit_data[key]
+    def __init__(self, changes):
+        "Takes a list of (filename, details) pairs, filenames being UTF-8 encoded and details a dictionary"
+        self.filenames = tuple( unicode(filename, "utf-8", "replace") for filename, data in changes )
+        self.fields = tuple( tuple( data.get(field) for filename, data in changes ) for field in self.Fields )
+        self.index = None
 
-        value = self._commit_data[key]
-        return unicode(value, "utf-8", 'replace')
+    def position(self, filename):
+        if self.index is None:
+            self.index = dict( (name, position) for position, name in enumerate(self.filenames) )
+        return self.index[filename]
 
-    def __setattr__(self, key, value):
-        if key not in ['_commit_data', '_raw_properties', 'repository']:
-            self._commit_data[key] = value
-        else:
-            self.__dict__[key] = value
+    def __getitem__(self, filename):
+        return FileChange(self, self.position(filename))
 
-    def __repr__(self):
-        return str(self._commit_data)
+    def get(self, filename, default = None):
+        return self[filename] if filename in self else default
 
-class CommitChecker(object):
+    def __contains__(self, filename):
+        try:
+            self.position(filename)
+        except KeyError:
+            return False
+        return True
 
-    """Checker class for commit information such as licenses, or potentially
-    unsafe practices."""
+    def __iter__(self):
+        return iter(self.filenames)
 
-    @property
-    def license_problem(self):
-        return self._license_problem
+    def __len__(self):
+        return len(self.filenames)
 
-    @property
-    def commit_problem(self):
-        return self._commit_problem
+    def keys(self):
+        return list(self.filenames)
 
-    @property
-    def commit_notes(self):
-        return self._commit_notes
+    iterkeys = __iter__
 
-    def check_commit_license(self, filename, text):
-        problemfile = False
-        gl = qte = license = wrong = ""
-        text = re.sub("^\#", "", text)
-        text = re.sub("\t\n\r", "   ", text)
-        text = re.sub("[^ A-Za-z.@0-9]", "", text)
-        text = re.sub("\s+", " ", text)
+    def itervalues(self):
+        for position in range(len(self.filenames)):
+            yield FileChange(self, position)
 
-        if re.search("version 2(?:\.0)? .{0,40}as published by the Free Software Foundation", text):
-            gl = " (v2)"
+    def values(self):
+        return list(self.itervalues())
 
-        if re.search("version 2(?:\.0)? of the License", text):
-            gl = " (v2)"
+    def iteritems(self):
+        for position, filename in enumerate(self.filenames):
+            yield filename, FileChange(self, position)
 
-        if re.search("version 3(?:\.0)? .{0,40}as published by the Free Software Foundation", text):
-            gl = " (v3)"
+    def items(self):
+        return list(self.iteritems())
 
-        if re.search("either version 2(?: of the License)? or at your option any later version", text):
-            gl = " (v2+)"
+class FileChange(object):
 
-        if re.search("version 2(?: of the License)? or at your option version 3", text):
-            gl = " (v2/3)"
+    """The details of how a file changed, as a read only mapping holding whichever of
+    change, added, removed, old_blob, blob, similarity and source are known"""
 
-        if re.search("version 2(?: of the License)? or at your option version 3 or at the discretion of KDE e.V.{10,60}any later version", text):
-            gl = " (v2/3+eV)"
+    __slots__ = ["changes", "position"]
 
-        if re.search("either version 3(?: of the License)? or at your option any later version", text):
-            gl = " (v3+)"
+    def __init__(self, changes, position):
+        self.changes = changes
+        self.position = position
 
-        if re.search("version 2\.1 as published by the Free Software Foundation", text):
-            gl = " (v2.1)"
+    def __getitem__(self, field):
+        try:
+            value = self.changes.fields[ FileChanges.Fields.index(field) ][ self.position ]
+        except ValueError:
+            raise KeyError(field)
+        if value is None:
+            raise KeyError(field)
+        return value
 
-        if re.search("2\.1 available at: http:\/\/www.fsf.org\/copyleft\/lesser.html", text):
-            gl = " (v2.1)"
+    def get(self, field, default = None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
 
-        if re.search("either version 2\.1 of the License or at your option any later version", text):
-            gl = " (v2.1+)"
+    def __contains__(self, field):
+        return self.get(field) is not None
 
-        if re.search("([Pp]ermission is given|[pP]ermission is also granted|[pP]ermission) to link (the code of )?this program with (any edition of )?(Qt|the Qt library)", text):
+    def keys(self):
+        return [field for field, values in zip(FileChanges.Fields, self.changes.fields) if values[self.position] is not None]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(field, self[field]) for field in self]
+
+class Commit(object):
+
+    """Represents a git commit"""
+
+    UrlPattern = "https://commits.kde.org/{0}/{1}"
+
+    # Fields as extracted from git, which are decoded once when the commit is created
+    TextFields = ["sha1", "parents", "author_name", "author_email", "date", "committer_name", "committer_email", "description", "message"]
+
+    __slots__ = TextFields + ["repository", "files_changed", "datetime", "url"]
+
+    def __init__(self, repository, commit_data):
+        self.repository = repository
+        for field in self.TextFields:
+            setattr(self, field, unicode(commit_data[field], "utf-8", 'replace'))
+        self.files_changed = commit_data["files_changed"]
+        self.url = unicode( Commit.UrlPattern.format(repository.virtual_path, self.sha1), "utf-8", 'replace' )
+
+        # Convert the date into something usable...
+        self.datetime = datetime.fromtimestamp( float(commit_data["date"]) )
+
+    def __repr__(self):
+        return repr( dict((field, getattr(self, field)) for field in self.__slots__ if field != "repository") )
+
+class SpdxExpression(object):
+
+    """A parsed SPDX license expression, such as "LGPL-2.1-only OR LGPL-3.0-only OR LicenseRef-KDE-Accepted-LGPL"
+
+    Expressions are made of license identifiers, optionally followed by WITH and an
+    exception, combined using AND and OR (AND binding tighter) and grouped by parentheses."""
+
+    # The tag itself, following whatever comment syntax the file uses
+    TagLine = re.compile(r"^\+?[\s/*#;%!<{}'\"-]*SPDX-License-Identifier:\s*(.+?)\s*(?:\*/|-->|#}|-}|\*\))?\s*$")
+    Token = re.compile(r"\s*(\(|\)|[A-Za-z0-9.+:-]+)")
+    Operators = ["AND", "OR", "WITH"]
+
+    # Identifiers which have been superseded by the -only and -or-later forms
+    Deprecated = {
+        "GPL-2.0": "GPL-2.0-only", "GPL-2.0+": "GPL-2.0-or-later",
+        "GPL-3.0": "GPL-3.0-only", "GPL-3.0+": "GPL-3.0-or-later",
+        "LGPL-2.0": "LGPL-2.0-only", "LGPL-2.0+": "LGPL-2.0-or-later",
+        "LGPL-2.1": "LGPL-2.1-only", "LGPL-2.1+": "LGPL-2.1-or-later",
+        "LGPL-3.0": "LGPL-3.0-only", "LGPL-3.0+": "LGPL-3.0-or-later",
+    }
+
+    # Labels for the licenses accepted under the KDE Licensing Policy
+    Labels = {
+        "LGPL-2.0-only": "LGPL(v2.0)", "LGPL-2.0-or-later": "LGPL(v2.0+)",
+        "LGPL-2.1-only": "LGPL(v2.1)", "LGPL-2.1-or-later": "LGPL(v2.1+)",
+        "LGPL-3.0-only": "LGPL(v3.0)", "LGPL-3.0-or-later": "LGPL(v3.0+)",
+        "GPL-2.0-only": "GPL(v2.0)", "GPL-2.0-or-later": "GPL(v2.0+)",
+        "GPL-3.0-only": "GPL(v3.0)", "GPL-3.0-or-later": "GPL(v3.0+)",
+        "MIT": "MIT", "BSD-2-Clause": "BSD", "BSD-3-Clause": "BSD",
+        "CC0-1.0": "CC0", "BSL-1.0": "Boost", "MPL-2.0": "MPL 2.0",
+        "GFDL-1.2-or-later": "GFDL(v1.2+)", "CC-BY-4.0": "CC-BY", "CC-BY-SA-4.0": "CC-BY-SA",
+        "LicenseRef-Qt-Commercial": "Qt Commercial",
+    }
+
+    # Combinations known by their own label
+    Combinations = {
+        ("LGPL-2.0-only", "LGPL-3.0-only", "LicenseRef-KDE-Accepted-LGPL"): "LGPL(v2.0/3+eV)",
+        ("LGPL-2.1-only", "LGPL-3.0-only", "LicenseRef-KDE-Accepted-LGPL"): "LGPL(v2.1/3+eV)",
+        ("GPL-2.0-only", "GPL-3.0-only"): "GPL(v2/3)",
+        ("GPL-2.0-only", "GPL-3.0-only", "LicenseRef-KDE-Accepted-GPL"): "GPL(v2/3+eV)",
+    }
+
+    def __init__(self, operator, operands):
+        self.operator = operator
+        self.operands = operands
+
+    @classmethod
+    def parse(cls, text):
+        "Parses the given expression, raising ValueError if it isn't valid"
+        tokens = list()
+        position = 0
+        text = text.strip()
+        while position < len(text):
+            token = cls.Token.match(text, position)
+            if not token:
+                raise ValueError("Unexpected character in SPDX expression: " + text[position:])
+            value = token.group(1)
+            if value.upper() in cls.Operators:
+                value = value.upper()
+            tokens.append(value)
+            position = token.end()
+
+        # Tokens are consumed from the end
+        tokens.reverse()
+        expression = cls.parse_or(tokens)
+        if tokens:
+            raise ValueError("Unexpected " + tokens[-1] + " in SPDX expression")
+        return expression
+
+    @classmethod
+    def parse_or(cls, tokens):
+        operands = [cls.parse_and(tokens)]
+        while tokens and tokens[-1] == "OR":
+            tokens.pop()
+            operands.append( cls.parse_and(tokens) )
+        return operands[0] if len(operands) == 1 else cls("OR", operands)
+
+    @classmethod
+    def parse_and(cls, tokens):
+        operands = [cls.parse_license(tokens)]
+        while tokens and tokens[-1] == "AND":
+            tokens.pop()
+            operands.append( cls.parse_license(tokens) )
+        return operands[0] if len(operands) == 1 else cls("AND", operands)
+
+    @classmethod
+    def parse_license(cls, tokens):
+        if not tokens:
+            raise ValueError("SPDX expression ends unexpectedly")
+
+        token = tokens.pop()
+        if token == "(":
+            expression = cls.parse_or(tokens)
+            if not tokens or tokens.pop() != ")":
+                raise ValueError("Unbalanced parentheses in SPDX expression")
+            return expression
+        if token in cls.Operators or token == ")":
+            raise ValueError("Unexpected " + token + " in SPDX expression")
+
+        license = cls(None, [cls.Deprecated.get(token, token)])
+        if tokens and tokens[-1] == "WITH":
+            tokens.pop()
+            if not tokens or tokens[-1] in cls.Operators or tokens[-1] in ["(", ")"]:
+                raise ValueError("WITH must be followed by an exception")
+            license = cls("WITH", [license, tokens.pop()])
+        return license
+
+    @property
+    def licenses(self):
+        "All of the license identifiers used by the expression"
+        if self.operator is None:
+            return [self.operands[0]]
+        if self.operator == "WITH":
+            return self.operands[0].licenses
+        return [license for operand in self.operands for license in operand.licenses]
+
+    @property
+    def accepted(self):
+        "Whether all of the licenses used are acceptable"
+        return all(license in self.Labels or license.startswith("LicenseRef-KDE-") for license in self.licenses)
+
+    @property
+    def label(self):
+        if self.operator is None:
+            return self.Labels.get(self.operands[0], self.operands[0])
+        if self.operator == "WITH":
+            return self.operands[0].label + " WITH " + self.operands[1]
+
+        if self.operator == "OR" and all(operand.operator is None for operand in self.operands):
+            combination = tuple(sorted(operand.operands[0] for operand in self.operands))
+            if combination in self.Combinations:
+                return self.Combinations[combination]
+
+        labels = list()
+        for operand in self.operands:
+            if operand.operator in ["AND", "OR"]:
+                labels.append( "(" + operand.label + ")" )
+            else:
+                labels.append( operand.label )
+        return (" " + self.operator + " ").join(labels)
+
+class LicenseClassifier(object):
+
+    """Determines the license of a newly added file from its contents
+
+    Files carrying a SPDX-License-Identifier tag near their start are classified from
+    the tag alone. For all other files the license header is looked for: rather than searching for every signature in turn, the text is checked for the
+    distinctive phrase (anchor) of each signature, and only those signatures whose anchor
+    is present are then searched for. The labels produced are the same as those of the
+    original checks, which benchmarks/license_classifier.py verifies."""
+
+    # Change this whenever the signatures (or the lines given to them) change, so previously cached verdicts are ignored
+    Version = "3"
+
+    # How many lines at the start of a file are looked at for a SPDX tag
+    SpdxLines = 30
+
+    # Name, expression, flags and the anchors - phrases one of which any match must contain
+    Signatures = [
+        ("version-2",              r"version 2(?:\.0)? .{0,40}as published by the Free Software Foundation", 0, ["as published by the Free Software Foundation"]),
+        ("version-2-license",      r"version 2(?:\.0)? of the License", 0, ["of the License"]),
+        ("version-3",              r"version 3(?:\.0)? .{0,40}as published by the Free Software Foundation", 0, ["as published by the Free Software Foundation"]),
+        ("version-2-later",        r"either version 2(?: of the License)? or at your option any later version", 0, ["or at your option any later version"]),
+        ("version-2-3",            r"version 2(?: of the License)? or at your option version 3", 0, ["or at your option version 3"]),
+        ("version-2-3-ev",         r"version 2(?: of the License)? or at your option version 3 or at the discretion of KDE e.V.{10,60}any later version", 0, ["at the discretion of KDE e"]),
+        ("version-3-later",        r"either version 3(?: of the License)? or at your option any later version", 0, ["or at your option any later version"]),
+        ("version-2.1",            r"version 2\.1 as published by the Free Software Foundation", 0, ["as published by the Free Software Foundation"]),
+        ("version-2.1-url",        r"2\.1 available at: http:\/\/www.fsf.org\/copyleft\/lesser.html", 0, ["available at: http"]),
+        ("version-2.1-later",      r"either version 2\.1 of the License or at your option any later version", 0, ["or at your option any later version"]),
+        ("qt-exception",           r"([Pp]ermission is given|[pP]ermission is also granted|[pP]ermission) to link (the code of )?this program with (any edition of )?(Qt|the Qt library)", 0, ["to link"]),
+        ("wrong-address",          r"(?:675 Mass Ave|59 Temple Place|Suite 330|51 Franklin Steet|02139|02111-1307)", re.IGNORECASE, ["675 Mass Ave", "59 Temple Place", "Suite 330", "51 Franklin Steet", "02139", "02111-1307"]),
+        ("lgpl-gnu-lesser",        r"under (the (terms|conditions) of )?the GNU (Library|Lesser) General Public License", 0, ["General Public License"]),
+        ("lgpl-lesser-gnu",        r"under (the (terms|conditions) of )?the (Library|Lesser) GNU General Public License", 0, ["GNU General Public License"]),
+        ("lgpl-short",             r"under (the (terms|conditions) of )?the (GNU )?LGPL", 0, ["LGPL"]),
+        ("lgpl-fsf",               r"[Tt]he LGPL as published by the Free Software Foundation", 0, ["LGPL as published by the Free Software Foundation"]),
+        ("lgpl-clarification",     r"LGPL with the following explicit clarification", 0, ["LGPL with the following explicit clarification"]),
+        ("gpl",                    r"under (the terms of )?(version 2 of )?the GNU (General Public License|GENERAL PUBLIC LICENSE)", 0, ["General Public License"]),
+        ("qpl",                    r"may be distributed under the terms of the Q Public License as defined by Trolltech AS", 0, ["Q Public License"]),
+        ("x11",                    r"Permission is hereby granted free of charge to any person obtaining a copy of this software and associated documentation files", 0, ["Permission is hereby granted free of charge"]),
+        ("mit",                    r"Permission to use copy modify (and )?distribute(and sell)? this software and its documentation for any purpose", 0, ["Permission to use copy modify"]),
+        ("bsd",                    r"MERCHANTABILITY( AND|| or) FITNESS FOR A PARTICULAR PURPOSE", 0, ["FITNESS FOR A PARTICULAR PURPOSE"]),
+        ("mpl-1.1",                r"subject to the Mozilla Public License Version 1.1", 0, ["Mozilla Public License Version 1"]),
+        ("mpl-1.0",                r"Mozilla Public License Version 1\.0/", 0, ["Mozilla Public License Version 1"]),
+        ("artistic",               r"under the Artistic License", 0, ["under the Artistic License"]),
+        ("public-domain",          r"Public Domain", re.IGNORECASE, ["Public Domain"]),
+        ("public-domain-disclaim", r" disclaims [Cc]opyright", 0, [" disclaims "]),
+        ("generated",              r"(All changes made in this file will be lost|This file is automatically generated|DO NOT EDIT|DO NOT delete this file|[Gg]enerated by|uicgenerated|produced by gperf)", 0,
+                                   ["All changes made in this file will be lost", "This file is automatically generated", "DO NOT EDIT", "DO NOT delete this file", "enerated by", "uicgenerated", "produced by gperf"]),
+        ("provided",               r"This (software|package)( is free software and)? is provided ", re.IGNORECASE, [" is provided "]),
+    ]
+
+    # The versions of the GPL and LGPL - where several are found the last one listed wins
+    Versions = [
+        ("version-2", " (v2)"), ("version-2-license", " (v2)"), ("version-3", " (v3)"),
+        ("version-2-later", " (v2+)"), ("version-2-3", " (v2/3)"), ("version-2-3-ev", " (v2/3+eV)"),
+        ("version-3-later", " (v3+)"), ("version-2.1", " (v2.1)"), ("version-2.1-url", " (v2.1)"),
+        ("version-2.1-later", " (v2.1+)"),
+    ]
+
+    # Everything other than these characters is removed when normalizing
+    Retained = " ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz.@0123456789"
+
+    Compiled = None
+
+    def __init__(self):
+        # Anchors are looked for regardless of case, as some signatures ignore it
+        self.signatures = [(name, re.compile(expression, flags), [anchor.lower() for anchor in anchors])
+                           for name, expression, flags, anchors in self.Signatures]
+        self.anchors = set( anchor for name, expression, anchors in self.signatures for anchor in anchors )
+
+        self.removed = ''.join( chr(code) for code in range(128) if chr(code) not in self.Retained )
+        self.spaces = re.compile(" {2,}")
+
+    @classmethod
+    def compiled(cls):
+        "Returns the shared classifier, compiling the signatures on first use"
+        if cls.Compiled is None:
+            cls.Compiled = cls()
+        return cls.Compiled
+
+    def normalize(self, text):
+        "Reduces the text to letters, digits, dots, @ and single spaces"
+        if text.startswith("#"):
+            text = text[1:]
+        text = text.replace("\t\n\r", "   ")
+        # Everything outside of ASCII is removed anyway, so it can be dropped up front
+        if isinstance(text, unicode):
+            text = text.encode("ascii", "ignore")
+        text = text.translate(None, self.removed)
+        return self.spaces.sub(" ", text)
+
+    def match(self, text):
+        "Returns the names of the signatures found in the given normalized text"
+        lowered = text.lower()
+        found = set( anchor for anchor in self.anchors if anchor in lowered )
+
+        matched = set()
+        for name, expression, anchors in self.signatures:
+            if any(anchor in found for anchor in anchors) and expression.search(text):
+                matched.add(name)
+        return matched
+
+    def spdx(self, lines):
+        "Returns the SPDX expression declared by the start of the file, or None if there isn't one"
+        declared = list()
+        for line in itertools.islice(lines, self.SpdxLines):
+            if "SPDX-License-Identifier" not in line:
+                continue
+            tag = SpdxExpression.TagLine.match(line)
+            if tag:
+                declared.append( tag.group(1) )
+
+        if not declared:
+            return None
+
+        # Several tags all apply to the file
+        try:
+            if len(declared) == 1:
+                return SpdxExpression.parse( declared[0] )
+            return SpdxExpression.parse( ' AND '.join("(" + expression + ")" for expression in declared) )
+        except ValueError:
+            return None
+
+    def classify(self, lines):
+        "Returns the license label for a file with the given (added) lines, and whether it is a problem"
+        expression = self.spdx(lines)
+        if expression is not None:
+            return expression.label, not expression.accepted
+
+        text = self.normalize( ''.join(lines) )
+        matched = self.match(text)
+
+        problem = False
+        gl = qte = license = wrong = ""
+        for name, label in self.Versions:
+            if name in matched:
+                gl = label
+
+        if "qt-exception" in matched:
             qte = " (+Qt exception)"
 
         # Check for an old FSF address
         # MIT licenses will trigger the check too, as "675 Mass Ave" is MIT's address
-        if re.search("(?:675 Mass Ave|59 Temple Place|Suite 330|51 Franklin Steet|02139|02111-1307)", text, re.IGNORECASE):
+        if "wrong-address" in matched:
             # "51 Franklin Street, Fifth Floor, Boston, MA 02110-1301" is the right FSF address
             wrong = " (wrong address)"
-            self._license_problem = True
-            problemfile = True
+            problem = True
 
         # traditional license header LGPL or GPL
-        if re.search("under (the (terms|conditions) of )?the GNU (Library|Lesser) General Public License", text):
-            license = "LGPL" + gl + wrong + " " + license
-
-        if re.search("under (the (terms|conditions) of )?the (Library|Lesser) GNU General Public License", text):
-            license = "LGPL" + gl + wrong + " " + license
-
-        if re.search("under (the (terms|conditions) of )?the (GNU )?LGPL", text):
-            license = "LGPL" + gl + wrong + " " + license
+        for name in ["lgpl-gnu-lesser", "lgpl-lesser-gnu", "lgpl-short", "lgpl-fsf", "lgpl-clarification"]:
+            if name in matched:
+                license = "LGPL" + gl + wrong + " " + license
 
-        if re.search("[Tt]he LGPL as published by the Free Software Foundation", text):
-            license = "LGPL" + gl + wrong + " " + license
-
-        if re.search("LGPL with the following explicit clarification", text):
-            license = "LGPL" + gl + wrong + " " + license
-
-        if re.search("under (the terms of )?(version 2 of )?the GNU (General Public License|GENERAL PUBLIC LICENSE)", text):
+        if "gpl" in matched:
             license = "GPL" + gl + qte + wrong + " " + license
 
-        # SPDX based LGPL or GPL
-        # TODO first version for SPDX based license hooks: this only detects simple statements, shall be extended for full SPDX expressions
-        if re.search("SPDX-License-Identifier: LGPL-2.0-only", text):
-            license = "LGPL(v2.0) " + wrong + " " + license
-        if re.search("SPDX-License-Identifier: LGPL-2.0-or-later", text):
-            license = "LGPL(v2.0+) " + wrong + " " + license
-        if re.search("SPDX-License-Identifier: LGPL-2.1-only", text):
-            license = "LGPL(v2.1) " + wrong + " " + license
-        if re.search("SPDX-License-Identifier: LGPL-2.1-or-later", text):
-            license = "LGPL(v2.1+) " + wrong + " " + license
-        if re.search("SPDX-License-Identifier: LGPL-3.0-only", text):
-            license = "LGPL(v3.0) " + wrong + " " + license
-        if re.search("SPDX-License-Identifier: LGPL-3.0-or-later", text):
-            license = "LGPL(v3.0+) " + wrong + " " + license
-        if re.search("SPDX-License-Identifier: LGPL-2.0-only OR LGPL-3.0-only OR LicenseRef-KDE-Accepted-LGPL", text):
-            license = "LGPL(v2.0/3+eV) " + wrong + " " + license
-        if re.search("SPDX-License-Identifier: LGPL-2.1-only OR LGPL-3.0-only OR LicenseRef-KDE-Accepted-LGPL", text):
-            license = "LGPL(v2.1/3+eV) " + wrong + " " + license
-        if re.search("SPDX-License-Identifier: GPL-2.0-only", text):
-            license = "GPL(v2.0) " + wrong + " " + license
-        if re.search("SPDX-License-Identifier: GPL-2.0-or-later", text):
-            license = "GPL(v2.0+) " + wrong + " " + license
-        if re.search("SPDX-License-Identifier: GPL-3.0-only", text):
-            license = "GPL(v3.0) " + wrong + " " + license
-        if re.search("SPDX-License-Identifier: GPL-2.0-only OR GPL-3.0-only", text):
-            license = "GPL(v2/3) " + wrong + " " + license
-        if re.search("SPDX-License-Identifier: GPL-2.0-only OR GPL-3.0-only OR LicenseRef-KDE-Accepted-GPL", text):
-            license = "GPL(v2/3+eV) " + wrong + " " + license
-
         # QPL
-        if re.search("may be distributed under the terms of the Q Public License as defined by Trolltech AS", text):
+        if "qpl" in matched:
             license = "QPL " + license
 
         # X11, BSD-like
-        if re.search("Permission is hereby granted free of charge to any person obtaining a copy of this software and associated documentation files", text):
+        if "x11" in matched:
             license = "X11 (BSD like) " + license
 
         # MIT license
-        if re.search("Permission to use copy modify (and )?distribute(and sell)? this software and its documentation for any purpose", text):
+        if "mit" in matched:
             license = "MIT " + license
-        if re.search("SPDX-License-Identifier: MIT", text):
-            license = "MIT " + wrong + " " + license
 
         # BSD
-        if re.search("MERCHANTABILITY( AND|| or) FITNESS FOR A PARTICULAR PURPOSE", text) and not re.search("GPL", license):
+        if "bsd" in matched and not "GPL" in license:
             license = "BSD " + license
-        if re.search("SPDX-License-Identifier: BSD-2-Clause", text) or re.search("SPDX-License-Identifier: BSD-3-Clause", text):
-            license = "BSD " + wrong + " " + license
 
         # MPL
-        if re.search("subject to the Mozilla Public License Version 1.1", text):
+        if "mpl-1.1" in matched:
             license = "MPL 1.1 " + license
-
-        if re.search("Mozilla Public License Version 1\.0/", text):
+        if "mpl-1.0" in matched:
             license = "MPL 1.0 " + license
 
         # Artistic license
-        if re.search("under the Artistic License", text):
+        if "artistic" in matched:
             license = "Artistic " + license
 
         # Public domain
-        if re.search("Public Domain", text, re.IGNORECASE) or re.search(" disclaims [Cc]opyright", text):
+        if "public-domain" in matched or "public-domain-disclaim" in matched:
             license = "Public Domain " + license
 
         # Auto-generated
-        if re.search("(All changes made in this file will be lost|This file is automatically generated|DO NOT EDIT|DO NOT delete this file|[Gg]enerated by|uicgenerated|produced by gperf)", text):
+        if "generated" in matched:
             license = "GENERATED FILE"
-            self._license_problem = True
-            problemfile = True
+            problem = True
 
         # Don't bother with trivial files.
         if not license and len(text) < 128:
             license = "Trivial file"
 
         # About every license has this clause; but we've failed to detect which type it is.
-        if not license and re.search("This (software|package)( is free software and)? is provided ",
-                                     text, re.IGNORECASE):
+        if not license and "provided" in matched:
             license = "Unknown license"
-            self._license_problem = True
-            problemfile = True
+            problem = True
 
         # Either a missing or an unsupported license
         if not license:
             license = "UNKNOWN"
-            self._license_problem = True
-            problemfile = True
+            problem = True
+
+        return license.strip(), problem
+
+class DiffRule(object):
+
+    """A check made against each line added to files of a certain type
 
-        license = license.strip()
+    The expression is searched for in the added line (without its diff prefix), and
+    for each match the note is added to the file, formatted with the groups of the match."""
+
+    def __init__(self, name, filenames, expression, note):
+        self.name = name
+        self.filenames = re.compile(filenames)
+        self.expression = re.compile(expression)
+        self.note = note
+
+class DiffRuleSet(object):
+
+    """The rules which apply to a type of file, combined into a single expression so
+    each added line which none of them match (nearly all of them) is only scanned once
+
+    The match of one rule can overlap, and so hide, the match of another, so the
+    rules are searched for one at a time in the lines the combined expression matches."""
+
+    def __init__(self, rules):
+        self.rules = rules
+        combined = '|'.join( "(?:{0})".format(rule.expression.pattern) for rule in rules )
+        self.expression = re.compile(combined) if rules else None
+
+    def check(self, line):
+        "Returns the notes for the given added line, one for each rule it matches"
+        if self.expression is None or not self.expression.search(line):
+            return []
+
+        notes = list()
+        for rule in self.rules:
+            match = rule.expression.search(line)
+            if match:
+                notes.append( rule.note.format(*match.groups()) )
+        return notes
+
+class CommitChecker(object):
+
+    """Checker class for commit information such as licenses, or potentially
+    unsafe practices."""
+
+    # Source files, whose license is checked when they are added
+    SourceFiles = r"\.(cpp|cc|cxx|C|c\+\+|c|l|y||h|H|hh|hxx|hpp|h\+\+|qml)$"
+
+    # Checks made against the lines added to each file
+    Rules = [
+        DiffRule("unsafe-kde-api", r"\.(cpp|cc|cxx|C|c\+\+|c|l|y|h|H|hh|hxx|hpp|h\+\+|qml)$",
+                 r"\b(KRun::runCommand|K3?ShellProcess|setUseShell|setShellCommand)\b\s*[\(\r\n]", "[POSSIBLY UNSAFE: {0}] **"),
+        DiffRule("unsafe-libc", r"\.(cpp|cc|cxx|C|c\+\+|c|l|y|h|H|hh|hxx|hpp|h\+\+|qml)$",
+                 r"\b(system|popen|mktemp|mkstemp|tmpnam|gets|syslog|strptime)\b\s*[\(\r\n]", "[POSSIBLY UNSAFE: {0}] **"),
+        DiffRule("unsafe-scanf", r"\.(cpp|cc|cxx|C|c\+\+|c|l|y|h|H|hh|hxx|hpp|h\+\+|qml)$",
+                 r"(scanf)\b\s*[\(\r\n]", "[POSSIBLY UNSAFE: {0}] **"),
+        # Trailing spaces on the value of a key, outside of comments, break .desktop files
+        DiffRule("desktop-trailing-space", r"\.desktop$",
+                 r"^(?!#)(?=.*[^=]=).*[ \t]$", "[TRAILING SPACE] **"),
+    ]
+
+    # Rule sets, by the rules which make them up
+    Compiled = dict()
+
+    def __init__(self):
+        self._license_verdicts = dict()
+        self._license_cache = VerdictCache("licenses-" + LicenseClassifier.Version)
+        # Verdicts not in the cache yet, which are stored together once the push has been checked
+        self._license_classified = dict()
+        self._rule_sets = dict()
+
+    def rules_for(self, filename):
+        "Returns the set of rules applying to the given file"
+        if filename not in self._rule_sets:
+            applicable = tuple( rule for rule in self.Rules if rule.filenames.search(filename) )
+            if applicable not in CommitChecker.Compiled:
+                CommitChecker.Compiled[applicable] = DiffRuleSet( list(applicable) )
+            self._rule_sets[filename] = CommitChecker.Compiled[applicable]
+        return self._rule_sets[filename]
+
+    @property
+    def license_problem(self):
+        return self._license_problem
+
+    @property
+    def commit_problem(self):
+        return self._commit_problem
+
+    @property
+    def commit_notes(self):
+        return self._commit_notes
+
+    def load_license_verdicts(self, blobs):
+        "Looks up the cached verdicts of the given blobs which haven't been seen yet, all at once"
+        wanted = set( blob for blob in blobs if blob and blob not in self._license_verdicts )
+        if not wanted:
+            return
+
+        for blob, cached in self._license_cache.get_many(wanted).iteritems():
+            self._license_verdicts[blob] = tuple( json.loads(cached) )
+
+    def store_license_verdicts(self):
+        "Stores the verdicts determined since this was last called in the cache, all at once"
+        self._license_cache.put_many( dict( (blob, json.dumps(verdict)) for blob, verdict in self._license_classified.iteritems() ) )
+        self._license_classified = dict()
+
+    def check_commit_license(self, filename, lines, blob = None):
+        # The license of a blob never changes, so it only needs to be determined once
+        # The lines are those of the blob alone, so it gets the same verdict whatever its path is
+        verdict = self._license_verdicts.get(blob) if blob else None
+        if verdict is None:
+            with Metrics.stage("license"):
+                verdict = LicenseClassifier.compiled().classify(lines)
+            if blob:
+                self._license_verdicts[blob] = verdict
+                self._license_classified[blob] = verdict
+
+        license, problemfile = verdict
+        if problemfile:
+            self._license_problem = True
 
         if license:
                 self._commit_notes[filename].append( (" "*4) + "[License: " + license + "]")
@@ -1070,50 +3405,264 @@ class CommitChecker(object):
         self._commit_problem = False
         self._commit_notes = defaultdict(list)
 
-        # Unsafe regex checks...
-        unsafe_matches = list()
-        unsafe_matches.append( r"\b(KRun::runCommand|K3?ShellProcess|setUseShell|setShellCommand)\b\s*[\(\r\n]" )
-        unsafe_matches.append( r"\b(system|popen|mktemp|mkstemp|tmpnam|gets|syslog|strptime)\b\s*[\(\r\n]" )
-        unsafe_matches.append( r"(scanf)\b\s*[\(\r\n]" )
-        valid_filename_regex = r"\.(cpp|cc|cxx|C|c\+\+|c|l|y||h|H|hh|hxx|hpp|h\+\+|qml)$"
+        # Only newly added source files have their license checked
+        def license_checked(filename):
+            return filename != "" and commit.files_changed[ filename ]["change"] in ['A'] and re.search(self.SourceFiles, filename)
+
+        self.load_license_verdicts( data.get("blob") for filename, data in commit.files_changed.iteritems() if license_checked(filename) )
 
         # Retrieve the diff and do the problem checks...
         filename = unicode("")
         filediff = list()
+        rules = self.rules_for(filename)
+        # Number of columns of +/- at the start of each line, or None when outside of a hunk
+        columns = None
         for line in diff:
             file_change = re.match( "^diff --(cc |git a\/.+ b\/)(.+)$", line )
             if file_change:
                 # Are we changing file? If so, we have the full diff, so do a license check....
-                if filename != "" and commit.files_changed[ filename ]["change"] in ['A'] and re.search(valid_filename_regex, filename):
-                    self.check_commit_license(filename, ''.join(filediff))
+                if license_checked(filename):
+                    self.check_commit_license(filename, filediff, commit.files_changed[ filename ].get("blob"))
 
                 filediff = list()
                 filename = file_change.group(2)
+                rules = self.rules_for(filename)
+                columns = None
                 continue
 
-            # Diff headers are bogus
-            if re.match("@@ -\d+,\d+ \+\d+ @@", line):
+            # Hunks of combined diffs (for merges) have a column for each parent
+            # Diff headers are bogus, and only the lines of the hunk itself are those of the file
+            if line.startswith("@@"):
+                columns = len(line) - len(line.lstrip("@")) - 1
                 filediff = list()
                 continue
 
-            # Do an incremental check for *.desktop syntax errors....
-            if re.search("\.desktop$", filename) and re.search("[^=]+=.*[ \t]$", line) and line.startswith("+") and not re.match("^\+#", line):
-                self._commit_notes[filename].append( "[TRAILING SPACE] **" )
-                self._commit_problem = True
-
-            # Check for things which are unsafe...
-            for safety_match in unsafe_matches:
-                match = re.match(safety_match, line)
-                if match:
-                    note = "[POSSIBLY UNSAFE: {0}] **".format( match.group(1) )
-                    self._commit_notes[filename].append(note)
-                    self._commit_problem = True
+            # Check the lines being added...
+            if columns:
+                prefix = line[:columns]
+                if "+" in prefix and "-" not in prefix:
+                    notes = rules.check( line[columns:] )
+                    if notes:
+                        self._commit_notes[filename].extend(notes)
+                        self._commit_problem = True
 
             # Store the diff....
             filediff.append(line)
 
-        if filename != "" and commit.files_changed[ filename ]["change"] in ['A'] and re.search(valid_filename_regex, filename):
-            self.check_commit_license(filename, ''.join(filediff))
+        if license_checked(filename):
+            self.check_commit_license(filename, filediff, commit.files_changed[ filename ].get("blob"))
+
+def determine_gitlab_repo_type( repository ):
+    """Redetermine the type of the repository
+
+    Because things are structured differently in a Gitlab world we need a different set of checks to determine the type of repository we have here"""
+
+    # Starting position is that repositories should be treated as if they are scratch (personal) repositories
+    repository.repo_type = RepoType.Scratch
+
+    # Is this potentially a mainline (kde/) repository?
+    mainlineRepository = re.match("^kde/(.+)$", repository.path)
+    if mainlineRepository:
+        repository.repo_type = RepoType.Normal
+        repository.path = mainlineRepository.group(1)
+
+    # Website live in the websites/ namespace
+    elif re.match("^websites/(.+)$", repository.path):
+        repository.repo_type = RepoType.Website
+
+    # Sysadmin repositories live in the sysadmin/ namespace
+    elif re.match("^sysadmin/(.+)$", repository.path):
+        repository.repo_type = RepoType.Sysadmin
+
+# For some checks, these only apply if the change is to a mainline repository, which is one of these types...
+PushSizeRestricted = [RepoType.Normal, RepoType.Website, RepoType.Sysadmin]
+
+# Notifications are only sent for repositories of these types, and never for pushes by these users
+NotifyAllowed = [RepoType.Normal, RepoType.Website, RepoType.Sysadmin]
+PostExceptions = ["scripty"]
+
+def check_ref_change( repository ):
+    """Check the change being made to a ref is permitted
+
+    Returns the lines of the message to give to the user if the change has to be declined, or an empty list otherwise"""
+
+    # Repository change checks...
+    if repository.ref_type == RefType.Backup:
+        return ["Pushing to backup refs is not supported for security reasons",
+                "Push declined - attempted repository integrity violation"]
+    elif repository.ref_type == RefType.MergeRequest:
+        return ["Pushing to merge requests directly is not permitted",
+                "Please make this change through Gitlab itself",
+                "Push declined - attempted repository integrity violation"]
+    elif repository.ref_type == RefType.Internal:
+        return ["Pushing to server maintained internal references is not permitted",
+                "Push declined - attempted repository integrity violation"]
+    elif repository.ref_type == RefType.Unknown:
+        return ["Sorry, but the ref you are trying to push to could not be recognised.",
+                "Only pushes to branches, tags and notes are permitted."]
+    elif repository.ref_name == "HEAD":
+        return ["Creating refs which conflict with internally used names is not permitted.",
+                "Push declined - attempted repository integrity violation"]
+    elif repository.change_type == ChangeType.Create and re.match("^origin/(.+)$", repository.ref_name):
+        return ["Creating refs starting with the name origin/ is not permitted.",
+                "This is usually caused by incorrectly pushing a branch or tag.",
+                "Please ensure your remote branch name does not contain 'origin/' at the beginning",
+                "Push declined - attempted repository integrity violation"]
+    if repository.ref_type == RefType.Tag and repository.change_type != ChangeType.Delete and repository.commit_type != "tag":
+        return ["Pushing an unannotated tag is not permitted.",
+                "Push declined - attempted repository integrity violation"]
+
+    policy = RepoPolicy.for_path( repository.management_directory, repository.path )
+
+    # Force pushes must be specially allowed
+    if repository.change_type == ChangeType.Forced and repository.repo_type in PushSizeRestricted and repository.ref_type is not RefType.WorkBranch and not policy.force_push:
+        return ["Force pushes to mainline KDE repositories is only permitted for specific situations.",
+                "Please contact the KDE Sysadmin team for further assistance"]
+
+    # New commits...
+    if repository.commit_count > 100 and not policy.bulk_notifications and repository.repo_type in PushSizeRestricted:
+        return ["More than 100 commits are being pushed",
+                "Push declined - excessive notifications would be sent",
+                "Please file a KDE Sysadmin ticket to continue"]
+
+    return []
+
+def audit_pushed_commits( repository ):
+    """Perform the audits applicable to the repository on the commits being pushed
+
+    Accepts either a Repository or a Push. Returns the CommitAuditor used."""
+
+    auditor = CommitAuditor( repository )
+    policy = RepoPolicy.for_path( repository.management_directory, repository.path )
+
+    # The commits are read from git once, and audited in batches as they arrive
+    # This bounds the memory used by huge pushes, while blobs and domains are still looked up in bulk
+    commits = repository.iter_commits()
+    while True:
+        with Metrics.stage("extract"):
+            batch = list( itertools.islice(commits, CommitAuditor.BatchSize) )
+        if not batch:
+            break
+
+        if not policy.skip_eol:
+            with Metrics.stage("audit_eol"):
+                auditor.audit_eol_blobs( batch )
+
+        if not policy.skip_filename:
+            with Metrics.stage("audit_filename"):
+                auditor.audit_filename( batch )
+
+        if not policy.skip_author_names:
+            with Metrics.stage("audit_names"):
+                auditor.audit_names_in_metadata( batch )
+
+        if not policy.skip_author_emails:
+            with Metrics.stage("audit_emails"):
+                auditor.audit_emails_in_metadata( batch )
+
+    with Metrics.stage("audit_hashes"):
+        if policy.blocked:
+            auditor.audit_hashes( policy.blocked_list, policy.blocked_index )
+
+        # Some commits are blocked everywhere
+        auditor.audit_hashes( policy.global_blocked_list, policy.global_blocked_index )
+
+    return auditor
+
+def sends_notifications( repository ):
+    "Whether process_accepted_change() will send notifications for the commits of the ref change"
+    policy = RepoPolicy.for_path( repository.management_directory, repository.path )
+    return (not policy.skip_notifications and repository.push_user not in PostExceptions
+            and repository.ref_type is not RefType.WorkBranch and repository.repo_type in NotifyAllowed)
+
+def process_accepted_change( repository, transport = None, bugzilla = None, checker = None ):
+    "Output information about, and send notifications for, a ref change which has been accepted"
+
+    # Are post commands supposed to be run?
+    policy = RepoPolicy.for_path( repository.management_directory, repository.path )
+    if policy.skip_notifications:
+        print "Hooks are currently disabled!"
+        return
+
+    # Does this user need a special post-update skip?
+    if repository.push_user in PostExceptions:
+        return
+
+    # Output a helpful url....
+    if repository.tip_introduced:
+        if repository.commit_count == 1:
+            print "This commit is available for viewing at:"
+        else:
+            print "The last commit in this series is available for viewing at:"
+
+        print Commit.UrlPattern.format( repository.virtual_path, repository.new_sha1 )
+
+    # Is this change to a work branch?
+    if repository.ref_type is RefType.WorkBranch:
+        print "Not processing commit hooks - this is a work branch"
+        return
+
+    # Are we allowed to send notifications on this repo?
+    if not repository.repo_type in NotifyAllowed:
+        return
+
+    # Prepare to send notifications, over a single connection (or into the spool)
+    own_transport = transport is None
+    if own_transport:
+        transport = open_transport()
+    # Bugzilla is notified once per bug, after all the commits have been seen
+    own_bugzilla = bugzilla is None
+    if own_bugzilla:
+        bugzilla = BugzillaAggregator(transport)
+    notifier = CommitNotifier(transport)
+    cia = CiaNotifier(repository, transport)
+    # The license verdicts are stored once the whole push has been checked
+    own_checker = checker is None
+    if own_checker:
+        checker = CommitChecker()
+
+    # Perform notifications
+    for (commit, diff) in notifier.handler(repository):
+        # Check for license, etc problems in the commit
+        with Metrics.stage("checker"):
+            checker.check_commit_problems( commit, diff )
+
+        # Create the message builder in preperation to send notifications
+        builder = MessageBuilder( repository, commit, checker )
+        builder.determine_keywords()
+
+        # Do CIA (IRC Notifications)
+        with Metrics.stage("notify_cia"):
+            cia.notify(builder)
+
+        if repository.repo_type == RepoType.Sysadmin:
+            notify_address = "sysadmin-svn@kde.org"
+        else:
+            notify_address = "kde-commits@kde.org"
+
+        with Metrics.stage("notify_email"):
+            notifier.notify_email( builder, notify_address, diff )
+
+        # Handle Bugzilla
+        bugzilla.add( builder )
+
+    if own_bugzilla:
+        with Metrics.stage("notify_bugzilla"):
+            bugzilla.notify()
+    if own_checker:
+        checker.store_license_verdicts()
+    if own_transport:
+        transport.close()
+
+def email_classes():
+    "Loads the email packages when the first notification is built, returning the MIMEText and Header classes"
+    from email.mime.text import MIMEText
+    from email.header import Header
+    from email import Charset
+
+    # Ensure emails get done using the charset encoding method we want, not what Python thinks is best....
+    Charset.add_charset("utf-8", Charset.QP, Charset.QP)
+    return MIMEText, Header
 
 def read_command( command, shell=False ):
     process = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE,
@@ -1128,7 +3677,7 @@ def get_change_diff( repository, log_arguments ):
                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     # Pass on the commits for it to show...
-    for sha1 in repository.commits:
+    for sha1 in repository.revisions():
         process.stdin.write(sha1 + "\n")
     process.stdin.close()
     return process
@@ -11,27 +11,283 @@ shared mime database package.
 """
 
 import os
+import re
+import sys
+import mmap
 import struct
-from fnmatch import fnmatch
-from xml.dom import minidom, XML_NAMESPACE
+from collections import OrderedDict
+from fnmatch import translate
 from . import xdg
 from ..basemime import BaseMime
 
 
+class MimeCache(object):
+	"""
+	/usr/share/mime/mime.cache, looked up in place through mmap
+	"""
+	MAJOR_VERSION = 1
+	CASE_SENSITIVE = 0x100
+
+	CARD32 = struct.Struct(">I")
+	PAIR = struct.Struct(">II")
+	TRIPLE = struct.Struct(">III")
+
+	# The text files the cache is generated from, which are used instead if it is older
+	SOURCES = ["aliases", "generic-icons", "globs2", "magic", "subclasses"]
+
+	def __init__(self, path):
+		with open(path, "rb") as file:
+			self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		major, minor = struct.unpack_from(">HH", self._map, 0)
+		if major != self.MAJOR_VERSION or minor < 1:
+			raise ValueError("Unsupported version %d.%d of %r" % (major, minor, path))
+
+		(self._aliasList, self._parentList, self._literalList, self._suffixTree, self._globList,
+			self._magicList, self._namespaceList, self._iconsList, self._genericIconsList) = struct.unpack_from(">9I", self._map, 4)
+		self._literals = None
+		self._nodes = {}
+		self._globs = None
+		self._magic = None
+
+	def card32(self, offset):
+		return self.CARD32.unpack_from(self._map, offset)[0]
+
+	def bytesAt(self, offset):
+		return self._map[offset:self._map.find(b"\0", offset)]
+
+	def string(self, offset):
+		value = self.bytesAt(offset)
+		return value if str is bytes else value.decode("utf-8")
+
+	def search(self, listOffset, entrySize, key):
+		"""
+		Binary search a list sorted by the string its entries start with,
+		returning the offset of the entry for key, or None
+		"""
+		if not isinstance(key, bytes):
+			key = key.encode("utf-8")
+
+		low, high = 0, self.card32(listOffset)
+		while low < high:
+			middle = (low + high) // 2
+			entry = listOffset + 4 + middle * entrySize
+			value = self.bytesAt(self.card32(entry))
+			if value < key:
+				low = middle + 1
+			elif value > key:
+				high = middle
+			else:
+				return entry
+
+	def lookup(self, listOffset, name):
+		entry = self.search(listOffset, 8, name)
+		if entry is not None:
+			return self.string(self.card32(entry + 4))
+
+	def alias(self, name):
+		return self.lookup(self._aliasList, name)
+
+	def genericIcon(self, name):
+		return self.lookup(self._genericIconsList, name)
+
+	def parents(self, name):
+		entry = self.search(self._parentList, 8, name)
+		if entry is None:
+			return None
+
+		parents = self.card32(entry + 4)
+		return [self.string(self.card32(parents + 4 + 4 * i)) for i in range(self.card32(parents))]
+
+	def literals(self):
+		"""
+		The literal globs, as (mime offset, case sensitive) by name, decoded on first use
+		"""
+		if self._literals is None:
+			self._literals = {}
+			for i in range(self.card32(self._literalList)):
+				literal, mime, flags = self.TRIPLE.unpack_from(self._map, self._literalList + 4 + 12 * i)
+				self._literals[self.string(literal)] = (mime, flags & self.CASE_SENSITIVE)
+
+		return self._literals
+
+	def matchLiteral(self, name):
+		literals = self.literals()
+		if name in literals:
+			return self.string(literals[name][0])
+
+		mime, caseSensitive = literals.get(name.lower(), (None, True))
+		if not caseSensitive:
+			return self.string(mime)
+
+	def children(self, count, first):
+		"""
+		The children of a node of the reverse suffix tree, as a list of leaves (weight, mime offset,
+		case sensitive) and the other nodes by character, decoded the first time the node is visited
+		"""
+		try:
+			return self._nodes[first]
+		except KeyError:
+			pass
+
+		leaves = []
+		nodes = {}
+		for child in range(first, first + 12 * count, 12):
+			character, second, third = self.TRIPLE.unpack_from(self._map, child)
+			if character == 0:
+				leaves.append((third & 0xff, second, third & self.CASE_SENSITIVE))
+			else:
+				nodes[character] = (second, third)
+
+		self._nodes[first] = (leaves, nodes)
+		return leaves, nodes
+
+	def matchSuffix(self, name, caseSensitive=True):
+		"""
+		Walk the reverse suffix tree with name, returning (weight, length, mime offset)
+		for the best suffix glob matching it, or None
+		"""
+		leaves, nodes = self.children(*self.PAIR.unpack_from(self._map, self._suffixTree))
+		best = None
+		for length, character in enumerate(reversed(name), 1):
+			node = nodes.get(ord(character))
+			if node is None:
+				break
+
+			# Each leaf is a glob which the suffix read so far matches
+			leaves, nodes = self.children(*node)
+			for weight, mime, leafCaseSensitive in leaves:
+				if leafCaseSensitive and not caseSensitive:
+					continue
+				if best is None or (weight, length) > best[:2]:
+					best = (weight, length, mime)
+
+		return best
+
+	def globs(self):
+		"""
+		The globs which are neither literals nor suffixes, indexed as GlobsFile does
+		"""
+		if self._globs is None:
+			self._globs = GlobsFile()
+			for i in range(self.card32(self._globList)):
+				glob, mime, flags = self.TRIPLE.unpack_from(self._map, self._globList + 4 + 12 * i)
+				self._globs.addGlob(flags & 0xff, self.string(mime), self.string(glob), flags & self.CASE_SENSITIVE and ["cs"] or [])
+
+		return self._globs
+
+	def magic(self):
+		"""
+		The magic sections, as (priority, mime, rules), decoded on first use
+		"""
+		if self._magic is None:
+			count, extent, first = self.TRIPLE.unpack_from(self._map, self._magicList)
+			self._magic = []
+			for match in range(first, first + 16 * count, 16):
+				priority, mime, matchlets, firstMatchlet = struct.unpack_from(">4I", self._map, match)
+				self._magic.append((priority, self.string(mime), self.matchlets(matchlets, firstMatchlet)))
+
+		return self._magic
+
+	def matchlets(self, count, first):
+		rules = []
+		for matchlet in range(first, first + 32 * count, 32):
+			start, rangeLength, wordSize, length, value, mask, children, firstChild = struct.unpack_from(">8I", self._map, matchlet)
+			rule = MagicFile.Magic(start, self._map[value:value + length], mask and self._map[mask:mask + length] or None, wordSize, rangeLength)
+			rule.children = self.matchlets(children, firstChild)
+			rules.append(rule)
+
+		return rules
+
+	def matchGlob(self, name):
+		if isinstance(name, bytes):
+			name = name.decode("utf-8", "replace")
+
+		mime = self.matchLiteral(name)
+		if mime:
+			return mime
+
+		best = self.matchSuffix(name)
+		lowered = name.lower()
+		if lowered != name:
+			folded = self.matchSuffix(lowered, caseSensitive=False)
+			if folded is not None and (best is None or folded[:2] > best[:2]):
+				best = folded
+
+		if best is not None:
+			return self.string(best[2])
+
+		return self.globs().matchComplex(name)
+
+_CACHES = None
+
+def getCaches():
+	"""
+	Return the up to date mime.cache of each XDG data dir which has one, by directory
+	"""
+	global _CACHES
+	if _CACHES is None:
+		_CACHES = OrderedDict()
+		for path in xdg.getFiles(os.path.join("mime", "mime.cache")):
+			directory = os.path.dirname(path)
+			sources = [os.path.join(directory, name) for name in MimeCache.SOURCES]
+			try:
+				modified = os.path.getmtime(path)
+				if any(os.path.exists(source) and os.path.getmtime(source) > modified for source in sources):
+					continue
+				_CACHES[directory] = MimeCache(path)
+			except (EnvironmentError, ValueError, struct.error):
+				continue
+
+	return _CACHES
+
+def getTextFiles(name):
+	"""
+	Return the files of the given name from the XDG data dirs which don't have an up to date mime.cache
+	"""
+	caches = getCaches()
+	return [path for path in xdg.getFiles(name) if os.path.dirname(path) not in caches]
+
+
 class BaseFile(object):
-	def __init__(self):
+	"""
+	Files of the shared database (named relative to the XDG data dirs) are only read when
+	first needed, and only from the dirs which don't have a mime.cache to look them up in
+	"""
+	def __init__(self, name=None):
+		self._name = name
+		self._loaded = False
 		self._keys = {}
 
 	def __repr__(self):
 		return self._keys.__repr__()
 
+	def load(self):
+		if self._name and not self._loaded:
+			self._loaded = True
+			for path in getTextFiles(self._name):
+				self.parse(path)
+
 	def get(self, name, default=None):
+		if self._name:
+			for cache in getCaches().values():
+				value = self.fromCache(cache, name)
+				if value is not None:
+					return value
+
+		self.load()
 		return self._keys.get(name, default)
 
+	def fromCache(self, cache, name):
+		return None
+
 class AliasesFile(BaseFile):
 	"""
 	/usr/share/mime/aliases
 	"""
+	def fromCache(self, cache, name):
+		return cache.alias(name)
+
 	def parse(self, path):
 		with open(path, "r") as file:
 			for line in file:
@@ -41,21 +297,122 @@ class AliasesFile(BaseFile):
 				mime, alias = line.split(" ")
 				self._keys[mime] = alias
 
-ALIASES = AliasesFile()
-for f in xdg.getFiles("mime/aliases"):
-	ALIASES.parse(f)
+ALIASES = AliasesFile("mime/aliases")
 
 
+def translateGlob(glob):
+	"""
+	Translate a glob into a regular expression which can be embedded in another
+	(compiled with re.S), and which only matches whole names once followed by \\Z
+	"""
+	pattern = translate(glob)
+	if pattern.startswith("(?s:") and pattern.endswith(")\\Z"):
+		return pattern[4:-3]
+	return pattern[:pattern.rindex("\\Z")]
+
+def literalAffixes(glob):
+	"""
+	Return the literal prefix and suffix of a glob, ie. what any name it matches starts and ends with
+	"""
+	special = "*?[]"
+	start = 0
+	while start < len(glob) and glob[start] not in special:
+		start += 1
+	end = len(glob)
+	while end > start and glob[end - 1] not in special:
+		end -= 1
+	return glob[:start], glob[end:]
+
+class GlobIndex(object):
+	"""
+	Globs bucketed by their literal suffix, or their literal prefix for those without one,
+	each bucket being tested with a single regular expression
+	"""
+	AFFIX_LENGTH = 3
+	# Python 2 limits the number of groups in a regular expression
+	CHUNK_SIZE = 90
+
+	def __init__(self, globs):
+		"""
+		Takes a list of (rank, glob) pairs, the lowest rank being the best
+		"""
+		suffixes = {}
+		prefixes = {}
+		others = []
+		for rank, glob in globs:
+			prefix, suffix = literalAffixes(glob)
+			if suffix:
+				suffixes.setdefault(suffix[-self.AFFIX_LENGTH:], []).append((rank, glob))
+			elif prefix:
+				prefixes.setdefault(prefix[:self.AFFIX_LENGTH], []).append((rank, glob))
+			else:
+				others.append((rank, glob))
+
+		self._suffixes = dict((key, self.compile(entries)) for key, entries in suffixes.items())
+		self._prefixes = dict((key, self.compile(entries)) for key, entries in prefixes.items())
+		self._suffixLengths = sorted(set(len(key) for key in suffixes))
+		self._prefixLengths = sorted(set(len(key) for key in prefixes))
+		self._others = others and self.compile(others) or None
+
+	@classmethod
+	def compile(cls, globs):
+		# Alternatives are tried in order, so the best ranked glob matching is the one reported
+		globs = sorted(globs)
+		chunks = [globs[i:i + cls.CHUNK_SIZE] for i in range(0, len(globs), cls.CHUNK_SIZE)]
+		return [re.compile("|".join("(?P<glob%d>%s\\Z)" % (rank, translateGlob(glob)) for rank, glob in chunk), re.S) for chunk in chunks]
+
+	def match(self, name):
+		"""
+		Return the best rank of the globs matching name, or None
+		"""
+		buckets = [self._suffixes.get(name[-length:]) for length in self._suffixLengths]
+		buckets += [self._prefixes.get(name[:length]) for length in self._prefixLengths]
+		buckets.append(self._others)
+
+		best = None
+		for bucket in buckets:
+			for regex in bucket or ():
+				match = regex.match(name)
+				if match:
+					rank = int(match.lastgroup[4:])
+					if best is None or rank < best:
+						best = rank
+					break
+		return best
+
 class GlobsFile(object):
 	"""
 	/usr/share/mime/globs2
 	"""
-	def __init__(self):
+	CACHE_SIZE = 1024
+
+	def __init__(self, name=None):
+		self._name = name
+		self._loaded = False
 		self._extensions = {}
 		self._literals = {}
 		self._matches = []
+		self._ranked = None
+		self._index = None
+		self._foldedIndex = None
+		self._recent = OrderedDict()
+
+	def load(self):
+		if self._name and not self._loaded:
+			self._loaded = True
+			for path in getTextFiles(self._name):
+				self.parse(path)
+
+	def addGlob(self, weight, mime, glob, flags):
+		self._matches.append((weight, mime, glob, flags))
+		self._ranked = None
+		self._recent.clear()
 
 	def parse(self, path):
+		self._ranked = None
+		self._recent.clear()
+
+		seen = set()
 		with open(path, "r") as file:
 			for line in file:
 				if line.startswith("#"): # comment
@@ -70,44 +427,104 @@ class GlobsFile(object):
 				flags, _, line = line.partition(":")
 				flags = flags and flags.split(",") or []
 
+				# As in mime.cache, a glob is only listed once for each type
+				if (glob, mime) in seen:
+					continue
+				seen.add((glob, mime))
+
+				# As with mime.cache, the glob of the greatest weight (and then the first of them) wins
+				weight = int(weight)
+				extension = glob[1:]
 				if "*" not in glob and "?" not in glob and "[" not in glob:
-					self._literals[glob] = mime
+					if glob not in self._literals or weight > self._literals[glob][0]:
+						self._literals[glob] = (weight, mime, "cs" in flags)
 
-				elif glob.startswith("*.") and "cs" not in flags:
-					extension = glob[1:]
-					if "*" not in extension and "?" not in extension and "[" not in extension:
-						self._extensions[extension] = mime
+				elif glob.startswith("*.") and "cs" not in flags and "*" not in extension and "?" not in extension and "[" not in extension:
+					if extension not in self._extensions or weight > self._extensions[extension][0]:
+						self._extensions[extension] = (weight, mime)
 
 				else:
-					self._matches.append((int(weight), mime, glob, flags))
+					self.addGlob(weight, mime, glob, flags)
+
+	def buildIndex(self):
+		"""
+		Rank the complex globs by weight, then length (then order), and index them
+		"""
+		order = sorted(range(len(self._matches)), key=lambda i: (-self._matches[i][0], -len(self._matches[i][2]), i))
+		self._ranked = [self._matches[i] for i in order]
+
+		# Globs which aren't case sensitive also match the lower cased name
+		self._index = GlobIndex([(rank, glob) for rank, (weight, mime, glob, flags) in enumerate(self._ranked)])
+		self._foldedIndex = GlobIndex([(rank, glob) for rank, (weight, mime, glob, flags) in enumerate(self._ranked) if "cs" not in flags])
 
 	def match(self, name):
+		try:
+			mime = self._recent.pop(name)
+		except KeyError:
+			mime = self.lookup(name)
+			if len(self._recent) >= self.CACHE_SIZE:
+				self._recent.popitem(last=False)
+
+		self._recent[name] = mime
+		return mime
+
+	def lookup(self, name):
+		if self._name:
+			for cache in getCaches().values():
+				mime = cache.matchGlob(name)
+				if mime:
+					return mime
+			self.load()
+
 		if name in self._literals:
-			return self._literals[name]
+			return self._literals[name][1]
 
-		_, extension = os.path.splitext(name)
-		if extension in self._extensions:
-			return self._extensions[extension]
-		elif extension.lower() in self._extensions:
-			return self._extensions[extension.lower()]
+		weight, mime, caseSensitive = self._literals.get(name.lower(), (None, None, True))
+		if not caseSensitive:
+			return mime
 
-		matches = []
-		for weight, mime, glob, flags in self._matches:
-			if fnmatch(name, glob):
-				matches.append((weight, mime, glob))
+		best = self.matchExtension(name)
+		if best is not None:
+			return best[2]
 
-			elif "cs" not in flags and fnmatch(name.lower(), glob):
-				matches.append((weight, mime, glob))
+		return self.matchComplex(name)
 
-		if not matches:
+	def matchExtension(self, name):
+		"""
+		Return (weight, length, mime) for the best extension glob matching name, or None,
+		ranking them by weight and then length as mime.cache does ("*.tar.gz" over "*.gz")
+		"""
+		best = None
+		lowered = name.lower()
+		start = name.find(".")
+		while start != -1:
+			for extension in (name[start:], lowered[start:]):
+				if extension in self._extensions:
+					weight, mime = self._extensions[extension]
+					if best is None or (weight, len(extension)) > best[:2]:
+						best = (weight, len(extension), mime)
+			start = name.find(".", start + 1)
+
+		return best
+
+	def matchComplex(self, name):
+		if self._ranked is None:
+			self.buildIndex()
+
+		rank = self._index.match(name)
+		lowered = name.lower()
+		if lowered != name:
+			folded = self._foldedIndex.match(lowered)
+			if folded is not None and (rank is None or folded < rank):
+				rank = folded
+
+		if rank is None:
 			return ""
 
-		weight, mime, glob = max(matches, key=lambda weight_mime_glob: (weight_mime_glob[0], len(weight_mime_glob[2])))
+		weight, mime, glob, flags = self._ranked[rank]
 		return mime
 
-GLOBS = GlobsFile()
-for f in xdg.getFiles("mime/globs2"):
-	GLOBS.parse(f)
+GLOBS = GlobsFile("mime/globs2")
 
 
 class IconsFile(BaseFile):
@@ -115,6 +532,9 @@ class IconsFile(BaseFile):
 	/usr/share/mime/icons
 	/usr/share/mime/generic-icons
 	"""
+	def fromCache(self, cache, name):
+		return cache.genericIcon(name)
+
 	def parse(self, path):
 		with open(path, "r") as file:
 			for line in file:
@@ -124,9 +544,7 @@ class IconsFile(BaseFile):
 				mime, icon = line.split(":")
 				self._keys[mime] = icon
 
-ICONS = IconsFile()
-for f in xdg.getFiles("mime/generic-icons"):
-	ICONS.parse(f)
+ICONS = IconsFile("mime/generic-icons")
 
 
 class MagicFile(BaseFile):
@@ -134,145 +552,225 @@ class MagicFile(BaseFile):
 	/usr/share/mime/magic
 	"""
 	class Magic(object):
-		def __init__(self, *args):
-			pass
+		"""
+		A rule of a section, which matches if its value (under its mask) is found at one of the
+		offsets of its range, and if it has no children or one of its children matches
+		"""
+		__slots__ = ["start", "value", "mask", "masked", "rangeLength", "children"]
+
+		def __init__(self, start, value, mask=None, wordSize=1, rangeLength=1):
+			# Values of more than a byte are given big endian, and compared to data in host order
+			if wordSize > 1 and sys.byteorder == "little":
+				value = swapWords(value, wordSize)
+				mask = mask and swapWords(mask, wordSize)
+
+			self.start = start
+			self.value = value
+			self.mask = mask and bytearray(mask) or None
+			self.masked = mask and bytearray(v & m for v, m in zip(bytearray(value), self.mask)) or None
+			self.rangeLength = max(rangeLength, 1)
+			self.children = []
+
+		def extent(self):
+			return max([self.start + self.rangeLength - 1 + len(self.value)] + [child.extent() for child in self.children])
+
+		def matches(self, data):
+			if self.mask is None:
+				found = data.find(self.value, self.start, self.start + self.rangeLength - 1 + len(self.value)) != -1
+			else:
+				last = min(self.start + self.rangeLength, len(data) - len(self.value) + 1)
+				found = any(self.matchesAt(data, offset) for offset in range(self.start, last))
 
-	def readNumber(self, file):
-		ret = bytearray()
-		c = file.read(1)
-		while c:
-			if not c.isdigit():
-				file.seek(-1, os.SEEK_CUR)
-				break
-			ret.append(ord(c))
-			c = file.read(1)
+			if not found:
+				return False
+			return not self.children or any(child.matches(data) for child in self.children)
 
-		return ret and int(ret.decode("utf-8")) or 0
+		def matchesAt(self, data, offset):
+			window = bytearray(data[offset:offset + len(self.value)])
+			return all(byte & mask == value for byte, mask, value in zip(window, self.mask, self.masked))
+
+	def __init__(self, name=None):
+		super(MagicFile, self).__init__(name)
+		self._sections = []
+		self._ordered = None
+		self._index = None
 
 	def parse(self, path):
+		"""
+		Parse the sections of a magic file, read as a whole:
+		[priority:mime/type]
+		[ indent ] ">" start-offset "=" value [ "&" mask ] [ "~" word-size ] [ "+" range-length ] "\n"
+		"""
 		with open(path, "rb") as file:
-			if not file.read(12) == b"MIME-Magic\0\n":
-				raise ValueError("Bad header for file %r" % (path))
-
-			sections = []
-
-			while True:
-				# Parse the head
-				# Expect a "["
-				c = file.read(1)
-
-				# Check if the file is empty
-				if not c:
-					return
-
-				if c != b"[":
-					raise ValueError("Section syntax error in %r: expected '[', got %r" % (file.name, c))
-				priority, mime = self.parseSectionHead(file)
-				if file.read(1) != b"\n":
-					raise ValueError("Odd header in %r" % (file.name))
-
-				# Parse the section(s)
-				sections = []
-				while True:
-					c = file.read(1)
-					if not c:
-						return
-					file.seek(-1, os.SEEK_CUR)
-					if c != b"[":
-						if c == b"\n": # end of file
-							return
-						else:
-							sections.append(self.parseSectionBody(file))
-					else:
-						break
+			data = file.read()
+
+		if not data.startswith(b"MIME-Magic\0\n"):
+			raise ValueError("Bad header for file %r" % (path))
+
+		self._ordered = None
+		position = 12
+		rules = None
+		while position < len(data):
+			if data[position:position + 1] == b"[":
+				end = data.find(b"]\n", position)
+				if end == -1:
+					raise ValueError("Unfinished header in %r" % (path))
+				priority, mime = self.parseSectionHead(data[position + 1:end])
+				position = end + 2
+
+				rules = []
+				# The rule most recently read at each level of indentation
+				parents = []
+				self._sections.append((priority, mime, rules))
+				self._keys.setdefault(mime, []).append((priority, rules))
+
+			elif rules is None:
+				raise ValueError("Section syntax error in %r: expected '[', got %r" % (path, data[position:position + 1]))
 
-				# Store it all
-				if mime not in self._keys:
-					self._keys[mime] = []
-				self._keys[mime].append((priority, sections))
+			else:
+				indent, rule, position = self.parseSectionBody(data, position, path)
+				if rule is None or indent > len(parents):
+					continue
+
+				del parents[indent:]
+				if indent:
+					parents[-1].children.append(rule)
+				else:
+					rules.append(rule)
+				parents.append(rule)
 
-	def parseSectionHead(self, file):
+	def parseSectionHead(self, head):
 		"""
 		Parse head of a section
 		[50:text/x-diff]\n
 		"""
-		s = bytearray()
-		while True:
-			c = file.read(1)
-			if not c:
-				raise ValueError("Unfinished header in %r" % (file.name))
-			if c == b"]":
-				break
-			s.append(ord(c))
+		if b":" not in head:
+			raise ValueError("No ':' in section header %r" % (head))
 
-		if b":" not in s:
-			raise ValueError("No ':' in section header %r" % (s))
+		priority, type = head.decode("utf-8").split(":", 1)
+		return int(priority), str(type)
 
-		s = s.decode("utf-8")
-		priority, type = s.split(":")
-		return priority, type
+	def readNumber(self, data, position):
+		end = position
+		while data[end:end + 1].isdigit():
+			end += 1
+		return end > position and int(data[position:end]) or 0, end
 
-	def parseSectionBody(self, file):
+	def parseSectionBody(self, data, position, path):
 		"""
-		Parse line of a section
-		[ indent ] ">" start-offset "=" value [ "&" mask ] [ "~" word-size ] [ "+" range-length ] "\n"
+		Parse line of a section, returning its indent, the rule and the position of the next line
 		"""
-		indent = None
-		c = file.read(1)
-		if not c:
-			raise ValueError("Early EOF")
-
-		if c != b">":
-			file.seek(-1, os.SEEK_CUR)
-			indent = self.readNumber(file)
-			c = file.read(1)
-			if c != b">":
-				raise ValueError("Missing '>' in section body (got %r)" % (c))
-
-		startOffset = self.readNumber(file)
-
-		c = file.read(1)
-
-		if c != b"=":
-			raise ValueError("Missing '=' in %r section body (got %r)" % (file.name, c))
-
-		valueLength, = struct.unpack(">H", file.read(2))
-		value = file.read(valueLength)
-
-		invalidLine = False
-		c = file.read(1)
+		indent, position = self.readNumber(data, position)
+		if data[position:position + 1] != b">":
+			raise ValueError("Missing '>' in section body of %r (got %r)" % (path, data[position:position + 1]))
+
+		start, position = self.readNumber(data, position + 1)
+		if data[position:position + 1] != b"=":
+			raise ValueError("Missing '=' in %r section body (got %r)" % (path, data[position:position + 1]))
+
+		valueLength, = struct.unpack(">H", data[position + 1:position + 3])
+		position += 3
+		value = data[position:position + valueLength]
+		position += valueLength
+
+		mask = None
+		wordSize = 1
+		rangeLength = 1
 		while True:
+			c = data[position:position + 1]
 			if c == b"\n":
-				# Done with the section
-				break
+				return indent, self.Magic(start, value, mask, wordSize, rangeLength), position + 1
 			elif c == b"&":
-				match = file.read(valueLength)
-				break
+				mask = data[position + 1:position + 1 + valueLength]
+				position += 1 + valueLength
 			elif c == b"~":
-				wordSize = self.readNumber(file)
-				break
+				wordSize, position = self.readNumber(data, position + 1)
 			elif c == b"+":
-				rangeLength = self.readNumber(file)
-				break
+				rangeLength, position = self.readNumber(data, position + 1)
 			elif not c:
-				raise ValueError("Unexpected EOF in section body")
+				raise ValueError("Unexpected EOF in section body of %r" % (path))
 			else:
-				raise ValueError("Unexpected character in section body: %r" % (c))
+				# Lines using extensions to the format are to be ignored
+				end = data.find(b"\n", position)
+				return indent, None, end == -1 and len(data) or end + 1
+
+	def ordered(self):
+		"""
+		All the sections, from the caches and the text files, by priority (then the order they were read in)
+		"""
+		if self._ordered is None:
+			self.load()
+			sections = list(self._sections)
+			if self._name:
+				for cache in getCaches().values():
+					sections.extend(cache.magic())
+
+			ordered = sorted(sections, key=lambda section: -section[0])
+			self._index = MagicIndex(ordered)
+			self._ordered = ordered
+
+		return self._ordered
+
+	def extent(self):
+		"""
+		How much of the start of a file the rules may look at
+		"""
+		self.ordered()
+		return self._index.extent
+
+	def match(self, data):
+		"""
+		Return the type of the highest priority section matching data, the start of a file, or None
+		"""
+		self.ordered()
+		return self._index.match(data)
+
+def swapWords(value, wordSize):
+	value = bytearray(value)
+	for i in range(0, len(value) - wordSize + 1, wordSize):
+		value[i:i + wordSize] = value[i:i + wordSize][::-1]
+	return bytes(value)
 
-			# TODO unknown character, see kmimetyperepository.cpp
+class MagicIndex(object):
+	"""
+	Magic sections, with the rules which compare a single offset to an unmasked value indexed
+	by that offset and the first byte of the value, so that only the rules whose first byte is
+	found in data are tried, along with those looking at a range or using a mask
+	"""
+	def __init__(self, sections):
+		self._byOffset = {}
+		self._others = []
+		self.extent = 0
+		for rank, (priority, mime, rules) in enumerate(sections):
+			for rule in rules:
+				self.extent = max(self.extent, rule.extent())
+				if rule.rangeLength == 1 and rule.mask is None and rule.value:
+					self._byOffset.setdefault(rule.start, {}).setdefault(rule.value[:1], []).append((rank, rule))
+				else:
+					self._others.append((rank, rule))
 
-		return self.Magic(indent, startOffset, valueLength, value)
+		self._mimes = [mime for priority, mime, rules in sections]
 
+	def match(self, data):
+		candidates = list(self._others)
+		for offset, rules in self._byOffset.items():
+			candidates.extend(rules.get(data[offset:offset + 1], ()))
 
-MAGIC = MagicFile()
-for f in xdg.getFiles("mime/magic"):
-	MAGIC.parse(f)
+		candidates.sort(key=lambda candidate: candidate[0])
+		for rank, rule in candidates:
+			if rule.matches(data):
+				return self._mimes[rank]
+
+MAGIC = MagicFile("mime/magic")
 
 
 class SubclassesFile(BaseFile):
 	"""
 	/usr/share/mime/subclasses
 	"""
+	def fromCache(self, cache, name):
+		return cache.parents(name)
+
 	def parse(self, path):
 		with open(path, "r") as file:
 			for line in file:
@@ -284,14 +782,17 @@ class SubclassesFile(BaseFile):
 					self._keys[mime] = []
 				self._keys[mime].append(subclass)
 
-SUBCLASSES = SubclassesFile()
-for f in xdg.getFiles("mime/subclasses"):
-	SUBCLASSES.parse(f)
+SUBCLASSES = SubclassesFile("mime/subclasses")
+
+# Bytes which text (other than in legacy encodings) doesn't contain, besides NUL
+CONTROL_CHARACTERS = re.compile(b"[\x01-\x07\x0e-\x1a\x1c-\x1f\x7f]")
 
 class MimeType(BaseMime):
 	"""
 	XDG-based MimeType
 	"""
+	# How much of a file is checked for NUL bytes, which only binary files have (as git assumes)
+	TEXT_SAMPLE_SIZE = 8000
 
 	@staticmethod
 	def installPackage(package, base=os.path.join(xdg.XDG_DATA_HOME, "mime")):
@@ -312,13 +813,72 @@ class MimeType(BaseMime):
 	def fromContent(cls, name):
 		try:
 			size = os.stat(name).st_size
-		except IOError:
+		except (IOError, OSError):
 			return
 
 		if size == 0:
 			return cls(cls.ZERO_SIZE)
 
+		# Only as much of the file as the magic rules look at is read
+		try:
+			with open(name, "rb") as file:
+				data = file.read(max(MAGIC.extent(), cls.TEXT_SAMPLE_SIZE))
+		except (IOError, OSError):
+			return
+
+		return cls.fromData(data)
+
+	@classmethod
+	def fromData(cls, data):
+		"""
+		The type of a file starting with data, by its magic, or else whether it looks like text
+		"""
+		if not data:
+			return cls(cls.ZERO_SIZE)
+
+		mime = MAGIC.match(data)
+		if mime:
+			return cls(mime)
+
+		return cls(b"\0" in data[:cls.TEXT_SAMPLE_SIZE] and cls.DEFAULT_BINARY or cls.DEFAULT_TEXT)
+
+	@classmethod
+	def isTextData(cls, data):
+		"""
+		Whether a file starting with data is text. As git decides, it must not contain a NUL
+		byte near its start. If it contains other control characters it must also not have
+		the magic of a type which isn't text. Without them it is text, whatever its magic says,
+		as formats such as PEM certificates and XPM images are recognized by a printable signature.
+		"""
+		sample = data[:cls.TEXT_SAMPLE_SIZE]
+		if b"\0" in sample:
+			return False
+		if not CONTROL_CHARACTERS.search(sample):
+			return True
+
+		mime = MAGIC.match(data)
+		return not mime or cls(mime).isText()
+
+	def isText(self):
+		"""
+		Whether the type is text/plain, or one of its (possibly indirect) subclasses
+		"""
+		seen = set()
+		pending = [ALIASES.get(self.name()) or self.name()]
+		while pending:
+			mime = pending.pop()
+			if mime in seen:
+				continue
+			if mime == self.DEFAULT_TEXT or mime.startswith("text/"):
+				return True
+
+			seen.add(mime)
+			pending.extend(SUBCLASSES.get(mime, []))
+
+		return False
+
 	def aliases(self):
+		from xml.dom import minidom
 		if not self._aliases:
 			files = xdg.getFiles(os.path.join("mime", self.type(), "%s.xml" % (self.subtype())))
 			if not files:
@@ -337,6 +897,7 @@ class MimeType(BaseMime):
 		return ALIASES.get(self.name())
 
 	def comment(self, lang="en"):
+		from xml.dom import minidom, XML_NAMESPACE
 		if lang not in self._comment:
 			files = xdg.getFiles(os.path.join("mime", self.type(), "%s.xml" % (self.subtype())))
 			if not files:
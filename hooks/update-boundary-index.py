@@ -0,0 +1,23 @@
+#!/usr/bin/python
+# Records the ref changes of an accepted push in the repository's boundary index
+# Reads the "<old-sha1> <new-sha1> <ref>" lines given to post-receive on stdin
+
+import os
+import sys
+from hooklib import BoundaryIndex, Metrics
+
+# With Gitaly GIT_DIR isn't always set
+git_dir = os.getenv('GIT_DIR', os.getcwd())
+
+changes = []
+for line in sys.stdin:
+    fields = line.split()
+    if len(fields) != 3:
+        continue
+
+    old_sha1, new_sha1, ref = fields
+    changes.append( (ref, old_sha1, new_sha1) )
+
+if changes:
+    with Metrics.stage("boundary_index"):
+        BoundaryIndex( os.path.abspath(git_dir) ).update( changes )